@@ -0,0 +1,399 @@
+# -*- coding: utf-8 -*-
+import json
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyproj
+import shapely
+
+
+class AnnotationStore:
+    """A columnar store of polygon annotations, as ragged arrays.
+
+    The vertices of all polygons are held in a single flat float32
+    coordinate buffer. Rings are slices of the buffer given by ring_offsets,
+    and polygons are slices of the rings given by polygon_offsets (the
+    first ring of a polygon is its exterior). This is the layout of the
+    GeoArrow polygon encoding, so stores concatenate with a few array
+    operations, pickle as a handful of arrays, and export to pandas,
+    GeoPandas, Arrow and GeoParquet without building Python lists.
+
+    Args:
+        coords (np.ndarray): A (K, 2) array of the [x, y] vertices of all rings
+        ring_offsets (np.ndarray): A (R + 1,) array of the offsets of the rings into coords
+        polygon_offsets (np.ndarray): A (P + 1,) array of the offsets of the polygons into the rings
+        image_id (np.ndarray): A (P,) array of the image tile of each polygon
+        class_id (np.ndarray): A (P,) array of the class of each polygon
+        score (np.ndarray, optional): A (P,) array of the prediction score of each polygon. Defaults to NaN scores.
+    """
+
+    def __init__(
+        self,
+        coords,
+        ring_offsets,
+        polygon_offsets,
+        image_id,
+        class_id,
+        score=None,
+    ):
+        self.coords = np.asarray(coords, dtype=np.float32).reshape(-1, 2)
+        self.ring_offsets = np.asarray(ring_offsets, dtype=np.int64)
+        self.polygon_offsets = np.asarray(polygon_offsets, dtype=np.int64)
+        self.image_id = np.asarray(image_id, dtype=np.int64)
+        self.class_id = np.asarray(class_id, dtype=np.int64)
+        if score is None:
+            score = np.full(len(self.image_id), np.nan)
+        self.score = np.asarray(score, dtype=np.float32)
+
+        assert (
+            len(self.polygon_offsets) == len(self.image_id) + 1
+        ), "polygon_offsets must have one more entry than there are polygons."
+        assert (
+            len(self.class_id) == len(self.image_id) == len(self.score)
+        ), "image_id, class_id and score must have one entry per polygon."
+
+    @classmethod
+    def empty(cls):
+        """Returns a store without annotations."""
+        return cls(np.empty((0, 2)), [0], [0], [], [])
+
+    @classmethod
+    def from_polygons(cls, polygons, image_id, class_id, score=None):
+        """Builds a store of single-ring polygons.
+
+        Args:
+            polygons (list): A list of polygons, each a list of [x, y] vertices (or flattened) or a (K, 2) array
+            image_id: The image tile of each polygon, or a single id for all of them
+            class_id: The class of each polygon, or a single class for all of them
+            score (optional): The prediction score of each polygon, or a single score for all of them. Defaults to None.
+
+        Returns:
+            AnnotationStore: The store of the polygons
+        """
+        if len(polygons) == 0:
+            return cls.empty()
+
+        coords = [
+            np.asarray(polygon, dtype=np.float32).reshape(-1, 2) for polygon in polygons
+        ]
+        counts = np.fromiter(
+            (len(c) for c in coords), dtype=np.int64, count=len(coords)
+        )
+        num_polygons = len(coords)
+        if score is not None:
+            score = np.broadcast_to(score, num_polygons)
+
+        return cls(
+            np.concatenate(coords),
+            np.concatenate([[0], np.cumsum(counts)]),
+            np.arange(num_polygons + 1),
+            np.broadcast_to(image_id, num_polygons),
+            np.broadcast_to(class_id, num_polygons),
+            score=score,
+        )
+
+    @classmethod
+    def from_dataframe(cls, annotations):
+        """Builds a store from a dataframe of annotations.
+
+        Args:
+            annotations (Pandas.DataFrame): A dataframe with pixel_polygon, image_id and class_id columns, and optionally a score column, e.g. from aerialseg.utils.extract_all_annotations_df.
+
+        Returns:
+            AnnotationStore: The store of the annotations
+        """
+        return cls.from_polygons(
+            annotations["pixel_polygon"].tolist(),
+            annotations["image_id"].to_numpy(),
+            annotations["class_id"].to_numpy(),
+            score=annotations["score"].to_numpy() if "score" in annotations else None,
+        )
+
+    @classmethod
+    def concat(cls, stores):
+        """Concatenates stores, shifting their offsets.
+
+        Args:
+            stores (list): A list of AnnotationStore
+
+        Returns:
+            AnnotationStore: A store of all the annotations, in order
+        """
+        stores = list(stores)
+        if len(stores) == 0:
+            return cls.empty()
+
+        vertex_starts = np.cumsum([0] + [len(store.coords) for store in stores])
+        ring_starts = np.cumsum([0] + [store.num_rings for store in stores])
+
+        return cls(
+            np.concatenate([store.coords for store in stores]),
+            np.concatenate(
+                [[0]]
+                + [
+                    store.ring_offsets[1:] + start
+                    for store, start in zip(stores, vertex_starts)
+                ]
+            ),
+            np.concatenate(
+                [[0]]
+                + [
+                    store.polygon_offsets[1:] + start
+                    for store, start in zip(stores, ring_starts)
+                ]
+            ),
+            np.concatenate([store.image_id for store in stores]),
+            np.concatenate([store.class_id for store in stores]),
+            score=np.concatenate([store.score for store in stores]),
+        )
+
+    def __len__(self):
+        return len(self.image_id)
+
+    def take(self, indices):
+        """Returns a store of the selected polygons.
+
+        Args:
+            indices (np.ndarray): The indices of the polygons to keep, or a boolean mask
+
+        Returns:
+            AnnotationStore: A store of the selected polygons, in the order of indices
+        """
+        indices = np.arange(len(self))[indices]
+        ring_counts = np.diff(self.polygon_offsets)[indices]
+        rings = _ragged_arange(self.polygon_offsets[:-1][indices], ring_counts)
+        vertex_counts = np.diff(self.ring_offsets)[rings]
+        vertices = _ragged_arange(self.ring_offsets[:-1][rings], vertex_counts)
+
+        return AnnotationStore(
+            self.coords[vertices],
+            np.concatenate([[0], np.cumsum(vertex_counts)]),
+            np.concatenate([[0], np.cumsum(ring_counts)]),
+            self.image_id[indices],
+            self.class_id[indices],
+            score=self.score[indices],
+        )
+
+    @property
+    def num_rings(self) -> int:
+        """Number of rings in the store."""
+        return len(self.ring_offsets) - 1
+
+    def _vertex_polygons(self):
+        """Returns the index of the polygon of each vertex."""
+        ring_polygons = np.repeat(
+            np.arange(len(self)), np.diff(self.polygon_offsets)
+        )
+
+        return np.repeat(ring_polygons, np.diff(self.ring_offsets))
+
+    def exteriors(self) -> list:
+        """Returns the exterior ring of each polygon.
+
+        Returns:
+            list: A list of (K, 2) views into the coordinate buffer, one per polygon
+        """
+        starts = self.ring_offsets[self.polygon_offsets[:-1]]
+        ends = self.ring_offsets[self.polygon_offsets[:-1] + 1]
+
+        return [self.coords[start:end] for start, end in zip(starts, ends)]
+
+    def attributes(self):
+        """Returns the attribute columns as a dataframe.
+
+        Returns:
+            Pandas.DataFrame: A dataframe with annot_id, image_id, class_id and score columns, backed by the store arrays
+        """
+        return pd.DataFrame(
+            {
+                "annot_id": np.arange(len(self)),
+                "image_id": self.image_id,
+                "class_id": self.class_id,
+                "score": self.score,
+            },
+            copy=False,
+        )
+
+    def to_pandas(self, as_lists: bool = False):
+        """Returns the annotations as a dataframe, as
+        aerialseg.utils.extract_all_annotations_df does.
+
+        Args:
+            as_lists (bool, optional): If true, pixel_polygon holds lists of [x, y] vertices, as expected by the COCO writers. Otherwise it holds (K, 2) views into the coordinate buffer, without copying it. Defaults to False.
+
+        Returns:
+            Pandas.DataFrame: A dataframe with annot_id, pixel_polygon, image_id, class_id and score columns
+        """
+        # Filled one by one, as numpy would stack polygons of equal length.
+        polygons = np.empty(len(self), dtype=object)
+        for i, polygon in enumerate(self.exteriors()):
+            polygons[i] = polygon.tolist() if as_lists else polygon
+        annotations = self.attributes()
+        annotations.insert(1, "pixel_polygon", polygons)
+
+        return annotations
+
+    def georeferenced_coords(self, transforms: list):
+        """Returns the vertices mapped with the transforms of their tiles.
+
+        Args:
+            transforms (list): A list of the affine.Affine transforms of the tiles, indexed by image_id
+
+        Returns:
+            np.ndarray: A (K, 2) float64 array of the georeferenced vertices
+        """
+        # Imported here, as aerialseg.postprocess depends on aerialseg.utils.
+        from aerialseg.postprocess import georeference_vertices
+
+        return georeference_vertices(
+            self.coords.astype(np.float64),
+            transforms,
+            image_ids=self.image_id[self._vertex_polygons()],
+        )
+
+    def to_shapely(self, transforms: list = None):
+        """Builds the shapely polygons straight from the coordinate buffer.
+
+        Args:
+            transforms (list, optional): A list of the affine.Affine transforms of the tiles, indexed by image_id. If given, the polygons are georeferenced. Defaults to None.
+
+        Returns:
+            np.ndarray: An array of shapely Polygons
+        """
+        if len(self) == 0:
+            return np.empty(0, dtype=object)
+
+        if transforms is None:
+            coords = self.coords
+        else:
+            coords = self.georeferenced_coords(transforms)
+        rings = shapely.linearrings(
+            coords,
+            indices=np.repeat(np.arange(self.num_rings), np.diff(self.ring_offsets)),
+        )
+
+        return shapely.polygons(
+            rings,
+            indices=np.repeat(np.arange(len(self)), np.diff(self.polygon_offsets)),
+        )
+
+    def to_geopandas(self, transforms: list = None, crs=None):
+        """Returns the annotations as a geodataframe.
+
+        Args:
+            transforms (list, optional): A list of the affine.Affine transforms of the tiles, indexed by image_id. If given, the polygons are georeferenced. Defaults to None.
+            crs (optional): The CRS of the transforms. Defaults to None.
+
+        Returns:
+            geopandas.GeoDataFrame: A geodataframe of the annotation attributes and polygons
+        """
+        return gpd.GeoDataFrame(
+            self.attributes(), geometry=self.to_shapely(transforms), crs=crs
+        )
+
+    def to_arrow(self, transforms: list = None, crs=None):
+        """Returns the annotations as an Arrow table with a GeoArrow polygon
+        geometry column and GeoParquet metadata.
+
+        The offsets and attribute columns are passed to Arrow as they are.
+        The coordinates are widened to float64, as GeoArrow requires.
+
+        Args:
+            transforms (list, optional): A list of the affine.Affine transforms of the tiles, indexed by image_id. If given, the polygons are georeferenced. Defaults to None.
+            crs (optional): The CRS of the transforms, as anything pyproj accepts. Defaults to None.
+
+        Returns:
+            pyarrow.Table: A table with annot_id, image_id, class_id, score and geometry columns
+        """
+        if transforms is None:
+            coords = self.coords.astype(np.float64)
+        else:
+            coords = self.georeferenced_coords(transforms)
+        vertices = pa.FixedSizeListArray.from_arrays(
+            pa.array(coords.ravel()), type=pa.list_(pa.field("xy", pa.float64()), 2)
+        )
+        rings = pa.LargeListArray.from_arrays(pa.array(self.ring_offsets), vertices)
+        polygons = pa.LargeListArray.from_arrays(
+            pa.array(self.polygon_offsets), rings
+        )
+
+        table = pa.Table.from_pandas(self.attributes(), preserve_index=False)
+        table = table.append_column("geometry", polygons)
+
+        return table.replace_schema_metadata(
+            {"geo": json.dumps(_geoparquet_metadata(crs))}
+        )
+
+    def to_parquet(self, path: str, transforms: list = None, crs=None):
+        """Writes the annotations to a GeoParquet file, with the native
+        GeoArrow polygon encoding.
+
+        Args:
+            path (str): Path of the GeoParquet file
+            transforms (list, optional): A list of the affine.Affine transforms of the tiles, indexed by image_id. If given, the polygons are georeferenced. Defaults to None.
+            crs (optional): The CRS of the transforms, as anything pyproj accepts. Defaults to None.
+        """
+        pq.write_table(self.to_arrow(transforms=transforms, crs=crs), path)
+
+    @classmethod
+    def from_arrow(cls, table):
+        """Builds a store from an Arrow table written by to_arrow.
+
+        Args:
+            table (pyarrow.Table): A table with image_id, class_id, score and GeoArrow polygon geometry columns
+
+        Returns:
+            AnnotationStore: The store of the annotations
+        """
+        polygons = table.column("geometry").combine_chunks()
+        rings = polygons.values
+        vertices = rings.values
+
+        return cls(
+            vertices.values.to_numpy(zero_copy_only=False),
+            rings.offsets.to_numpy(),
+            polygons.offsets.to_numpy(),
+            table.column("image_id").to_numpy(),
+            table.column("class_id").to_numpy(),
+            score=table.column("score").to_numpy(),
+        )
+
+    @classmethod
+    def read_parquet(cls, path: str):
+        """Reads a store from a GeoParquet file written by to_parquet.
+
+        Args:
+            path (str): Path of the GeoParquet file
+
+        Returns:
+            AnnotationStore: The store of the annotations
+        """
+        return cls.from_arrow(pq.read_table(path))
+
+
+def _ragged_arange(starts, counts):
+    """Concatenates the ranges starts[i] : starts[i] + counts[i]."""
+    ends = np.cumsum(counts)
+
+    total = ends[-1] if len(ends) > 0 else 0
+
+    return np.repeat(starts - (ends - counts), counts) + np.arange(total)
+
+
+def _geoparquet_metadata(crs=None) -> dict:
+    """Returns the GeoParquet "geo" metadata of a polygon geometry column."""
+    column = {"encoding": "polygon", "geometry_types": ["Polygon"]}
+    if crs is None:
+        # An explicit null marks the CRS as unknown, e.g. for pixel coordinates.
+        column["crs"] = None
+    else:
+        column["crs"] = pyproj.CRS.from_user_input(crs).to_json_dict()
+
+    return {
+        "version": "1.1.0",
+        "primary_column": "geometry",
+        "columns": {"geometry": column},
+    }
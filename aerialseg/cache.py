@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from aerialseg.utils import mask_crop_bounds
+
+
+def file_digest(path: str, chunk_size: int = 1 << 20) -> str:
+    """Returns the SHA-256 hex digest of a file's content.
+
+    Args:
+        path (str): Path of the file
+        chunk_size (int, optional): Number of bytes read at a time. Defaults to 1 MiB.
+
+    Returns:
+        str: The hex digest
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def model_digest(cfg, paste_masks: bool = True) -> str:
+    """Returns a digest identifying the predictions of a model.
+
+    Combines the content of the weights file, the config and its
+    SCORE_THRESH_TEST. The weights path and the device are left out of the
+    config, so moving the weights or switching devices keeps the digest.
+
+    Args:
+        cfg: Detectron2 config, with MODEL.WEIGHTS set
+        paste_masks (bool, optional): Whether the predictor pastes full-image masks, or returns ROI mask probabilities (see aerialseg.predictors.BatchPredictor). Defaults to True.
+
+    Returns:
+        str: The hex digest
+    """
+    model_cfg = cfg.clone()
+    model_cfg.defrost()
+    model_cfg.MODEL.WEIGHTS = ""
+    model_cfg.MODEL.DEVICE = ""
+
+    digest = hashlib.sha256()
+    digest.update(file_digest(cfg.MODEL.WEIGHTS).encode())
+    digest.update(model_cfg.dump().encode())
+    digest.update(repr(float(cfg.MODEL.ROI_HEADS.SCORE_THRESH_TEST)).encode())
+    digest.update(b"paste" if paste_masks else b"roi")
+
+    return digest.hexdigest()
+
+
+def pack_masks(mask_array, bbox) -> dict:
+    """Packs (N, H, W) binary masks into bits, cropped to their boxes.
+
+    Args:
+        mask_array (np.ndarray): A (N, H, W) array of binary masks
+        bbox (np.ndarray): A (N, 4) array of bounding boxes
+
+    Returns:
+        dict: Arrays of the crop "offsets" (N, 2) and "shapes" (N, 2), the concatenated "bits", and the "bit_offsets" (N + 1) of each mask into them
+    """
+    offsets = np.zeros((len(mask_array), 2), dtype=np.int32)
+    shapes = np.zeros((len(mask_array), 2), dtype=np.int32)
+    bits = []
+    for i, (mask, box) in enumerate(zip(mask_array, bbox)):
+        x0, y0, x1, y1 = mask_crop_bounds(mask, box)
+        offsets[i] = x0, y0
+        shapes[i] = y1 - y0, x1 - x0
+        bits.append(np.packbits(mask[y0:y1, x0:x1], axis=None))
+    bit_offsets = np.cumsum([0] + [len(b) for b in bits])
+
+    return {
+        "offsets": offsets,
+        "shapes": shapes,
+        "bits": np.concatenate(bits) if bits else np.zeros(0, dtype=np.uint8),
+        "bit_offsets": bit_offsets,
+    }
+
+
+def unpack_masks(packed: dict, image_shape: tuple):
+    """Unpacks masks packed by pack_masks into (N, H, W) binary masks.
+
+    Args:
+        packed (dict): The packed masks
+        image_shape (tuple): The (H, W) shape of the image
+
+    Returns:
+        np.ndarray: A (N, H, W) array of binary masks
+    """
+    num_masks = len(packed["offsets"])
+    mask_array = np.zeros((num_masks, *image_shape[:2]), dtype=bool)
+    for i in range(num_masks):
+        x0, y0 = packed["offsets"][i]
+        height, width = packed["shapes"][i]
+        start, end = packed["bit_offsets"][i], packed["bit_offsets"][i + 1]
+        bits = packed["bits"][start:end]
+        mask_array[i, y0 : y0 + height, x0 : x0 + width] = np.unpackbits(
+            bits, count=height * width
+        ).reshape(height, width)
+
+    return mask_array
+
+
+class PredictionCache:
+    """An on-disk cache of raw model outputs, keyed by tile content.
+
+    Entries hold the boxes, classes and scores of a tile prediction, with
+    full-image masks packed into bits within their boxes, or ROI mask
+    probabilities as float32. Keys combine the SHA-256 of the decoded tile
+    pixels with the model digest (weights, config, score threshold and mask
+    mode), so a post-processing sweep over the same tiles replays the
+    predictions at polygonization speed. Least recently used entries are
+    evicted once the cache grows beyond max_bytes.
+
+    Processes sharing the directory (e.g. replica workers) each keep their
+    own view of its entries. They rescan the directory whenever their view
+    exceeds max_bytes, or after writing a sixteenth of max_bytes, so the
+    cache can only exceed the cap by about max_bytes / 16 per process.
+
+    Args:
+        cache_dir (str): Directory of the cache. Created if it does not exist.
+        cfg: Detectron2 config, with MODEL.WEIGHTS set
+        paste_masks (bool, optional): Whether the predictor pastes full-image masks, or returns ROI mask probabilities. Defaults to True.
+        max_bytes (int, optional): Size cap of the cache in bytes. Defaults to 10 GB.
+
+    Attributes:
+        hits (int): Number of tiles found in the cache.
+        misses (int): Number of tiles not found in the cache.
+    """
+
+    def __init__(
+        self,
+        cache_dir: str,
+        cfg,
+        paste_masks: bool = True,
+        max_bytes: int = 10 * 10**9,
+    ):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.model_digest = model_digest(cfg, paste_masks=paste_masks)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self._scan()
+
+    def __getstate__(self):
+        # Pickled for worker processes, which share the entries on disk.
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _scan(self):
+        """Reads the entries of the directory, including those written by
+        other processes."""
+        # Least recently used entries first, by modification time.
+        entries = []
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if name.endswith(".npz"):
+                    try:
+                        stat = os.stat(os.path.join(root, name))
+                    except FileNotFoundError:
+                        # Evicted by another process.
+                        continue
+                    entries.append((stat.st_mtime, name[:-4], stat.st_size))
+        self._entries = OrderedDict((key, size) for _, key, size in sorted(entries))
+        self.size = sum(self._entries.values())
+        self._written = 0
+
+    def key(self, image) -> str:
+        """Returns the cache key of a tile.
+
+        Args:
+            image (np.ndarray): The decoded tile, of shape (H, W, C)
+
+        Returns:
+            str: The hex key
+        """
+        digest = hashlib.sha256(self.model_digest.encode())
+        digest.update(repr(image.shape).encode())
+        digest.update(np.ascontiguousarray(image).data)
+
+        return digest.hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f"{key}.npz")
+
+    def get(self, key: str):
+        """Returns the cached prediction arrays of a tile.
+
+        Args:
+            key (str): The cache key of the tile
+
+        Returns:
+            tuple: The (mask_array, bbox, labels, roi_masks, scores) of the tile as returned by aerialseg.utils.output_to_arrays, or None if the tile is not cached
+        """
+        path = self._path(key)
+        try:
+            with np.load(path) as npz:
+                entry = dict(npz)
+        except (OSError, ValueError):
+            # Missing, evicted by another process, or a truncated write.
+            with self._lock:
+                self.misses += 1
+            return None
+
+        # Touch the entry to mark it as recently used.
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        with self._lock:
+            self.hits += 1
+            if key in self._entries:
+                self._entries.move_to_end(key)
+
+        roi_masks = bool(entry["roi_masks"])
+        if roi_masks:
+            mask_array = entry["mask_probs"]
+        else:
+            mask_array = unpack_masks(entry, tuple(entry["image_shape"]))
+
+        return mask_array, entry["bbox"], entry["labels"], roi_masks, entry["scores"]
+
+    def put(self, key: str, arrays: tuple, image_shape: tuple):
+        """Stores the prediction arrays of a tile.
+
+        Args:
+            key (str): The cache key of the tile
+            arrays (tuple): The (mask_array, bbox, labels, roi_masks, scores) of the tile as returned by aerialseg.utils.output_to_arrays
+            image_shape (tuple): The shape of the tile
+        """
+        mask_array, bbox, labels, roi_masks, scores = arrays
+        entry = {
+            "bbox": bbox,
+            "labels": labels,
+            "scores": scores,
+            "roi_masks": np.array(roi_masks),
+            "image_shape": np.array(image_shape[:2]),
+        }
+        if roi_masks:
+            # Kept at full precision, so probabilities near the mask
+            # threshold replay on the same side of it.
+            entry["mask_probs"] = mask_array.astype(np.float32)
+        else:
+            entry.update(pack_masks(mask_array, bbox))
+
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Written to a temporary file first, so readers never see a partial entry.
+        with tempfile.NamedTemporaryFile(
+            dir=os.path.dirname(path), suffix=".tmp", delete=False
+        ) as f:
+            np.savez(f, **entry)
+        os.replace(f.name, path)
+
+        size = os.path.getsize(path)
+        with self._lock:
+            self.size += size - self._entries.pop(key, 0)
+            self._entries[key] = size
+            self._written += size
+            if self.size > self.max_bytes or self._written > self.max_bytes // 16:
+                # Other processes may have added entries since the last scan.
+                self._scan()
+                self._evict()
+
+    def _evict(self):
+        """Removes least recently used entries until the cache fits max_bytes."""
+        while self.size > self.max_bytes and len(self._entries) > 1:
+            key, size = self._entries.popitem(last=False)
+            self.size -= size
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+import glob
+import json
+import os
+from collections import deque
+
+import numpy as np
+
+from aerialseg.annotations import AnnotationStore
+from aerialseg.utils import tile_file_name
+
+
+class RunCheckpoint:
+    """Checkpoints the annotations of a prediction run, tile by tile, so an
+    interrupted run can be resumed.
+
+    Used as the writer of aerialseg.utils.extract_all_annotations. The
+    annotations of completed tiles are buffered and appended to the
+    checkpoint directory as GeoParquet chunks every flush_every tiles. The
+    tiles of each chunk are then appended to a manifest. A tile is
+    completed once it is in the manifest, so at most flush_every tiles are
+    lost if the process is killed. Chunks not yet in the manifest are
+    ignored.
+
+    extract_all_annotations calls add_annotations once per tile, in the
+    order of the add_image calls, which is how tiles are matched to their
+    annotations (including tiles without any).
+
+    Args:
+        checkpoint_dir (str): Directory of the checkpoint. Created if it does not exist.
+        params (dict, optional): Parameters of the run (e.g. model and post-processing options). A run can only be resumed with the same parameters. Defaults to None.
+        resume (bool, optional): If true, will continue the checkpoint found in checkpoint_dir. Otherwise checkpoint_dir must not hold a checkpoint already. Defaults to False.
+        flush_every (int, optional): Number of completed tiles buffered before they are written to the checkpoint. Defaults to 64.
+
+    Attributes:
+        completed (dict): Chunk and image id within the chunk of each completed tile, keyed by tile file name.
+    """
+
+    def __init__(
+        self,
+        checkpoint_dir: str,
+        params: dict = None,
+        resume: bool = False,
+        flush_every: int = 64,
+    ):
+        assert flush_every >= 1, "flush_every must be at least 1."
+        self.checkpoint_dir = checkpoint_dir
+        self.flush_every = flush_every
+        self.completed = {}
+        self._manifest_path = os.path.join(checkpoint_dir, "manifest.jsonl")
+        params_path = os.path.join(checkpoint_dir, "params.json")
+        params = json.loads(json.dumps(params or {}))
+
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        if os.path.exists(self._manifest_path):
+            if not resume:
+                raise FileExistsError(
+                    f"{checkpoint_dir} already holds a checkpoint. Resume it, or choose another directory."
+                )
+            with open(params_path, "r") as f:
+                checkpoint_params = json.load(f)
+            if checkpoint_params != params:
+                raise ValueError(
+                    f"The checkpoint in {checkpoint_dir} was created with other parameters: {checkpoint_params}."
+                )
+            self._read_manifest()
+        else:
+            with open(params_path, "w") as f:
+                json.dump(params, f)
+
+        # Chunks are numbered on from any chunk left, listed or not.
+        chunks = glob.glob(os.path.join(checkpoint_dir, "chunk-*.parquet"))
+        self._next_chunk = (
+            max(int(os.path.basename(c)[6:-8]) for c in chunks) + 1 if chunks else 0
+        )
+        self._pending = deque()
+        self._tiles = []
+        self._stores = []
+
+    def _read_manifest(self):
+        with open(self._manifest_path, "r") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # The last line may be cut short by a crash.
+                    continue
+                self.completed[record["tile"]] = (record["chunk"], record["image_id"])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        # Completed tiles are kept, also when the run is interrupted.
+        self.close()
+
+    def pending(self, tiles: list) -> list:
+        """Returns the tiles that are not completed yet.
+
+        Args:
+            tiles (list): A list of image paths or rasterio windows
+
+        Returns:
+            list: The tiles without a completed checkpoint, in order
+        """
+        return [tile for tile in tiles if tile_file_name(tile) not in self.completed]
+
+    def add_image(self, image_id: int, file_name: str, height: int, width: int):
+        """Registers a tile whose annotations are on their way.
+
+        Args:
+            image_id (int): an id for the image tile. Usually a unique int
+            file_name (str): file name of the image tile
+            height (int): height of the image tile in pixels
+            width (int): width of the image tile in pixels
+        """
+        self._pending.append((int(image_id), file_name))
+
+    def add_annotations(self, annotations):
+        """Buffers the annotations of the next registered tile, and writes the
+        buffer to the checkpoint once flush_every tiles are completed.
+
+        Args:
+            annotations (AnnotationStore or Pandas.DataFrame): the annotations of the tile
+        """
+        if not isinstance(annotations, AnnotationStore):
+            annotations = AnnotationStore.from_dataframe(annotations)
+        self._tiles.append(self._pending.popleft())
+        self._stores.append(annotations)
+        if len(self._tiles) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        """Writes the buffered tiles to the checkpoint."""
+        if not self._tiles:
+            return
+
+        annotations = AnnotationStore.concat(self._stores)
+        chunk = None
+        if len(annotations) > 0:
+            chunk = self._next_chunk
+            self._next_chunk += 1
+            path = os.path.join(self.checkpoint_dir, f"chunk-{chunk:06d}.parquet")
+            annotations.to_parquet(f"{path}.tmp")
+            os.replace(f"{path}.tmp", path)
+
+        with open(self._manifest_path, "a") as f:
+            for image_id, file_name in self._tiles:
+                f.write(
+                    json.dumps({"tile": file_name, "chunk": chunk, "image_id": image_id})
+                    + "\n"
+                )
+                self.completed[file_name] = (chunk, image_id)
+            f.flush()
+            os.fsync(f.fileno())
+
+        self._tiles = []
+        self._stores = []
+
+    def close(self):
+        """Writes any buffered tiles to the checkpoint."""
+        self.flush()
+
+    def load(self, file_names: list) -> AnnotationStore:
+        """Assembles the checkpointed annotations of a list of tiles.
+
+        Args:
+            file_names (list): The file names of the tiles of the run, in order. Image ids are assigned by position in this list.
+
+        Returns:
+            AnnotationStore: The annotations of the completed tiles, ordered by image id
+        """
+        image_ids = {file_name: i for i, file_name in enumerate(file_names)}
+        chunk_tiles = {}
+        for file_name, (chunk, image_id) in self.completed.items():
+            if chunk is not None and file_name in image_ids:
+                chunk_tiles.setdefault(chunk, {})[image_id] = image_ids[file_name]
+
+        stores = []
+        for chunk in sorted(chunk_tiles):
+            path = os.path.join(self.checkpoint_dir, f"chunk-{chunk:06d}.parquet")
+            annotations = AnnotationStore.read_parquet(path)
+            id_map = chunk_tiles[chunk]
+            annotations = annotations.take(
+                np.isin(annotations.image_id, list(id_map.keys()))
+            )
+            annotations.image_id = np.array(
+                [id_map[image_id] for image_id in annotations.image_id.tolist()],
+                dtype=np.int64,
+            )
+            stores.append(annotations)
+
+        annotations = AnnotationStore.concat(stores)
+
+        return annotations.take(np.argsort(annotations.image_id, kind="stable"))
@@ -0,0 +1,445 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import time
+from typing import Dict, List, Tuple
+
+import numpy as np
+import torch
+from detectron2.checkpoint import DetectionCheckpointer
+from detectron2.data import transforms as T
+from detectron2.engine import DefaultPredictor
+from detectron2.export import TracingAdapter, scripting_with_instances
+from detectron2.modeling import build_model
+from detectron2.structures import Boxes
+
+from aerialseg.cache import file_digest
+from aerialseg.predictors import OnnxPredictor
+from aerialseg.torchscript import TorchScriptPredictor
+
+# Export methods supported by each artifact format.
+EXPORT_FORMATS = {
+    "torchscript": ("tracing", "scripting"),
+    "onnx": ("tracing",),
+}
+
+# Output names of a traced model, in the order the Instances fields are
+# flattened, followed by the image size.
+TRACING_OUTPUT_NAMES = [
+    "pred_boxes",
+    "pred_classes",
+    "pred_masks",
+    "scores",
+    "image_size",
+]
+
+
+def load_model(cfg):
+    """Builds a Detectron2 model in eval mode, with the weights of cfg.MODEL.WEIGHTS.
+
+    Args:
+        cfg: Detectron2 config
+
+    Returns:
+        torch.nn.Module: The model
+    """
+    model = build_model(cfg)
+    DetectionCheckpointer(model).load(cfg.MODEL.WEIGHTS)
+    model.eval()
+
+    return model
+
+
+def sample_input(cfg, original_image) -> dict:
+    """Converts a BGR image into a model input, exactly as DefaultPredictor does.
+
+    Args:
+        cfg: Detectron2 config
+        original_image (np.ndarray): an image of shape (H, W, C) (in BGR order).
+
+    Returns:
+        dict: a model input with an "image" key
+    """
+    if cfg.INPUT.FORMAT == "RGB":
+        original_image = original_image[:, :, ::-1]
+    aug = T.ResizeShortestEdge(
+        [cfg.INPUT.MIN_SIZE_TEST, cfg.INPUT.MIN_SIZE_TEST], cfg.INPUT.MAX_SIZE_TEST
+    )
+    image = aug.get_transform(original_image).apply_image(original_image)
+
+    return {"image": torch.as_tensor(image.astype("float32").transpose(2, 0, 1))}
+
+
+def export_tracing(model, image, output_dir: str, formats: list, opset: int = 16):
+    """Exports a Mask R-CNN by tracing, as detectron2's export_model.py does.
+
+    The exported model takes a (3, H, W) float image and returns the raw
+    outputs of model.inference with do_postprocess=False: boxes, classes,
+    ROI masks and scores in the input image coordinates, then the image
+    size. The ONNX model has dynamic height and width.
+
+    Args:
+        model: Detectron2 model in eval mode
+        image (torch.Tensor): A (3, H, W) sample input traced through the model
+        output_dir (str): Directory the artifacts are written to
+        formats (list): Artifact formats, "torchscript" and/or "onnx"
+        opset (int, optional): ONNX opset version. Defaults to 16.
+
+    Returns:
+        dict: The paths of the artifacts, keyed by format
+    """
+
+    def inference(model, inputs):
+        # do_postprocess=False returns the ROI masks, not full-image masks.
+        instances = model.inference(inputs, do_postprocess=False)[0]
+        return [{"instances": instances}]
+
+    adapter = TracingAdapter(model, [{"image": image}], inference)
+    artifacts = {}
+    with torch.no_grad():
+        if "torchscript" in formats:
+            path = os.path.join(output_dir, "model.ts")
+            torch.jit.save(torch.jit.trace(adapter, (image,)), path)
+            artifacts["torchscript"] = path
+        if "onnx" in formats:
+            path = os.path.join(output_dir, "model.onnx")
+            torch.onnx.export(
+                adapter,
+                (image,),
+                path,
+                opset_version=opset,
+                input_names=["image"],
+                output_names=TRACING_OUTPUT_NAMES,
+                dynamic_axes={"image": {1: "height", 2: "width"}},
+            )
+            artifacts["onnx"] = path
+
+    return artifacts
+
+
+class _ScriptableAdapter(torch.nn.Module):
+    """Wraps a Mask R-CNN for scripting, returning its raw outputs as the
+    dicts read by scripts/benchmark.cpp."""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+        self.eval()
+
+    def forward(
+        self, inputs: Tuple[Dict[str, torch.Tensor]]
+    ) -> List[Dict[str, torch.Tensor]]:
+        instances = self.model.inference(inputs, do_postprocess=False)
+        outputs = []
+        for result in instances:
+            outputs.append(
+                {
+                    "pred_boxes": result.pred_boxes.tensor,
+                    "pred_classes": result.pred_classes,
+                    "pred_masks": result.pred_masks,
+                    "scores": result.scores,
+                }
+            )
+
+        return outputs
+
+
+def export_scripting(model, output_dir: str) -> dict:
+    """Exports a Mask R-CNN to TorchScript by scripting.
+
+    The scripted model takes a tuple of {"image": (3, H, W) float tensor}
+    dicts and returns one dict of boxes, classes, ROI masks and scores per
+    image.
+
+    Args:
+        model: Detectron2 model in eval mode
+        output_dir (str): Directory the artifact is written to
+
+    Returns:
+        dict: The path of the artifact, keyed by format
+    """
+    fields = {
+        "proposal_boxes": Boxes,
+        "objectness_logits": torch.Tensor,
+        "pred_boxes": Boxes,
+        "scores": torch.Tensor,
+        "pred_classes": torch.Tensor,
+        "pred_masks": torch.Tensor,
+    }
+    path = os.path.join(output_dir, "model.ts")
+    scripted = scripting_with_instances(_ScriptableAdapter(model), fields)
+    torch.jit.save(scripted, path)
+
+    return {"torchscript": path}
+
+
+def box_iou(boxes1, boxes2):
+    """Returns the pairwise IoU of two sets of boxes.
+
+    Args:
+        boxes1 (np.ndarray): A (N, 4) array of XYXY boxes
+        boxes2 (np.ndarray): A (M, 4) array of XYXY boxes
+
+    Returns:
+        np.ndarray: A (N, M) array of IoU
+    """
+    boxes1 = np.asarray(boxes1, dtype=np.float64).reshape(-1, 4)
+    boxes2 = np.asarray(boxes2, dtype=np.float64).reshape(-1, 4)
+    top_left = np.maximum(boxes1[:, None, :2], boxes2[None, :, :2])
+    bottom_right = np.minimum(boxes1[:, None, 2:], boxes2[None, :, 2:])
+    intersection = np.prod(np.clip(bottom_right - top_left, 0, None), axis=2)
+    area1 = np.prod(boxes1[:, 2:] - boxes1[:, :2], axis=1)
+    area2 = np.prod(boxes2[:, 2:] - boxes2[:, :2], axis=1)
+    union = area1[:, None] + area2[None, :] - intersection
+
+    return np.divide(
+        intersection, union, out=np.zeros_like(intersection), where=union > 0
+    )
+
+
+def match_instances(
+    boxes1, classes1, boxes2, classes2, iou_threshold: float = 0.5
+) -> list:
+    """Matches two sets of instances one to one, greedily by box IoU.
+
+    Instances are only matched within the same class, and if their box IoU
+    reaches iou_threshold.
+
+    Args:
+        boxes1 (np.ndarray): A (N, 4) array of XYXY boxes
+        classes1 (np.ndarray): A (N,) array of classes
+        boxes2 (np.ndarray): A (M, 4) array of XYXY boxes
+        classes2 (np.ndarray): A (M,) array of classes
+        iou_threshold (float, optional): Minimum box IoU of a match. Defaults to 0.5.
+
+    Returns:
+        list: (i, j, iou) tuples of the matched instances, by decreasing IoU
+    """
+    iou = box_iou(boxes1, boxes2)
+    iou[np.asarray(classes1)[:, None] != np.asarray(classes2)[None, :]] = 0.0
+    matches = []
+    used1, used2 = set(), set()
+    for flat in np.argsort(-iou, axis=None, kind="stable"):
+        i, j = np.unravel_index(flat, iou.shape)
+        if iou[i, j] < iou_threshold:
+            break
+        if i in used1 or j in used2:
+            continue
+        used1.add(i)
+        used2.add(j)
+        matches.append((int(i), int(j), float(iou[i, j])))
+
+    return matches
+
+
+def compare_instances(reference, instances, iou_threshold: float = 0.5) -> dict:
+    """Compares the instances predicted by an exported model to the
+    reference predictions of the eager model, on one image.
+
+    Args:
+        reference (Instances): Reference instances, with full-image pred_masks
+        instances (Instances): Instances to compare, with full-image pred_masks
+        iou_threshold (float, optional): Minimum box IoU of a match. Defaults to 0.5.
+
+    Returns:
+        dict: The number of "reference" and "predicted" instances, the number "matched", and the lists of "box_iou" and "mask_iou" of the matched pairs
+    """
+    reference = reference.to("cpu")
+    instances = instances.to("cpu")
+    matches = match_instances(
+        reference.pred_boxes.tensor.numpy(),
+        reference.pred_classes.numpy(),
+        instances.pred_boxes.tensor.numpy(),
+        instances.pred_classes.numpy(),
+        iou_threshold=iou_threshold,
+    )
+    reference_masks = reference.pred_masks.numpy()
+    masks = instances.pred_masks.numpy()
+    mask_iou = []
+    for i, j, _ in matches:
+        union = np.logical_or(reference_masks[i], masks[j]).sum()
+        intersection = np.logical_and(reference_masks[i], masks[j]).sum()
+        mask_iou.append(float(intersection / union) if union > 0 else 1.0)
+
+    return {
+        "reference": len(reference),
+        "predicted": len(instances),
+        "matched": len(matches),
+        "box_iou": [iou for _, _, iou in matches],
+        "mask_iou": mask_iou,
+    }
+
+
+def timed_predictions(predictor, images: list, warmup: int = 1):
+    """Predicts each image, after warmup calls, and times each prediction.
+
+    Args:
+        predictor: A predictor with the call contract of DefaultPredictor
+        images (list): Images of shape (H, W, C) (in BGR order)
+        warmup (int, optional): Number of images predicted before timing. Defaults to 1.
+
+    Returns:
+        instances (list): The predicted instances of each image
+        latencies (list): The latency (seconds) of each prediction
+    """
+    for image in images[:warmup]:
+        predictor(image)
+    instances, latencies = [], []
+    for image in images:
+        start = time.perf_counter()
+        output = predictor(image)
+        latencies.append(time.perf_counter() - start)
+        instances.append(output["instances"])
+
+    return instances, latencies
+
+
+def latency_stats(latencies: list) -> dict:
+    """Returns the median and mean of latencies (seconds), in ms.
+
+    Args:
+        latencies (list): The latencies, in seconds
+
+    Returns:
+        dict: The "latency_median_ms" and "latency_mean_ms"
+    """
+    latencies_ms = 1000 * np.asarray(latencies)
+
+    return {
+        "latency_median_ms": float(np.median(latencies_ms)),
+        "latency_mean_ms": float(np.mean(latencies_ms)),
+    }
+
+
+def agreement(reference: list, predictions: list, iou_threshold: float = 0.5) -> dict:
+    """Summarizes the agreement of predictions with reference predictions
+    over several images.
+
+    Args:
+        reference (list): Reference instances of each image, with full-image pred_masks
+        predictions (list): Instances to compare of each image, with full-image pred_masks
+        iou_threshold (float, optional): Minimum box IoU of matched instances. Defaults to 0.5.
+
+    Returns:
+        dict: The number of predicted "instances", the number "matched", the "matched_fraction" of instances (over the larger of both counts), and the mean "box_iou" and "mask_iou" of the matched instances
+    """
+    stats = [
+        compare_instances(r, p, iou_threshold) for r, p in zip(reference, predictions)
+    ]
+    counts = {
+        key: sum(s[key] for s in stats) for key in ("reference", "predicted", "matched")
+    }
+    box_ious = [iou for s in stats for iou in s["box_iou"]]
+    mask_ious = [iou for s in stats for iou in s["mask_iou"]]
+    total = max(counts["reference"], counts["predicted"])
+
+    return {
+        "instances": counts["predicted"],
+        "matched": counts["matched"],
+        # Two empty predictions agree perfectly.
+        "matched_fraction": counts["matched"] / total if total else 1.0,
+        "box_iou": float(np.mean(box_ious)) if box_ious else float(total == 0),
+        "mask_iou": float(np.mean(mask_ious)) if mask_ious else float(total == 0),
+    }
+
+
+def parity_check(
+    cfg,
+    artifacts: dict,
+    images: list,
+    export_method: str = "tracing",
+    iou_threshold: float = 0.5,
+    warmup: int = 1,
+) -> dict:
+    """Compares exported models to the eager DefaultPredictor on sample images.
+
+    Args:
+        cfg: Detectron2 config of the eager model
+        artifacts (dict): The paths of the exported models, keyed by format
+        images (list): Sample images of shape (H, W, C) (in BGR order)
+        export_method (str, optional): "tracing" or "scripting". Defaults to "tracing".
+        iou_threshold (float, optional): Minimum box IoU of matched instances. Defaults to 0.5.
+        warmup (int, optional): Number of images predicted before timing each backend. Defaults to 1.
+
+    Returns:
+        dict: Per backend ("eager" and each format), the median and mean latency in ms and, for exported models, their agreement with the eager model (see agreement)
+    """
+    reference, latencies = timed_predictions(DefaultPredictor(cfg), images, warmup)
+    report = {"eager": latency_stats(latencies)}
+    report["eager"]["instances"] = int(sum(len(r) for r in reference))
+
+    for backend, path in artifacts.items():
+        if backend == "onnx":
+            predictor = OnnxPredictor(cfg, model_path=path)
+        else:
+            predictor = TorchScriptPredictor.from_config(
+                cfg, model_path=path, export_method=export_method
+            )
+        predictions, latencies = timed_predictions(predictor, images, warmup)
+        report[backend] = {
+            **latency_stats(latencies),
+            **agreement(reference, predictions, iou_threshold),
+        }
+
+    return report
+
+
+def export_model(
+    cfg,
+    output_dir: str,
+    sample_image,
+    formats: list = ("torchscript", "onnx"),
+    export_method: str = "tracing",
+    opset: int = 16,
+) -> dict:
+    """Exports a Mask R-CNN to TorchScript and/or ONNX.
+
+    Next to the artifacts, the config is written to config.yaml, and the
+    export parameters to export.json with the digest of the weights and the
+    library versions, so the export can be reproduced.
+
+    Args:
+        cfg: Detectron2 config, with MODEL.WEIGHTS set. The model is exported on the CPU.
+        output_dir (str): Directory the artifacts are written to. Created if it does not exist.
+        sample_image (np.ndarray): A sample image of shape (H, W, C) (in BGR order), traced through the model
+        formats (list, optional): Artifact formats, "torchscript" and/or "onnx". Defaults to ("torchscript", "onnx").
+        export_method (str, optional): "tracing" or "scripting". Scripting only exports TorchScript. Defaults to "tracing".
+        opset (int, optional): ONNX opset version. Defaults to 16.
+
+    Returns:
+        dict: The paths of the artifacts, keyed by format
+    """
+    for export_format in formats:
+        assert (
+            export_method in EXPORT_FORMATS[export_format]
+        ), f"{export_format} can only be exported with {EXPORT_FORMATS[export_format]}."
+    cfg = cfg.clone()
+    cfg.defrost()
+    cfg.MODEL.DEVICE = "cpu"
+    os.makedirs(output_dir, exist_ok=True)
+
+    model = load_model(cfg)
+    if export_method == "scripting":
+        artifacts = export_scripting(model, output_dir)
+    else:
+        image = sample_input(cfg, sample_image)["image"]
+        artifacts = export_tracing(model, image, output_dir, formats, opset=opset)
+
+    with open(os.path.join(output_dir, "config.yaml"), "w") as f:
+        f.write(cfg.dump())
+    with open(os.path.join(output_dir, "export.json"), "w") as f:
+        json.dump(
+            {
+                "weights": cfg.MODEL.WEIGHTS,
+                "weights_sha256": file_digest(cfg.MODEL.WEIGHTS),
+                "export_method": export_method,
+                "formats": sorted(artifacts),
+                "opset": opset,
+                "sample_shape": list(sample_image.shape),
+                "torch": torch.__version__,
+            },
+            f,
+            indent=2,
+        )
+
+    return artifacts
@@ -0,0 +1,483 @@
+# -*- coding: utf-8 -*-
+import contextlib
+import heapq
+import itertools
+import os
+import threading
+import time
+import tracemalloc
+
+MEMORY_ENV = "AERIALSEG_PROFILE_MEMORY"
+
+# The active memory tracker, or None when memory tracking is off.
+_tracker = None
+
+
+def _read_rss(pid: int) -> int:
+    """Returns the resident set size (bytes) of a process, or 0 if it is gone."""
+    try:
+        with open(f"/proc/{pid}/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, IndexError, ValueError):
+        return 0
+
+
+def _descendants(pid: int) -> list:
+    """Returns the pids of the descendants of a process, from /proc."""
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat", "r") as f:
+                # The command name may hold spaces; fields resume after it.
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+
+    descendants = []
+    stack = [pid]
+    while stack:
+        for child in children.get(stack.pop(), []):
+            descendants.append(child)
+            stack.append(child)
+
+    return descendants
+
+
+def process_tree_rss(pid: int = None) -> int:
+    """Returns the resident set size (bytes) of a process and its
+    descendants, e.g. polygonizer or replica worker processes.
+
+    Pages shared between the processes are counted once per process, so
+    this overestimates the memory used by forked workers. Linux only.
+
+    Args:
+        pid (int, optional): The process. Defaults to the current process.
+
+    Returns:
+        int: The summed RSS in bytes
+    """
+    pid = os.getpid() if pid is None else pid
+
+    return sum(_read_rss(p) for p in [pid] + _descendants(pid))
+
+
+class RssSampler:
+    """Samples the RSS of the current process tree in a background thread,
+    keeping the peak.
+
+    Use as a context manager around the code to measure.
+
+    Args:
+        interval (float, optional): Time (seconds) between samples. Defaults to 0.1.
+
+    Attributes:
+        peak (int): The peak RSS (bytes) of the process tree, see process_tree_rss.
+    """
+
+    def __init__(self, interval: float = 0.1):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self.peak = process_tree_rss()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, process_tree_rss())
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, process_tree_rss())
+
+
+def _status_kb(field: str) -> int:
+    """Returns a field of /proc/self/status in kB, or None if unavailable."""
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1])
+    except (OSError, IndexError, ValueError):
+        pass
+
+    return None
+
+
+def reset_rss_high_water_mark() -> bool:
+    """Resets the peak RSS of the current process to its current RSS, so the
+    peak of a stage can be read with rss_high_water_mark. Linux only.
+
+    Returns:
+        bool: True if the peak was reset
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        return False
+
+    return True
+
+
+def rss_high_water_mark() -> int:
+    """Returns the peak RSS (bytes) of the current process since it started
+    or since reset_rss_high_water_mark, or its current RSS if the peak is
+    unavailable."""
+    peak = _status_kb("VmHWM")
+    if peak is None:
+        return _read_rss(os.getpid())
+
+    return peak * 1024
+
+
+class MemoryTracker:
+    """Records the peak RSS and the peak of Python allocations (traced by
+    tracemalloc, which includes numpy arrays but not torch tensors) of
+    each stage and each tile of a run.
+
+    Stages and tiles can be nested: the peaks of a stage are carried into
+    the stages and tile enclosing it. Peaks are those of the whole process
+    while the stage was open, so allocations of other threads (e.g. decoding
+    threads) count towards them. Only the thread that created the tracker
+    is tracked.
+
+    Args:
+        top_k (int, optional): Number of tiles with the highest peak RSS kept for the summary. Defaults to 10.
+        max_tiles (int, optional): Maximum number of tile records kept in memory; later tiles only count towards the top tiles. Defaults to 100000.
+        trace_python (bool, optional): If true, tracemalloc is started (if it is not already) to trace Python allocations. It slows allocations down. Defaults to True.
+    """
+
+    def __init__(self, top_k: int = 10, max_tiles: int = 100_000, trace_python=True):
+        self.top_k = top_k
+        self.max_tiles = max_tiles
+        self.stages = {}
+        self.tiles = []
+        self.num_tiles = 0
+        self.dropped = 0
+        self._top = []
+        self._order = itertools.count()
+        self._stack = []
+        self._thread = threading.get_ident()
+        self._started_tracemalloc = trace_python and not tracemalloc.is_tracing()
+        if self._started_tracemalloc:
+            tracemalloc.start()
+        self.high_water_mark_reset = reset_rss_high_water_mark()
+
+    def _reset_peaks(self):
+        if self.high_water_mark_reset:
+            reset_rss_high_water_mark()
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+
+    def _update_peaks(self, frame: dict):
+        frame["rss"] = max(frame["rss"], rss_high_water_mark())
+        if tracemalloc.is_tracing():
+            frame["traced"] = max(frame["traced"], tracemalloc.get_traced_memory()[1])
+
+    def _enter(self) -> dict:
+        # The peaks so far belong to the enclosing frame, before they are reset.
+        if self._stack:
+            self._update_peaks(self._stack[-1])
+        self._reset_peaks()
+        frame = {
+            "start": time.perf_counter_ns(),
+            "start_rss": _read_rss(os.getpid()),
+            "rss": 0,
+            "traced": 0,
+        }
+        self._stack.append(frame)
+
+        return frame
+
+    def _exit(self) -> dict:
+        frame = self._stack.pop()
+        self._update_peaks(frame)
+        if self._stack:
+            parent = self._stack[-1]
+            parent["rss"] = max(parent["rss"], frame["rss"])
+            parent["traced"] = max(parent["traced"], frame["traced"])
+
+        return frame
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        """Tracks the peaks of a named stage.
+
+        Args:
+            name (str): Name of the stage, e.g. "predict"
+        """
+        if threading.get_ident() != self._thread:
+            yield
+            return
+
+        self._enter()
+        try:
+            yield
+        finally:
+            frame = self._exit()
+            stats = self.stages.setdefault(
+                name, {"calls": 0, "peak_rss": 0, "peak_traced": 0, "max_growth": 0}
+            )
+            stats["calls"] += 1
+            stats["peak_rss"] = max(stats["peak_rss"], frame["rss"])
+            stats["peak_traced"] = max(stats["peak_traced"], frame["traced"])
+            stats["max_growth"] = max(
+                stats["max_growth"], frame["rss"] - frame["start_rss"]
+            )
+
+    @contextlib.contextmanager
+    def tile(self, tiles: list):
+        """Tracks the peaks of a tile, or of a batch of tiles predicted
+        together.
+
+        Yields a record dict, where the caller can set the "instances" of
+        each tile.
+
+        Args:
+            tiles (list): Names of the tiles
+        """
+        if threading.get_ident() != self._thread:
+            yield {}
+            return
+
+        record = {"tiles": list(tiles), "instances": None, "pid": os.getpid()}
+        self._enter()
+        try:
+            yield record
+        finally:
+            frame = self._exit()
+            record.update(
+                start_ns=frame["start"],
+                start_rss=frame["start_rss"],
+                peak_rss=frame["rss"],
+                peak_traced=frame["traced"],
+            )
+            self._add_tile(record)
+
+    def _add_tile(self, record: dict):
+        self.num_tiles += 1
+        if len(self.tiles) < self.max_tiles:
+            self.tiles.append(record)
+        else:
+            self.dropped += 1
+        self._push_top(record)
+
+    def _push_top(self, record: dict):
+        # A min-heap of the top_k records by peak RSS; the counter breaks ties.
+        entry = (record["peak_rss"], record["peak_traced"], next(self._order), record)
+        if len(self._top) < self.top_k:
+            heapq.heappush(self._top, entry)
+        elif self.top_k > 0:
+            heapq.heappushpop(self._top, entry)
+
+    def drain(self) -> dict:
+        """Returns the recorded stages and tiles as a picklable dict, and
+        clears them, e.g. to send them from a worker process to merge.
+
+        Returns:
+            dict: The recorded state
+        """
+        state = {
+            "stages": self.stages,
+            "tiles": self.tiles,
+            "num_tiles": self.num_tiles,
+            "dropped": self.dropped,
+            "top": [entry[3] for entry in self._top],
+        }
+        self.stages = {}
+        self.tiles = []
+        self.num_tiles = 0
+        self.dropped = 0
+        self._top = []
+
+        return state
+
+    def merge(self, state: dict):
+        """Adds stages and tiles drained from another tracker, e.g. of a
+        worker process.
+
+        Args:
+            state (dict): The state returned by drain
+        """
+        for name, other in state["stages"].items():
+            stats = self.stages.setdefault(name, dict.fromkeys(other, 0))
+            stats["calls"] += other["calls"]
+            for key in ("peak_rss", "peak_traced", "max_growth"):
+                stats[key] = max(stats[key], other[key])
+        room = max(self.max_tiles - len(self.tiles), 0)
+        self.tiles.extend(state["tiles"][:room])
+        self.dropped += state["dropped"] + max(len(state["tiles"]) - room, 0)
+        self.num_tiles += state["num_tiles"]
+        for record in state["top"]:
+            self._push_top(record)
+
+    def summary(self) -> dict:
+        """Returns the peaks of each stage, the top tiles and every tile
+        record, in MB.
+
+        Returns:
+            dict: The "stages", with the number of "calls", "peak_rss_mb", "peak_traced_mb" and "max_growth_mb" (peak RSS over the RSS at the start of the stage) of each, the number of "tiles", the "top_tiles" by peak RSS, and the "tile_records" kept
+        """
+
+        def tile_summary(record):
+            return {
+                "tiles": record["tiles"],
+                "instances": record["instances"],
+                "pid": record["pid"],
+                "start_rss_mb": record["start_rss"] / 2**20,
+                "peak_rss_mb": record["peak_rss"] / 2**20,
+                "peak_traced_mb": record["peak_traced"] / 2**20,
+            }
+
+        stages = {
+            name: {
+                "calls": stats["calls"],
+                "peak_rss_mb": stats["peak_rss"] / 2**20,
+                "peak_traced_mb": stats["peak_traced"] / 2**20,
+                "max_growth_mb": stats["max_growth"] / 2**20,
+            }
+            for name, stats in self.stages.items()
+        }
+
+        return {
+            "stages": stages,
+            "tiles": self.num_tiles,
+            "top_tiles": [
+                tile_summary(entry[3]) for entry in sorted(self._top, reverse=True)
+            ],
+            "tile_records": [tile_summary(record) for record in self.tiles],
+            "dropped_tile_records": self.dropped,
+            "high_water_mark_reset": self.high_water_mark_reset,
+            "traced_python": tracemalloc.is_tracing(),
+        }
+
+    def trace_events(self) -> list:
+        """Returns the peaks of each tile as Chrome trace counter events."""
+        return [
+            {
+                "name": "memory",
+                "ph": "C",
+                "ts": record["start_ns"] / 1e3,
+                "pid": record["pid"],
+                "args": {
+                    "peak_rss_mb": record["peak_rss"] / 2**20,
+                    "peak_traced_mb": record["peak_traced"] / 2**20,
+                },
+            }
+            for record in self.tiles
+        ]
+
+    def format_summary(self) -> str:
+        """Returns the peaks of each stage and the top tiles as a table."""
+        summary = self.summary()
+        lines = [
+            f"{'Stage':<32}{'Calls':>9}{'RSS MB':>10}{'Traced MB':>11}"
+            f"{'Growth MB':>11}"
+        ]
+        for name, stats in sorted(
+            summary["stages"].items(), key=lambda item: -item[1]["peak_rss_mb"]
+        ):
+            lines.append(
+                f"{name:<32}{stats['calls']:>9}{stats['peak_rss_mb']:>10.0f}"
+                f"{stats['peak_traced_mb']:>11.0f}{stats['max_growth_mb']:>11.0f}"
+            )
+        if summary["top_tiles"]:
+            lines.append(f"Top {len(summary['top_tiles'])} tiles by peak RSS:")
+            for record in summary["top_tiles"]:
+                lines.append(
+                    f"  {', '.join(map(str, record['tiles']))}: "
+                    f"{record['peak_rss_mb']:.0f} MB RSS, "
+                    f"{record['peak_traced_mb']:.0f} MB traced, "
+                    f"{record['instances']} instances"
+                )
+
+        return "\n".join(lines)
+
+    def close(self):
+        """Stops tracemalloc if the tracker started it."""
+        if self._started_tracemalloc and tracemalloc.is_tracing():
+            tracemalloc.stop()
+        self._started_tracemalloc = False
+
+
+def enable(top_k: int = 10) -> MemoryTracker:
+    """Switches memory tracking on, keeping the active tracker if there is
+    one.
+
+    Args:
+        top_k (int, optional): Number of top tiles kept, for a new tracker. Defaults to 10.
+
+    Returns:
+        MemoryTracker: The active tracker
+    """
+    global _tracker
+    if _tracker is None:
+        _tracker = MemoryTracker(top_k=top_k)
+
+    return _tracker
+
+
+def disable():
+    """Switches memory tracking off, discarding what was recorded."""
+    global _tracker
+    if _tracker is not None:
+        _tracker.close()
+    _tracker = None
+
+
+def enabled() -> bool:
+    """Returns true if memory tracking is on."""
+    return _tracker is not None
+
+
+def get_tracker():
+    """Returns the active MemoryTracker, or None if memory tracking is off."""
+    return _tracker
+
+
+_NULL_STAGE = contextlib.nullcontext()
+
+
+def stage(name: str):
+    """Returns a context manager tracking the memory peaks of a named stage.
+
+    Args:
+        name (str): Name of the stage, e.g. "predict"
+
+    Returns:
+        A context manager, which does nothing if memory tracking is off
+    """
+    if _tracker is None:
+        return _NULL_STAGE
+
+    return _tracker.stage(name)
+
+
+def tile(tiles: list):
+    """Returns a context manager tracking the memory peaks of a tile, or of
+    a batch of tiles.
+
+    Args:
+        tiles (list): Names of the tiles
+
+    Returns:
+        A context manager yielding the tile record, to set the "instances" of each tile in, or None if memory tracking is off
+    """
+    if _tracker is None:
+        return _NULL_STAGE
+
+    return _tracker.tile(tiles)
+
+
+if os.environ.get(MEMORY_ENV, "") not in ("", "0"):
+    enable()
@@ -0,0 +1,310 @@
+# -*- coding: utf-8 -*-
+import itertools
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory
+
+import cv2
+import numpy as np
+
+from aerialseg import profiling
+
+
+def batched(iterable, batch_size: int):
+    """Groups the items of an iterable into lists of batch_size items.
+
+    Args:
+        iterable: Any iterable
+        batch_size (int): Number of items per batch. The last batch may be shorter.
+
+    Yields:
+        list: A batch of items
+    """
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+class Prefetcher:
+    """Loads (decodes) tiles on a thread pool ahead of the consumer.
+
+    Iterating over the prefetcher yields (item, image) pairs in the order of
+    the input items, while up to `depth` of the following tiles are already
+    being decoded in the background. cv2 releases the GIL while decoding,
+    so decoding overlaps with the model forward pass of the consumer.
+
+    Args:
+        items (iterable): Items to load, usually image paths
+        load_fn (callable, optional): Function loading a single item. Defaults to cv2.imread.
+        depth (int, optional): Maximum number of tiles decoded ahead of the consumer. If 0, tiles are decoded synchronously on the calling thread. Defaults to 4.
+        num_workers (int, optional): Number of decoding threads. Defaults to 2.
+
+    Attributes:
+        decode_time (float): Total time (seconds) spent decoding tiles, summed over workers.
+        wait_time (float): Total time (seconds) the consumer was blocked waiting for a decoded tile.
+    """
+
+    def __init__(
+        self, items, load_fn=cv2.imread, depth: int = 4, num_workers: int = 2
+    ):
+        assert depth >= 0, "depth must be greater than or equal to 0."
+        assert num_workers >= 1, "num_workers must be at least 1."
+        self.items = items
+        self.load_fn = load_fn
+        self.depth = depth
+        self.num_workers = num_workers
+        self.decode_time = 0.0
+        self.wait_time = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def hidden_time(self) -> float:
+        """Decoding time (seconds) that was overlapped with the consumer's
+        work."""
+        return max(self.decode_time - self.wait_time, 0.0)
+
+    def _load(self, item):
+        start = time.perf_counter()
+        with profiling.span("decode"):
+            image = self.load_fn(item)
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self.decode_time += elapsed
+
+        return image
+
+    def __iter__(self):
+        if self.depth == 0:
+            for item in self.items:
+                start = time.perf_counter()
+                image = self._load(item)
+                self.wait_time += time.perf_counter() - start
+                yield item, image
+            return
+
+        items = iter(self.items)
+        with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            pending = deque(
+                (item, executor.submit(self._load, item))
+                for item in itertools.islice(items, self.depth)
+            )
+            while pending:
+                item, future = pending.popleft()
+                start = time.perf_counter()
+                image = future.result()
+                self.wait_time += time.perf_counter() - start
+
+                # Keep the queue full before handing the tile to the consumer.
+                for next_item in itertools.islice(items, 1):
+                    pending.append(
+                        (next_item, executor.submit(self._load, next_item))
+                    )
+
+                yield item, image
+
+
+def _polygonize_shared(
+    shm_name,
+    shape,
+    dtype,
+    bbox,
+    labels,
+    image_id,
+    scores=None,
+    simplify_tolerance: float = 0.0,
+    minimum_rotated_rectangle: bool = False,
+    roi_masks: bool = False,
+    mask_resolution: int = 0,
+):
+    """Polygonizes instance masks stored in a shared memory block.
+
+    Runs in a PolygonizerPool worker process. If shm_name is None, the masks
+    are empty and no shared memory is attached.
+    """
+    # Imported here, as aerialseg.utils depends on this module.
+    from aerialseg.utils import extract_mask_annotation_store
+
+    if shm_name is None:
+        return extract_mask_annotation_store(
+            np.zeros(shape, dtype=dtype),
+            bbox,
+            labels,
+            image_id,
+            scores=scores,
+            simplify_tolerance=simplify_tolerance,
+            minimum_rotated_rectangle=minimum_rotated_rectangle,
+            roi_masks=roi_masks,
+            mask_resolution=mask_resolution,
+        )
+
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        mask_array = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        annotations = extract_mask_annotation_store(
+            mask_array,
+            bbox,
+            labels,
+            image_id,
+            scores=scores,
+            simplify_tolerance=simplify_tolerance,
+            minimum_rotated_rectangle=minimum_rotated_rectangle,
+            roi_masks=roi_masks,
+            mask_resolution=mask_resolution,
+        )
+        # Views of the buffer must be released before closing it.
+        del mask_array
+    finally:
+        shm.close()
+
+    return annotations
+
+
+class PolygonizerPool:
+    """Polygonizes prediction masks in a pool of worker processes.
+
+    The (N, H, W) bool masks (or ROI mask probabilities) of each prediction
+    are copied once into a shared memory block, so they are not pickled to
+    the workers. Results are collected in submission order, so the calling
+    loop can keep feeding the model while earlier tiles are polygonized.
+
+    Args:
+        num_workers (int, optional): Number of worker processes. Defaults to 2.
+        max_pending (int, optional): Maximum number of tiles in flight before collect() blocks. Bounds the memory held by shared mask blocks. Defaults to 2 * num_workers.
+        simplify_tolerance (float, optional): Tolerance for simplifying polygons. Accepts values between 0.0 and 1.0. Defaults to 0.0.
+        minimum_rotated_rectangle (bool, optional): If true, will return the minimum rotated rectangle of the polygon. Defaults to False.
+        mask_resolution (int, optional): Size ROI masks are resized to before tracing, for outputs predicted without pasting masks. If 0, they are resized to the box size in pixels. Defaults to 0.
+    """
+
+    def __init__(
+        self,
+        num_workers: int = 2,
+        max_pending: int = None,
+        simplify_tolerance: float = 0.0,
+        minimum_rotated_rectangle: bool = False,
+        mask_resolution: int = 0,
+    ):
+        assert num_workers >= 1, "num_workers must be at least 1."
+        self.num_workers = num_workers
+        self.max_pending = max_pending if max_pending is not None else 2 * num_workers
+        self.simplify_tolerance = simplify_tolerance
+        self.minimum_rotated_rectangle = minimum_rotated_rectangle
+        self.mask_resolution = mask_resolution
+        # Spans of the workers are not collected, so they do not record any.
+        self._executor = ProcessPoolExecutor(
+            max_workers=num_workers, initializer=profiling.disable
+        )
+        self._pending = deque()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def submit(self, output, image_id):
+        """Queues a Detectron2 prediction output for polygonization.
+
+        Args:
+            output: Detectron2 prediction output
+            image_id (int): an id for the image tile. Usually a unique int
+        """
+        # Imported here, as aerialseg.utils depends on this module.
+        from aerialseg.utils import output_to_arrays
+
+        self.submit_arrays(output_to_arrays(output), image_id)
+
+    def submit_arrays(self, arrays: tuple, image_id):
+        """Queues the prediction arrays of a tile for polygonization.
+
+        Args:
+            arrays (tuple): The (mask_array, bbox, labels, roi_masks, scores) of the tile, as returned by aerialseg.utils.output_to_arrays
+            image_id (int): an id for the image tile. Usually a unique int
+        """
+        mask_array, bbox, labels, roi_masks, scores = arrays
+        kwargs = {
+            "scores": scores,
+            "simplify_tolerance": self.simplify_tolerance,
+            "minimum_rotated_rectangle": self.minimum_rotated_rectangle,
+            "roi_masks": roi_masks,
+            "mask_resolution": self.mask_resolution,
+        }
+
+        if mask_array.size == 0:
+            # Nothing to share; polygonize the empty prediction in place.
+            future = Future()
+            future.set_result(
+                _polygonize_shared(
+                    None,
+                    mask_array.shape,
+                    mask_array.dtype,
+                    bbox,
+                    labels,
+                    image_id,
+                    **kwargs,
+                )
+            )
+            self._pending.append((future, None))
+            return
+
+        shm = shared_memory.SharedMemory(create=True, size=mask_array.nbytes)
+        shared_masks = np.ndarray(
+            mask_array.shape, dtype=mask_array.dtype, buffer=shm.buf
+        )
+        shared_masks[:] = mask_array
+        del shared_masks
+        future = self._executor.submit(
+            _polygonize_shared,
+            shm.name,
+            mask_array.shape,
+            mask_array.dtype,
+            bbox,
+            labels,
+            image_id,
+            **kwargs,
+        )
+        self._pending.append((future, shm))
+
+    def _pop(self):
+        future, shm = self._pending.popleft()
+        try:
+            return future.result()
+        finally:
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+
+    def collect(self, wait: bool = False) -> list:
+        """Returns the annotations of tiles that finished polygonization, in
+        submission order.
+
+        Blocks while more than max_pending tiles are in flight.
+
+        Args:
+            wait (bool, optional): If true, will wait for all submitted tiles. Defaults to False.
+
+        Returns:
+            list: A list of AnnotationStore annotations, one per tile
+        """
+        results = []
+        while self._pending and (
+            wait
+            or len(self._pending) > self.max_pending
+            or self._pending[0][0].done()
+        ):
+            results.append(self._pop())
+
+        return results
+
+    def close(self):
+        """Shuts down the workers and releases any shared memory left."""
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        while self._pending:
+            _, shm = self._pending.popleft()
+            if shm is not None:
+                shm.close()
+                shm.unlink()
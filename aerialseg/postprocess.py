@@ -17,10 +17,13 @@ from tqdm import tqdm
 
 import rasterio
 import rasterio.transform
+import shapely
 from shapely.geometry import Polygon
 import geopandas as gpd
 from shapely.validation import make_valid
 
+from aerialseg.annotations import AnnotationStore
+
 
 def detectron2_to_polygons(outputs, prediction_simplification=1):
 
@@ -60,36 +63,243 @@ def detectron2_to_polygons(outputs, prediction_simplification=1):
 
   return polygons
 
+def _affine_matrix(transform):
+    """Returns the 2x3 matrix of an affine transform, shifted by half a pixel
+    to map pixel indices to pixel centres (as rasterio.transform.xy
+    does)."""
+    return np.array(
+        [
+            [
+                transform.a,
+                transform.b,
+                transform.c + (transform.a + transform.b) / 2,
+            ],
+            [
+                transform.d,
+                transform.e,
+                transform.f + (transform.d + transform.e) / 2,
+            ],
+        ]
+    )
+
+
+def georeference_vertices(vertices, transforms, image_ids=None):
+    """Maps pixel vertices to geographic coordinates with a single matrix
+    multiplication.
+
+    Args:
+        vertices (np.ndarray): A (K, 2) array of [x, y] pixel vertices.
+        transforms: The affine.Affine transform of the raster, or a list of tile transforms indexed by image_ids.
+        image_ids (np.ndarray, optional): The tile of each vertex, if transforms is a list of tile transforms. Defaults to None.
+
+    Returns:
+        np.ndarray: A (K, 2) array of georeferenced vertices
+    """
+    homogeneous = np.column_stack([vertices, np.ones(len(vertices))])
+
+    if image_ids is None:
+        return homogeneous @ _affine_matrix(transforms).T
+
+    matrices = np.stack([_affine_matrix(transform) for transform in transforms])
+
+    return np.einsum("nij,nj->ni", matrices[image_ids], homogeneous)
+
+
+def georeference_polygons(polygons, transforms, image_ids=None):
+    """Converts pixel polygons into geographic polygons in a single
+    vectorized pass.
+
+    All polygon vertices are concatenated into one coordinate array, mapped
+    with the affine transform(s) as a matrix multiplication, and the
+    polygons are built at once from the ring offsets.
+
+    Args:
+        polygons (list): A list of polygons in pixel coordinates, each a list of [x, y] vertices (or flattened).
+        transforms: The affine.Affine transform of the raster, or a list of tile transforms indexed by image_ids.
+        image_ids (np.ndarray, optional): The tile of each polygon, if transforms is a list of tile transforms. Defaults to None.
+
+    Returns:
+        np.ndarray: An array of shapely Polygons
+    """
+    if len(polygons) == 0:
+        return np.empty(0, dtype=object)
+
+    coords = [
+        np.asarray(polygon, dtype=np.float64).reshape(-1, 2) for polygon in polygons
+    ]
+    counts = np.fromiter((len(c) for c in coords), dtype=np.intp, count=len(coords))
+    vertex_tiles = None
+    if image_ids is not None:
+        vertex_tiles = np.repeat(np.asarray(image_ids), counts)
+    geo_vertices = georeference_vertices(
+        np.concatenate(coords), transforms, image_ids=vertex_tiles
+    )
+
+    # Rings are closed by shapely if the last vertex is not the first one.
+    rings = shapely.linearrings(
+        geo_vertices, indices=np.repeat(np.arange(len(coords)), counts)
+    )
+
+    return shapely.polygons(rings)
+
+
 def convert_polygons_to_geospatial(polygons, tif_file):
+    """Converts pixel polygons predicted on a raster into a geodataframe.
+
+    Args:
+        polygons (list): A list of polygons in pixel coordinates of the raster, each a list of [x, y] vertices (or flattened).
+        tif_file (str): Path to the raster the polygons were predicted on.
+
+    Returns:
+        geopandas.GeoDataFrame: A geodataframe of the polygons, with the raster CRS
+    """
     with rasterio.open(tif_file) as src:
         raster_transform = src.transform
+        raster_crs = src.crs
 
-    # make polygons into an np array
-    polygons = [np.array(polygons[i]).reshape(-1, 2) for i in range(len(polygons))]
+    gdf = gpd.GeoDataFrame(
+        geometry=georeference_polygons(polygons, raster_transform), crs=raster_crs
+    )
 
-    geospatial_polygons = []  
-    for polygon_vertices in polygons:
-        # Convert polygon vertices to geospatial coordinates
-        geo_polygon = []
-        for vertex in polygon_vertices:
-            x, y = rasterio.transform.xy(raster_transform, vertex[1], vertex[0])
-            geo_polygon.append((x, y))
+    # Example saving geojson
+    # gdf.to_file("output.geojson", driver="GeoJSON")
 
-        # Ensure the right-hand rule for polygon winding order
-        if geo_polygon[0] != geo_polygon[-1]:
-            geo_polygon.append(geo_polygon[0])
+    return gdf
 
-        # Create a Shapely polygon
-        shapely_polygon = Polygon(geo_polygon)
 
-        geospatial_polygons.append(shapely_polygon)
+def _tile_ownership(geometries, image_ids, tile_windows):
+    """Finds the polygons lying in the core region of their own tile.
 
-    # Create a GeoDataFrame from the Shapely polygons
-    gdf = gpd.GeoDataFrame({'geometry': geospatial_polygons})
-    #give the gdf the raster's crs
-    gdf = geo_dataframe.set_crs(src.crs)
+    A polygon is owned by the tile whose centre is nearest to the polygon's
+    centroid, among the tiles containing the centroid. The core regions of
+    overlapping tiles therefore split the overlap strips down the middle.
+    """
+    corners = np.array(
+        [
+            [transform * (0, 0), transform * (window.width, window.height)]
+            for window, transform in tile_windows
+        ]
+    )
+    tile_boxes = shapely.box(
+        corners[:, :, 0].min(axis=1),
+        corners[:, :, 1].min(axis=1),
+        corners[:, :, 0].max(axis=1),
+        corners[:, :, 1].max(axis=1),
+    )
+    tile_centres = shapely.centroid(tile_boxes)
 
-    # Example saving geojson
-    #geo_dataframe.to_file("output.geojson", driver="GeoJSON")
-  
-    return gdf
+    centroids = shapely.centroid(geometries)
+    polygon_index, tile_index = shapely.STRtree(tile_boxes).query(
+        centroids, predicate="intersects"
+    )
+    distances = shapely.distance(centroids[polygon_index], tile_centres[tile_index])
+
+    # The nearest tile is the first one per polygon once sorted by distance.
+    order = np.lexsort((distances, polygon_index))
+    owned, first = np.unique(polygon_index[order], return_index=True)
+    keep = np.ones(len(geometries), dtype=bool)
+    keep[owned] = tile_index[order][first] == image_ids[owned]
+
+    return keep
+
+
+def _iou_suppression(geometries, image_ids, class_ids, iou_threshold: float = 0.5):
+    """Finds polygons that duplicate a larger polygon of another tile.
+
+    Polygons of the same class from different tiles with an IoU of at least
+    iou_threshold are duplicates, and only the largest of them is kept.
+    """
+    areas = shapely.area(geometries)
+    left, right = shapely.STRtree(geometries).query(
+        geometries, predicate="intersects"
+    )
+    candidates = (
+        (left < right)
+        & (image_ids[left] != image_ids[right])
+        & (class_ids[left] == class_ids[right])
+    )
+    left, right = left[candidates], right[candidates]
+
+    intersection = shapely.area(
+        shapely.intersection(geometries[left], geometries[right])
+    )
+    union = areas[left] + areas[right] - intersection
+    iou = np.divide(
+        intersection, union, out=np.zeros_like(intersection), where=union > 0
+    )
+    left, right = left[iou >= iou_threshold], right[iou >= iou_threshold]
+
+    # Rank polygons by area, largest first, and let the higher ranked polygon
+    # of each duplicate pair suppress the other one (non-maximum suppression).
+    rank = np.empty(len(geometries), dtype=int)
+    rank[np.lexsort((np.arange(len(geometries)), -areas))] = np.arange(
+        len(geometries)
+    )
+    winners = np.where(rank[left] < rank[right], left, right)
+    losers = np.where(rank[left] < rank[right], right, left)
+    order = np.argsort(rank[winners], kind="stable")
+
+    keep = np.ones(len(geometries), dtype=bool)
+    for winner, loser in zip(winners[order], losers[order]):
+        if keep[winner]:
+            keep[loser] = False
+
+    return keep
+
+
+def merge_tile_predictions(
+    annotations,
+    tile_windows: list,
+    crs=None,
+    method: str = "iou",
+    iou_threshold: float = 0.5,
+):
+    """Merges the predictions of overlapping tiles into a single
+    deduplicated vector layer.
+
+    Args:
+        annotations (Pandas.DataFrame or AnnotationStore): A dataframe of annotations with pixel_polygon, image_id and class_id columns, usually generated via aerialseg.utils.extract_all_annotations_df, or an aerialseg.annotations.AnnotationStore, whose polygons are georeferenced straight from its coordinate buffer.
+        tile_windows (list): A list of (window, transform) tuples of the tiles, indexed by image_id, as returned by aerialseg.raster.raster_windows.
+        crs (optional): The CRS of the raster. Defaults to None.
+        method (str, optional): How to resolve duplicates in the overlap strips. "iou" keeps the largest of the polygons (of the same class, from different tiles) overlapping with an IoU of at least iou_threshold. "core" keeps a polygon only if its centroid lies in the core region of its own tile. Defaults to "iou".
+        iou_threshold (float, optional): IoU above which two polygons are duplicates, for the "iou" method. Defaults to 0.5.
+
+    Returns:
+        geopandas.GeoDataFrame: A geodataframe of the merged polygons, with the raster CRS
+    """
+    assert method in ["iou", "core"], "method must be 'iou' or 'core'."
+
+    transforms = [transform for _, transform in tile_windows]
+    if isinstance(annotations, AnnotationStore):
+        geometries = annotations.to_shapely(transforms)
+        annotations = annotations.attributes()
+    else:
+        geometries = georeference_polygons(
+            annotations["pixel_polygon"].to_numpy(),
+            transforms,
+            image_ids=annotations["image_id"].to_numpy(),
+        )
+        annotations = annotations.drop(columns="pixel_polygon")
+
+    if len(annotations) == 0:
+        return gpd.GeoDataFrame(annotations, geometry=[], crs=crs)
+
+    # Contour polygons can self-touch; overlay operations need valid ones.
+    valid_geometries = shapely.make_valid(geometries)
+    image_ids = annotations["image_id"].to_numpy()
+    class_ids = annotations["class_id"].to_numpy()
+
+    if method == "core":
+        keep = _tile_ownership(valid_geometries, image_ids, tile_windows)
+    else:
+        keep = _iou_suppression(
+            valid_geometries, image_ids, class_ids, iou_threshold=iou_threshold
+        )
+
+    merged = gpd.GeoDataFrame(
+        annotations.loc[keep],
+        geometry=list(geometries[keep]),
+        crs=crs,
+    )
+
+    return merged.reset_index(drop=True)
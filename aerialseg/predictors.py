@@ -0,0 +1,369 @@
+# -*- coding: utf-8 -*-
+import math
+
+import numpy as np
+import onnxruntime as ort
+import torch
+from detectron2.data import transforms as T
+from detectron2.engine import DefaultPredictor
+from detectron2.modeling.postprocessing import detector_postprocess
+from detectron2.structures import Boxes, Instances
+
+from aerialseg.torchscript import TorchScriptPredictor
+
+# Names of the graph optimization levels of onnxruntime.
+ORT_OPTIMIZATION_LEVELS = {
+    "disable": ort.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    "basic": ort.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    "extended": ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    "all": ort.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+
+
+class BatchPredictor(DefaultPredictor):
+    """A Detectron2 DefaultPredictor that can run several images through the
+    model in a single forward pass.
+
+    Calling the predictor on a single image behaves exactly like
+    DefaultPredictor, so it can be used anywhere a DefaultPredictor is
+    expected.
+
+    Args:
+        cfg: Detectron2 config
+        paste_masks (bool, optional): If false, the low resolution ROI mask probabilities of the mask head are returned as pred_mask_probs, instead of pasting them into full-image pred_masks. aerialseg.utils.extract_output_annotations polygonizes them in box coordinates. Defaults to True.
+    """
+
+    def __init__(self, cfg, paste_masks: bool = True):
+        super().__init__(cfg)
+        self.paste_masks = paste_masks
+
+    def __call__(self, original_image):
+        if self.paste_masks:
+            return super().__call__(original_image)
+
+        return self.predict_batch([original_image])[0]
+
+    def prepare_input(self, original_image):
+        """Converts a BGR image into the input dict expected by the model.
+
+        Args:
+            original_image (np.ndarray): an image of shape (H, W, C) (in BGR order).
+
+        Returns:
+            dict: a model input with "image", "height" and "width" keys.
+        """
+        # Apply pre-processing to image, exactly as DefaultPredictor does.
+        if self.input_format == "RGB":
+            # whether the model expects BGR inputs or RGB
+            original_image = original_image[:, :, ::-1]
+        height, width = original_image.shape[:2]
+        image = self.aug.get_transform(original_image).apply_image(original_image)
+        image = torch.as_tensor(image.astype("float32").transpose(2, 0, 1))
+        image = image.to(self.cfg.MODEL.DEVICE)
+
+        return {"image": image, "height": height, "width": width}
+
+    def predict_batch(self, original_images: list):
+        """Predicts a batch of images with a single model call.
+
+        Args:
+            original_images (list): a list of images of shape (H, W, C) (in BGR order).
+
+        Returns:
+            list: a list of prediction dicts, one per image, in the same order as the inputs.
+        """
+        if len(original_images) == 0:
+            return []
+        with torch.inference_mode():
+            inputs = [self.prepare_input(image) for image in original_images]
+            if self.paste_masks:
+                return self.model(inputs)
+
+            results = self.model.inference(inputs, do_postprocess=False)
+            predictions = [
+                {
+                    "instances": roi_postprocess(
+                        result, model_input["height"], model_input["width"]
+                    )
+                }
+                for result, model_input in zip(results, inputs)
+            ]
+
+        return predictions
+
+
+def roi_postprocess(results, output_height: int, output_width: int):
+    """Rescales raw model results to the original image size, as
+    detectron2's detector_postprocess does, but without pasting the ROI
+    masks into full-image masks.
+
+    Args:
+        results (Instances): raw results of the model, in the resized input image coordinates. pred_masks holds the (N, 1, M, M) ROI mask probabilities.
+        output_height (int): height of the original image
+        output_width (int): width of the original image
+
+    Returns:
+        Instances: the results with pred_boxes, scores and pred_classes in original image coordinates, and the (N, M, M) ROI mask probabilities as pred_mask_probs.
+    """
+    scale_x = output_width / results.image_size[1]
+    scale_y = output_height / results.image_size[0]
+
+    output = Instances((output_height, output_width))
+    boxes = results.pred_boxes.clone()
+    boxes.scale(scale_x, scale_y)
+    boxes.clip(output.image_size)
+    output.pred_boxes = boxes
+    output.scores = results.scores
+    output.pred_classes = results.pred_classes
+    output.pred_mask_probs = results.pred_masks[:, 0, :, :]
+
+    return output[boxes.nonempty()]
+
+
+def exported_outputs_to_instances(
+    boxes, classes, masks, scores, image_size: tuple, score_threshold: float = 0.0
+):
+    """Wraps the flattened outputs of an exported Mask R-CNN into raw
+    Instances, as model.inference(do_postprocess=False) returns them.
+
+    Args:
+        boxes (np.ndarray): A (N, 4) array of boxes in the resized input image coordinates
+        classes (np.ndarray): A (N,) array of classes
+        masks (np.ndarray): A (N, 1, M, M) array of ROI mask probabilities
+        scores (np.ndarray): A (N,) array of scores
+        image_size (tuple): The (H, W) size of the resized input image, without padding
+        score_threshold (float, optional): Instances scoring below it are dropped. Defaults to 0.0.
+
+    Returns:
+        Instances: the raw results
+    """
+    keep = np.asarray(scores) >= score_threshold
+    results = Instances(image_size)
+    results.pred_boxes = Boxes(torch.as_tensor(np.asarray(boxes)[keep]))
+    results.scores = torch.as_tensor(np.asarray(scores)[keep])
+    results.pred_classes = torch.as_tensor(np.asarray(classes)[keep]).long()
+    results.pred_masks = torch.as_tensor(np.asarray(masks)[keep])
+
+    return results
+
+
+class ExportedPredictor:
+    """Base of the predictors running a Mask R-CNN exported by tracing, with
+    the call contract of Detectron2's DefaultPredictor.
+
+    The exported model takes a (3, H, W) float image and returns the boxes,
+    classes, ROI masks and scores of model.inference with
+    do_postprocess=False, as detectron2's export_model.py exports it.
+    Images are resized as DefaultPredictor does, and padded to a multiple of
+    size_divisibility with the pixel mean, so tiles of any size can be
+    predicted by a model exported with dynamic input sizes. Outputs are
+    rescaled to the original image, so they can be passed to
+    aerialseg.utils.extract_output_annotations. Subclasses implement run.
+
+    Args:
+        cfg: Detectron2 config of the exported model
+        paste_masks (bool, optional): If false, the ROI mask probabilities are returned as pred_mask_probs instead of full-image pred_masks, as with aerialseg.predictors.BatchPredictor. Defaults to True.
+        size_divisibility (int, optional): Input images are padded to a multiple of it. Defaults to 32.
+    """
+
+    def __init__(self, cfg, paste_masks: bool = True, size_divisibility: int = 32):
+        self.cfg = cfg.clone()
+        self.paste_masks = paste_masks
+        self.size_divisibility = size_divisibility
+        self.input_format = cfg.INPUT.FORMAT
+        self.score_threshold = cfg.MODEL.ROI_HEADS.SCORE_THRESH_TEST
+        self.aug = T.ResizeShortestEdge(
+            [cfg.INPUT.MIN_SIZE_TEST, cfg.INPUT.MIN_SIZE_TEST], cfg.INPUT.MAX_SIZE_TEST
+        )
+        self.pixel_mean = np.asarray(cfg.MODEL.PIXEL_MEAN, dtype=np.float32)
+
+    def __call__(self, original_image):
+        return self.predict_batch([original_image])[0]
+
+    def prepare_input(self, original_image):
+        """Resizes and pads a BGR image into the input of the model.
+
+        Args:
+            original_image (np.ndarray): an image of shape (H, W, C) (in BGR order).
+
+        Returns:
+            image (np.ndarray): the padded (3, H', W') float32 input
+            image_size (tuple): the (H, W) size of the resized image, without padding
+        """
+        if self.input_format == "RGB":
+            original_image = original_image[:, :, ::-1]
+        image = self.aug.get_transform(original_image).apply_image(original_image)
+        height, width = image.shape[:2]
+        divisibility = self.size_divisibility
+        padded_height = int(math.ceil(height / divisibility)) * divisibility
+        padded_width = int(math.ceil(width / divisibility)) * divisibility
+
+        # Padding with the pixel mean pads zeros once the model normalizes.
+        padded = np.empty((3, padded_height, padded_width), dtype=np.float32)
+        padded[:] = self.pixel_mean[:, None, None]
+        padded[:, :height, :width] = image.astype(np.float32).transpose(2, 0, 1)
+
+        return padded, (height, width)
+
+    def run(self, image):
+        """Runs the exported model on a prepared input.
+
+        Args:
+            image (np.ndarray): the padded (3, H', W') float32 input
+
+        Returns:
+            tuple: the boxes, classes, ROI masks and scores predicted
+        """
+        raise NotImplementedError
+
+    def predict_batch(self, original_images: list):
+        """Predicts a list of images, one model call per image.
+
+        Args:
+            original_images (list): a list of images of shape (H, W, C) (in BGR order).
+
+        Returns:
+            list: a list of prediction dicts, one per image, in the same order as the inputs.
+        """
+        predictions = []
+        for original_image in original_images:
+            image, image_size = self.prepare_input(original_image)
+            outputs = self.run(image)
+            height, width = original_image.shape[:2]
+            instances = self.postprocess_outputs(outputs, image_size, height, width)
+            predictions.append({"instances": instances})
+
+        return predictions
+
+    def postprocess_outputs(
+        self, outputs: tuple, image_size: tuple, height: int, width: int
+    ):
+        """Converts the outputs of run into instances of the original image.
+
+        Args:
+            outputs (tuple): the boxes, classes, ROI masks and scores returned by run
+            image_size (tuple): the (H, W) size of the resized image, without padding
+            height (int): height of the original image
+            width (int): width of the original image
+
+        Returns:
+            Instances: the instances, with full-image pred_masks, or pred_mask_probs if paste_masks is false
+        """
+        boxes, classes, masks, scores = outputs
+        results = exported_outputs_to_instances(
+            boxes,
+            classes,
+            masks,
+            scores,
+            image_size,
+            score_threshold=self.score_threshold,
+        )
+        if self.paste_masks:
+            return detector_postprocess(results, height, width)
+
+        return roi_postprocess(results, height, width)
+
+
+class OnnxPredictor(ExportedPredictor):
+    """Runs a Mask R-CNN exported to ONNX on onnxruntime, with the call
+    contract of Detectron2's DefaultPredictor. See ExportedPredictor.
+
+    Args:
+        cfg: Detectron2 config of the exported model. Its MODEL.WEIGHTS is the ONNX model path unless model_path is given.
+        model_path (str, optional): Path to the ONNX model. Defaults to None.
+        paste_masks (bool, optional): If false, the ROI mask probabilities are returned as pred_mask_probs instead of full-image pred_masks, as with aerialseg.predictors.BatchPredictor. Defaults to True.
+        intra_op_num_threads (int, optional): Number of threads used within an operator. 0 lets onnxruntime decide. Defaults to 0.
+        inter_op_num_threads (int, optional): Number of threads running independent operators. 0 lets onnxruntime decide. Defaults to 0.
+        graph_optimization_level (str, optional): "disable", "basic", "extended" or "all". Defaults to "all".
+        providers (list, optional): onnxruntime execution providers. Defaults to ["CPUExecutionProvider"].
+        size_divisibility (int, optional): Input images are padded to a multiple of it. Defaults to 32.
+    """
+
+    def __init__(
+        self,
+        cfg,
+        model_path: str = None,
+        paste_masks: bool = True,
+        intra_op_num_threads: int = 0,
+        inter_op_num_threads: int = 0,
+        graph_optimization_level: str = "all",
+        providers: list = None,
+        size_divisibility: int = 32,
+    ):
+        assert (
+            graph_optimization_level in ORT_OPTIMIZATION_LEVELS
+        ), f"graph_optimization_level must be one of {list(ORT_OPTIMIZATION_LEVELS)}."
+        super().__init__(
+            cfg, paste_masks=paste_masks, size_divisibility=size_divisibility
+        )
+
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = intra_op_num_threads
+        options.inter_op_num_threads = inter_op_num_threads
+        options.graph_optimization_level = ORT_OPTIMIZATION_LEVELS[
+            graph_optimization_level
+        ]
+        self.session = ort.InferenceSession(
+            model_path or cfg.MODEL.WEIGHTS,
+            sess_options=options,
+            providers=providers or ["CPUExecutionProvider"],
+        )
+        self.input_name = self.session.get_inputs()[0].name
+
+    def run(self, image):
+        """Runs the ONNX model on a prepared input.
+
+        Args:
+            image (np.ndarray): the padded (3, H', W') float32 input
+
+        Returns:
+            tuple: the boxes, classes, ROI masks and scores predicted
+        """
+        # Outputs are ordered by Instances field name, then the image size.
+        return tuple(self.session.run(None, {self.input_name: image})[:4])
+
+
+def create_predictor(
+    cfg,
+    backend: str = "torch",
+    paste_masks: bool = True,
+    num_threads: int = 0,
+    quantized: bool = False,
+    **kwargs,
+):
+    """Creates a predictor for a model backend.
+
+    Args:
+        cfg: Detectron2 config. Its MODEL.WEIGHTS is the model file of the backend.
+        backend (str, optional): "torch" for a BatchPredictor running the eager PyTorch model, "onnx" for an OnnxPredictor running an exported ONNX model, or "torchscript" for a TorchScriptPredictor running an exported TorchScript model. Defaults to "torch".
+        paste_masks (bool, optional): If false, the predictor returns ROI mask probabilities instead of full-image masks. Defaults to True.
+        num_threads (int, optional): Number of CPU threads used for inference: the intra-op threads of the onnxruntime session, or torch.set_num_threads for the torch and torchscript backends. 0 keeps the backend default. Defaults to 0.
+        quantized (bool, optional): If true, MODEL.WEIGHTS is a model quantized by aerialseg.quantization, run by a QuantizedPredictor. Only for the torch backend. Defaults to False.
+        **kwargs: Any other arguments of the predictor class, e.g. the session options of OnnxPredictor
+
+    Returns:
+        A predictor with the call contract of DefaultPredictor, and a predict_batch method
+    """
+    if quantized and backend != "torch":
+        raise ValueError("Quantized models can only run on the torch backend.")
+    if backend == "torch":
+        if num_threads > 0:
+            torch.set_num_threads(num_threads)
+        if quantized:
+            # Imported here, as aerialseg.quantization depends on this module.
+            from aerialseg.quantization import QuantizedPredictor
+
+            return QuantizedPredictor(cfg, paste_masks=paste_masks, **kwargs)
+        return BatchPredictor(cfg, paste_masks=paste_masks, **kwargs)
+    elif backend == "onnx":
+        return OnnxPredictor(
+            cfg, paste_masks=paste_masks, intra_op_num_threads=num_threads, **kwargs
+        )
+    elif backend == "torchscript":
+        if num_threads > 0:
+            torch.set_num_threads(num_threads)
+        return TorchScriptPredictor.from_config(cfg, paste_masks=paste_masks, **kwargs)
+    else:
+        raise ValueError(
+            f"backend must be 'torch', 'onnx' or 'torchscript', not {backend}."
+        )
@@ -0,0 +1,367 @@
+# -*- coding: utf-8 -*-
+"""Named span timers and counters for the hot paths of the pipeline.
+
+Profiling is off by default, and spans and counters then cost a global
+lookup. It is switched on by setting the AERIALSEG_PROFILE environment
+variable (to anything but "" or "0"), by the --profile flag of the
+prediction scripts, or by calling enable(). The recorded spans can be
+written as a Chrome trace, which opens in chrome://tracing or
+https://ui.perfetto.dev, along with a summary of each span and counter.
+"""
+import functools
+import json
+import os
+import threading
+import time
+
+from aerialseg import memory
+
+PROFILE_ENV = "AERIALSEG_PROFILE"
+
+# The active profiler, or None when profiling is off.
+_profiler = None
+
+
+class _NullSpan:
+    """Stands in for a span when profiling is off."""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    __slots__ = ("profiler", "name", "start")
+
+    def __init__(self, profiler, name: str):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.add_span(
+            self.name, self.start, time.perf_counter_ns() - self.start
+        )
+        return False
+
+
+class Profiler:
+    """Records spans and counters.
+
+    Every span is summed into its per-name statistics, and kept as a trace
+    event until max_events events are held; later events only count towards
+    the statistics.
+
+    Args:
+        max_events (int, optional): Maximum number of trace events kept in memory. Defaults to 1000000.
+    """
+
+    def __init__(self, max_events: int = 1_000_000):
+        self.max_events = max_events
+        self.events = []
+        self.spans = {}
+        self.counters = {}
+        self.threads = {}
+        self.dropped = 0
+        self._lock = threading.Lock()
+
+    def add_span(self, name: str, start: int, duration: int):
+        """Records a span.
+
+        Args:
+            name (str): Name of the span
+            start (int): Start time in nanoseconds, from time.perf_counter_ns
+            duration (int): Duration in nanoseconds
+        """
+        pid, tid = os.getpid(), threading.get_ident()
+        with self._lock:
+            stats = self.spans.get(name)
+            if stats is None:
+                self.spans[name] = [1, duration, duration]
+            else:
+                stats[0] += 1
+                stats[1] += duration
+                stats[2] = max(stats[2], duration)
+            if len(self.events) < self.max_events:
+                self.events.append((name, start, duration, pid, tid))
+                if (pid, tid) not in self.threads:
+                    self.threads[(pid, tid)] = threading.current_thread().name
+            else:
+                self.dropped += 1
+
+    def count(self, name: str, value: float = 1):
+        """Adds a value to a counter.
+
+        Args:
+            name (str): Name of the counter, e.g. "instances_per_tile"
+            value (float, optional): The value, e.g. the number of instances of a tile. Defaults to 1.
+        """
+        with self._lock:
+            stats = self.counters.get(name)
+            if stats is None:
+                self.counters[name] = [1, value, value]
+            else:
+                stats[0] += 1
+                stats[1] += value
+                stats[2] = max(stats[2], value)
+
+    def drain(self) -> dict:
+        """Returns the recorded spans and counters as a picklable dict, and
+        clears them, e.g. to send them from a worker process to merge.
+
+        Returns:
+            dict: The recorded state
+        """
+        with self._lock:
+            state = {
+                "events": self.events,
+                "spans": self.spans,
+                "counters": self.counters,
+                "threads": self.threads,
+                "dropped": self.dropped,
+            }
+            self.events = []
+            self.spans = {}
+            self.counters = {}
+            self.threads = {}
+            self.dropped = 0
+
+        return state
+
+    def merge(self, state: dict):
+        """Adds spans and counters drained from another profiler.
+
+        Args:
+            state (dict): The state returned by drain
+        """
+        with self._lock:
+            for totals, other in (
+                (self.spans, state["spans"]),
+                (self.counters, state["counters"]),
+            ):
+                for name, (events, total, maximum) in other.items():
+                    stats = totals.get(name)
+                    if stats is None:
+                        totals[name] = [events, total, maximum]
+                    else:
+                        stats[0] += events
+                        stats[1] += total
+                        stats[2] = max(stats[2], maximum)
+            room = max(self.max_events - len(self.events), 0)
+            self.events.extend(state["events"][:room])
+            self.dropped += state["dropped"] + max(len(state["events"]) - room, 0)
+            for thread, name in state["threads"].items():
+                self.threads.setdefault(thread, name)
+
+    def summary(self) -> dict:
+        """Returns the statistics of each span and counter.
+
+        Returns:
+            dict: The "spans", with the number of "calls", "total_s", "mean_ms" and "max_ms" of each, and the "counters", with the number of "events", "total", "mean" and "max" of each
+        """
+        with self._lock:
+            spans = {
+                name: {
+                    "calls": calls,
+                    "total_s": total / 1e9,
+                    "mean_ms": total / calls / 1e6,
+                    "max_ms": maximum / 1e6,
+                }
+                for name, (calls, total, maximum) in self.spans.items()
+            }
+            counters = {
+                name: {
+                    "events": events,
+                    "total": total,
+                    "mean": total / events,
+                    "max": maximum,
+                }
+                for name, (events, total, maximum) in self.counters.items()
+            }
+
+        return {"spans": spans, "counters": counters, "dropped_events": self.dropped}
+
+    def chrome_trace(self) -> dict:
+        """Returns the spans as a Chrome trace (JSON object format), with the
+        summary under a "summary" key. If memory tracking is on (see
+        aerialseg.memory), the peaks of each tile are added as counter events
+        and the memory summary under a "memory" key.
+
+        Returns:
+            dict: The trace
+        """
+        with self._lock:
+            events = [
+                {
+                    "name": name,
+                    "cat": "aerialseg",
+                    "ph": "X",
+                    "ts": start / 1e3,
+                    "dur": duration / 1e3,
+                    "pid": pid,
+                    "tid": tid,
+                }
+                for name, start, duration, pid, tid in self.events
+            ]
+            events.extend(
+                {
+                    "name": "thread_name",
+                    "ph": "M",
+                    "pid": pid,
+                    "tid": tid,
+                    "args": {"name": name},
+                }
+                for (pid, tid), name in self.threads.items()
+            )
+
+        trace = {
+            "traceEvents": events,
+            "displayTimeUnit": "ms",
+            "summary": self.summary(),
+        }
+        tracker = memory.get_tracker()
+        if tracker is not None:
+            events.extend(tracker.trace_events())
+            trace["memory"] = tracker.summary()
+
+        return trace
+
+    def format_summary(self) -> str:
+        """Returns the summary as a table, spans sorted by total time."""
+        summary = self.summary()
+        lines = [
+            f"{'Span':<32}{'Calls':>9}{'Total s':>10}{'Mean ms':>10}{'Max ms':>10}"
+        ]
+        for name, stats in sorted(
+            summary["spans"].items(), key=lambda item: -item[1]["total_s"]
+        ):
+            lines.append(
+                f"{name:<32}{stats['calls']:>9}{stats['total_s']:>10.2f}"
+                f"{stats['mean_ms']:>10.2f}{stats['max_ms']:>10.2f}"
+            )
+        if summary["counters"]:
+            lines.append(
+                f"{'Counter':<32}{'Events':>9}{'Total':>10}{'Mean':>10}{'Max':>10}"
+            )
+            for name, stats in sorted(summary["counters"].items()):
+                lines.append(
+                    f"{name:<32}{stats['events']:>9}{stats['total']:>10.0f}"
+                    f"{stats['mean']:>10.2f}{stats['max']:>10.0f}"
+                )
+        if summary["dropped_events"]:
+            lines.append(
+                f"{summary['dropped_events']} trace events beyond max_events were "
+                "only counted in the summary"
+            )
+
+        return "\n".join(lines)
+
+    def write_chrome_trace(self, path: str):
+        """Writes the Chrome trace, with the summary, to a JSON file.
+
+        Args:
+            path (str): Path of the JSON file
+        """
+        with open(path, "w") as f:
+            json.dump(self.chrome_trace(), f)
+
+
+def enable(max_events: int = 1_000_000) -> Profiler:
+    """Switches profiling on, keeping the active profiler if there is one.
+
+    Args:
+        max_events (int, optional): Maximum number of trace events kept in memory, for a new profiler. Defaults to 1000000.
+
+    Returns:
+        Profiler: The active profiler
+    """
+    global _profiler
+    if _profiler is None:
+        _profiler = Profiler(max_events=max_events)
+
+    return _profiler
+
+
+def disable():
+    """Switches profiling off, discarding what was recorded."""
+    global _profiler
+    _profiler = None
+
+
+def enabled() -> bool:
+    """Returns true if profiling is on."""
+    return _profiler is not None
+
+
+def get_profiler():
+    """Returns the active Profiler, or None if profiling is off."""
+    return _profiler
+
+
+def span(name: str):
+    """Returns a context manager timing a named span.
+
+    Args:
+        name (str): Name of the span, e.g. "predict"
+
+    Returns:
+        A context manager, which does nothing if profiling is off
+    """
+    if _profiler is None:
+        return _NULL_SPAN
+
+    return _Span(_profiler, name)
+
+
+def count(name: str, value: float = 1):
+    """Adds a value to a named counter, if profiling is on.
+
+    Args:
+        name (str): Name of the counter, e.g. "instances_per_tile"
+        value (float, optional): The value. Defaults to 1.
+    """
+    if _profiler is not None:
+        _profiler.count(name, value)
+
+
+def traced(name: str = None):
+    """Decorates a function to time each call as a span.
+
+    Args:
+        name (str, optional): Name of the span. Defaults to the function name.
+
+    Returns:
+        The decorator
+    """
+
+    def decorator(func):
+        span_name = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _profiler is None:
+                return func(*args, **kwargs)
+            with _Span(_profiler, span_name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def _enabled_by_env() -> bool:
+    return os.environ.get(PROFILE_ENV, "") not in ("", "0")
+
+
+if _enabled_by_env():
+    enable()
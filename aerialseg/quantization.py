@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+import torch
+from torch import nn
+
+from aerialseg.export import agreement, latency_stats, timed_predictions
+from aerialseg.predictors import BatchPredictor
+
+
+def linear_module_names(model) -> list:
+    """Returns the names of the nn.Linear modules of a model, the modules
+    dynamic quantization applies to.
+
+    In a Mask R-CNN these are the fully connected layers of the box head and
+    the box predictor.
+
+    Args:
+        model (torch.nn.Module): The model
+
+    Returns:
+        list: The module names, in model order
+    """
+    return [
+        name for name, module in model.named_modules() if type(module) is nn.Linear
+    ]
+
+
+def quantize_model(model, module_names: list = None):
+    """Applies dynamic INT8 quantization to the nn.Linear modules of a model.
+
+    Weights are quantized ahead of time and activations on the fly, so no
+    calibration data is needed to quantize; calibrate picks the modules
+    whose quantization keeps the predictions of the float model.
+
+    Args:
+        model (torch.nn.Module): The float model, in eval mode. It is not modified.
+        module_names (list, optional): Names of the nn.Linear modules to quantize. If None, all of them are quantized. Defaults to None.
+
+    Returns:
+        torch.nn.Module: The quantized model
+    """
+    if module_names is None:
+        module_names = linear_module_names(model)
+
+    return torch.ao.quantization.quantize_dynamic(
+        model, qconfig_spec=set(module_names), dtype=torch.qint8, inplace=False
+    )
+
+
+def save_quantized(model, path: str, module_names: list):
+    """Saves a model quantized by quantize_model.
+
+    Args:
+        model (torch.nn.Module): The quantized model
+        path (str): Path of the saved model, usually a .pth file
+        module_names (list): Names of the quantized modules
+    """
+    torch.save(
+        {
+            "model": model.state_dict(),
+            "quantized_modules": list(module_names),
+            "torch": torch.__version__,
+        },
+        path,
+    )
+
+
+def load_quantized(model, path: str):
+    """Loads a quantized model saved by save_quantized.
+
+    Args:
+        model (torch.nn.Module): The float model built from the config of the quantized model. Its weights are replaced.
+        path (str): Path of the saved model
+
+    Returns:
+        torch.nn.Module: The quantized model, in eval mode
+    """
+    checkpoint = torch.load(path, map_location="cpu")
+    model = quantize_model(model.eval(), checkpoint["quantized_modules"])
+    model.load_state_dict(checkpoint["model"])
+
+    return model.eval()
+
+
+class QuantizedPredictor(BatchPredictor):
+    """A BatchPredictor running a model quantized by quantize_model, on the
+    CPU.
+
+    Args:
+        cfg: Detectron2 config of the float model. Its MODEL.WEIGHTS is the quantized model saved by save_quantized.
+        paste_masks (bool, optional): If false, ROI mask probabilities are returned instead of full-image masks. See BatchPredictor. Defaults to True.
+    """
+
+    def __init__(self, cfg, paste_masks: bool = True):
+        # The model is built without weights; they are loaded with the quantization.
+        float_cfg = cfg.clone()
+        float_cfg.defrost()
+        float_cfg.MODEL.WEIGHTS = ""
+        float_cfg.MODEL.DEVICE = "cpu"
+        super().__init__(float_cfg, paste_masks=paste_masks)
+        self.model = load_quantized(self.model, cfg.MODEL.WEIGHTS)
+
+
+def calibrate(
+    cfg,
+    images: list,
+    module_names: list = None,
+    min_mask_iou: float = 0.95,
+    min_matched: float = 0.95,
+    iou_threshold: float = 0.5,
+    warmup: int = 1,
+):
+    """Picks the nn.Linear modules of a model that can be quantized without
+    changing its predictions on sample tiles.
+
+    Each candidate module is quantized on its own and its predictions are
+    compared to those of the float model; modules reaching min_mask_iou and
+    min_matched are kept. The model quantized with all kept modules is
+    then compared and timed against the float model.
+
+    Args:
+        cfg: Detectron2 config, with MODEL.WEIGHTS set to the float weights
+        images (list): Sample tiles of shape (H, W, C) (in BGR order)
+        module_names (list, optional): Candidate modules. If None, all nn.Linear modules are candidates. Defaults to None.
+        min_mask_iou (float, optional): Mean mask IoU with the float model a quantized module must keep. Defaults to 0.95.
+        min_matched (float, optional): Fraction of instances matched with the float model a quantized module must keep. Defaults to 0.95.
+        iou_threshold (float, optional): Minimum box IoU of matched instances. Defaults to 0.5.
+        warmup (int, optional): Number of tiles predicted before timing. Defaults to 1.
+
+    Returns:
+        model (torch.nn.Module): The quantized model
+        report (dict): The "modules" kept, the agreement of each candidate module ("candidates"), and the latency and agreement of the "float" and "quantized" models, with the "speedup" of the median latency
+    """
+    cfg = cfg.clone()
+    cfg.defrost()
+    cfg.MODEL.DEVICE = "cpu"
+    predictor = BatchPredictor(cfg)
+    float_model = predictor.model
+    if module_names is None:
+        module_names = linear_module_names(float_model)
+
+    def predict(model, warmup=0):
+        # The candidate models share the preprocessing of the float predictor.
+        predictor.model = model
+        return timed_predictions(predictor, images, warmup)
+
+    reference, float_latencies = predict(float_model, warmup)
+    candidates = {}
+    for name in module_names:
+        predictions, _ = predict(quantize_model(float_model, [name]))
+        candidates[name] = agreement(reference, predictions, iou_threshold)
+    kept = [
+        name
+        for name in module_names
+        if candidates[name]["mask_iou"] >= min_mask_iou
+        and candidates[name]["matched_fraction"] >= min_matched
+    ]
+
+    model = quantize_model(float_model, kept)
+    predictions, latencies = predict(model, warmup)
+    report = {
+        "modules": kept,
+        "candidates": candidates,
+        "float": {
+            **latency_stats(float_latencies),
+            "instances": int(sum(len(r) for r in reference)),
+        },
+        "quantized": {
+            **latency_stats(latencies),
+            **agreement(reference, predictions, iou_threshold),
+        },
+    }
+    report["speedup"] = (
+        report["float"]["latency_median_ms"] / report["quantized"]["latency_median_ms"]
+    )
+
+    return model, report
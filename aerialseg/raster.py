@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+import threading
+
+import numpy as np
+import rasterio as rio
+from rasterio import windows as rio_windows
+
+from aerialseg import profiling
+
+
+def _tile_offsets(length: int, tile_size: int, stride: int):
+    """Yields tile offsets along one axis until a tile reaches the edge."""
+    offset = 0
+    while True:
+        yield offset
+        if offset + tile_size >= length:
+            return
+        offset += stride
+
+
+@profiling.traced()
+def raster_windows(raster, tile_size: int, overlap: float = 0):
+    """Splits a raster into square tile windows, without reading any pixels.
+
+    Args:
+        raster (rasterio.DatasetReader): An open raster dataset
+        tile_size (int): Tile size in pixels. Tiles on the right and bottom edges may be smaller.
+        overlap (float, optional): Overlap between neighbouring tiles in percent of the tile size. Defaults to 0.
+
+    Returns:
+        list: A list of (window, transform) tuples, where transform is the affine transform of the window.
+    """
+    assert tile_size > 0, "tile_size must be greater than 0."
+    assert 0 <= overlap < 100, "overlap must be between 0 and 100 percent."
+    stride = max(int(round(tile_size * (1 - overlap / 100))), 1)
+    full_window = rio_windows.Window(0, 0, raster.width, raster.height)
+
+    tiles = []
+    for row_off in _tile_offsets(raster.height, tile_size, stride):
+        for col_off in _tile_offsets(raster.width, tile_size, stride):
+            window = rio_windows.Window(
+                col_off, row_off, tile_size, tile_size
+            ).intersection(full_window)
+            tiles.append((window, rio_windows.transform(window, raster.transform)))
+
+    return tiles
+
+
+def window_image_records(windows: list) -> list:
+    """Creates COCO image records for raster windows.
+
+    Args:
+        windows (list): A list of rasterio windows. The image ids follow the order of the list.
+
+    Returns:
+        list: A list of COCO image dicts
+    """
+    return [
+        {
+            "id": image_id,
+            "file_name": f"tile_{int(window.col_off)}-{int(window.row_off)}.png",
+            "width": int(window.width),
+            "height": int(window.height),
+        }
+        for image_id, window in enumerate(windows)
+    ]
+
+
+def raster_to_image(data):
+    """Converts raster band data into an image as cv2.imread would read it.
+
+    Args:
+        data (np.ndarray): A (bands, H, W) array. The first three bands are taken as RGB; a single band is taken as greyscale.
+
+    Returns:
+        np.ndarray: A (H, W, 3) uint8 image in BGR order
+    """
+    if data.shape[0] >= 3:
+        data = data[:3]
+    else:
+        data = np.repeat(data[:1], 3, axis=0)
+    image = np.moveaxis(data, 0, -1)[:, :, ::-1]
+    if image.dtype != np.uint8:
+        image = np.clip(image, 0, 255).astype(np.uint8)
+
+    return np.ascontiguousarray(image)
+
+
+class RasterWindowReader:
+    """Reads raster windows straight into memory as BGR images.
+
+    Can be used as the load_fn of aerialseg.pipeline.Prefetcher. Rasterio
+    datasets can not be shared between threads, so each thread opens its own
+    handle to the raster.
+
+    Args:
+        raster_path (str): Path to a raster file
+    """
+
+    def __init__(self, raster_path: str):
+        self.raster_path = raster_path
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._rasters = []
+
+    def __getstate__(self):
+        # Raster handles stay with their process; a pickled reader opens its own.
+        return {"raster_path": self.raster_path}
+
+    def __setstate__(self, state):
+        self.__init__(state["raster_path"])
+
+    def _raster(self):
+        raster = getattr(self._local, "raster", None)
+        if raster is None:
+            raster = rio.open(self.raster_path)
+            self._local.raster = raster
+            with self._lock:
+                self._rasters.append(raster)
+
+        return raster
+
+    def __call__(self, window):
+        raster = self._raster()
+        indexes = [1, 2, 3] if raster.count >= 3 else [1]
+        with profiling.span("read_window"):
+            data = raster.read(indexes, window=window)
+
+        return raster_to_image(data)
+
+    def close(self):
+        """Closes the raster handles of all threads."""
+        with self._lock:
+            for raster in self._rasters:
+                raster.close()
+            self._rasters = []
+        self._local = threading.local()
@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+import multiprocessing
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import torch
+from tqdm import tqdm
+
+from aerialseg import memory, profiling
+from aerialseg.annotations import AnnotationStore
+from aerialseg.pipeline import batched
+from aerialseg.utils import (
+    _AnnotationsWriter,
+    extract_mask_annotation_store,
+    predict_arrays,
+    tile_file_name,
+)
+
+# State of a replica worker process, set by _init_replica.
+_replica = {}
+
+
+def replica_cores(replica: int, threads_per_replica: int, cores: list) -> list:
+    """Returns the CPU cores a replica is pinned to.
+
+    Replicas get consecutive blocks of threads_per_replica cores, wrapping
+    around if there are more threads than cores.
+
+    Args:
+        replica (int): Index of the replica
+        threads_per_replica (int): Number of threads of each replica
+        cores (list): The available cores, usually sorted(os.sched_getaffinity(0))
+
+    Returns:
+        list: The cores of the replica
+    """
+    start = replica * threads_per_replica
+    return [cores[(start + i) % len(cores)] for i in range(threads_per_replica)]
+
+
+def _init_replica(
+    predictor_factory,
+    threads,
+    replica_ids,
+    cores,
+    load_fn,
+    cache,
+    options,
+    profile,
+    track_memory,
+):
+    """Sets up a replica worker process: its threads, cores, model and
+    profiling."""
+    replica = replica_ids.get()
+    if profile:
+        profiling.enable()
+    else:
+        profiling.disable()
+    if track_memory:
+        memory.enable()
+    else:
+        memory.disable()
+    torch.set_num_threads(threads)
+    cv2.setNumThreads(threads)
+    if cores is not None:
+        os.sched_setaffinity(0, replica_cores(replica, threads, cores))
+    _replica.update(
+        predictor=predictor_factory(), load_fn=load_fn, cache=cache, options=options
+    )
+
+
+def _predict_replica(items: list, image_ids: list) -> dict:
+    """Decodes, predicts and polygonizes a batch of tiles in a replica worker
+    process."""
+    cache = _replica["cache"]
+    start = time.perf_counter()
+    with profiling.span("decode"):
+        images = [_replica["load_fn"](item) for item in items]
+    decode_time = time.perf_counter() - start
+
+    with memory.tile([tile_file_name(item) for item in items]) as memory_record:
+        start = time.perf_counter()
+        hits, misses = (cache.hits, cache.misses) if cache is not None else (0, 0)
+        with profiling.span("predict"), memory.stage("predict"):
+            batch_arrays = predict_arrays(images, _replica["predictor"], cache=cache)
+        predict_time = time.perf_counter() - start
+        if memory_record is not None:
+            memory_record["instances"] = [len(a[2]) for a in batch_arrays]
+
+        start = time.perf_counter()
+        with profiling.span("postprocess"), memory.stage("postprocess"):
+            annotations = [
+                extract_mask_annotation_store(
+                    mask_array,
+                    bbox,
+                    labels,
+                    image_id,
+                    scores=scores,
+                    roi_masks=roi_masks,
+                    **_replica["options"],
+                )
+                for (mask_array, bbox, labels, roi_masks, scores), image_id in zip(
+                    batch_arrays, image_ids
+                )
+            ]
+        postprocess_time = time.perf_counter() - start
+
+    profiler = profiling.get_profiler()
+    tracker = memory.get_tracker()
+    return {
+        "shapes": [image.shape[:2] for image in images],
+        "annotations": annotations,
+        "decode": decode_time,
+        "predict": predict_time,
+        "postprocess": postprocess_time,
+        "cache_hits": cache.hits - hits if cache is not None else 0,
+        "cache_misses": cache.misses - misses if cache is not None else 0,
+        # The spans of the batch, merged into the profiler of the main process.
+        "profile": profiler.drain() if profiler is not None else None,
+        "memory": tracker.drain() if tracker is not None else None,
+    }
+
+
+def extract_all_annotations_replicated(
+    images_list: list,
+    predictor_factory,
+    num_replicas: int = 2,
+    threads_per_replica: int = 1,
+    pin_cores: bool = False,
+    simplify_tolerance: float = 0.0,
+    minimum_rotated_rectangle: bool = False,
+    batch_size: int = 1,
+    timings: dict = None,
+    load_fn=cv2.imread,
+    mask_resolution: int = 0,
+    writer=None,
+    cache=None,
+    max_pending: int = None,
+):
+    """Extract and combine tile annotations with several model replicas, each
+    in its own worker process.
+
+    Behaves like aerialseg.utils.extract_all_annotations, but batches of
+    tiles are handed out to num_replicas worker processes through the
+    shared task queue of a process pool. Each worker builds its own
+    predictor, runs torch (and OpenCV) with threads_per_replica threads, and
+    decodes, predicts and polygonizes its tiles. Only the annotations are
+    sent back, and they are collected in tile order.
+
+    Args:
+        images_list (list): A list of image paths, or of any items load_fn accepts
+        predictor_factory (callable): Picklable function creating the predictor of a replica, e.g. a functools.partial of aerialseg.predictors.create_predictor
+        num_replicas (int, optional): Number of worker processes. Defaults to 2.
+        threads_per_replica (int, optional): Number of threads of each worker. Defaults to 1.
+        pin_cores (bool, optional): If true, each worker is pinned to its own block of threads_per_replica cores (Linux only). Defaults to False.
+        simplify_tolerance (float, optional): Tolerance for simplifying polygons. Accepts values between 0.0 and 1.0. Defaults to 0.0.
+        minimum_rotated_rectangle (bool, optional): If true, will return the minimum rotated rectangle of the polygon. Defaults to False.
+        batch_size (int, optional): Number of tiles per task, predicted in a single forward pass if the predictor supports it. Defaults to 1.
+        timings (dict, optional): If given, will be filled with the time (seconds) spent in each stage, summed over workers: "decode", "predict" and "postprocess", the time the main process waited for results: "wait", and the time until the first batch came back, spawning workers and building their predictors included: "startup". Defaults to None.
+        load_fn (callable, optional): Picklable function loading an item of images_list as a BGR image, e.g. aerialseg.raster.RasterWindowReader. Defaults to cv2.imread.
+        mask_resolution (int, optional): Size ROI masks are resized to before tracing, for predictors that do not paste full-image masks. If 0, they are resized to the box size in pixels. Defaults to 0.
+        writer (optional): A writer with add_image and add_annotations methods, e.g. aerialseg.writers.StreamingCocoWriter. If given, annotations are written to it in tile order and None is returned. Defaults to None.
+        cache (optional): An aerialseg.cache.PredictionCache of raw model outputs, shared by the workers through the cache directory. Its hits and misses are updated with those of the workers. Defaults to None.
+        max_pending (int, optional): Maximum number of batches in flight. Defaults to 2 * num_replicas.
+
+    Returns:
+        AnnotationStore: A store of annotations, or None if a writer is given
+    """
+    assert num_replicas >= 1, "num_replicas must be at least 1."
+    assert threads_per_replica >= 1, "threads_per_replica must be at least 1."
+    assert batch_size >= 1, "batch_size must be at least 1."
+    if max_pending is None:
+        max_pending = 2 * num_replicas
+
+    # Workers are spawned rather than forked, as forking a process that has
+    # already started torch's thread pools can deadlock.
+    context = multiprocessing.get_context("spawn")
+    replica_ids = context.Queue()
+    for replica in range(num_replicas):
+        replica_ids.put(replica)
+    cores = sorted(os.sched_getaffinity(0)) if pin_cores else None
+    run_start = time.perf_counter()
+    options = {
+        "simplify_tolerance": simplify_tolerance,
+        "minimum_rotated_rectangle": minimum_rotated_rectangle,
+        "mask_resolution": mask_resolution,
+    }
+    executor = ProcessPoolExecutor(
+        max_workers=num_replicas,
+        mp_context=context,
+        initializer=_init_replica,
+        initargs=(
+            predictor_factory,
+            threads_per_replica,
+            replica_ids,
+            cores,
+            load_fn,
+            cache,
+            options,
+            profiling.enabled(),
+            memory.enabled(),
+        ),
+    )
+
+    stage_times = {"decode": 0.0, "predict": 0.0, "postprocess": 0.0, "wait": 0.0}
+    stage_times["startup"] = None
+    all_annotations = []
+    if writer is not None:
+        # Annotations go straight to the writer instead of being collected.
+        all_annotations = _AnnotationsWriter(writer)
+    pending = deque()
+
+    def collect(progress):
+        items, image_ids, future = pending.popleft()
+        start = time.perf_counter()
+        result = future.result()
+        stage_times["wait"] += time.perf_counter() - start
+        if stage_times["startup"] is None:
+            stage_times["startup"] = time.perf_counter() - run_start
+        for stage in ("decode", "predict", "postprocess"):
+            stage_times[stage] += result[stage]
+        if cache is not None:
+            cache.hits += result["cache_hits"]
+            cache.misses += result["cache_misses"]
+        profiler = profiling.get_profiler()
+        if profiler is not None and result["profile"] is not None:
+            profiler.merge(result["profile"])
+        tracker = memory.get_tracker()
+        if tracker is not None and result["memory"] is not None:
+            tracker.merge(result["memory"])
+        for item, image_id, shape, annotations in zip(
+            items, image_ids, result["shapes"], result["annotations"]
+        ):
+            if writer is not None:
+                writer.add_image(image_id, tile_file_name(item), *shape)
+            all_annotations.append(annotations)
+        progress.update(len(items))
+
+    image_index = 0
+    with executor, tqdm(total=len(images_list)) as progress:
+        for items in batched(images_list, batch_size):
+            image_ids = list(range(image_index, image_index + len(items)))
+            image_index += len(items)
+            future = executor.submit(_predict_replica, items, image_ids)
+            pending.append((items, image_ids, future))
+            while len(pending) > max_pending or (pending and pending[0][2].done()):
+                collect(progress)
+        while pending:
+            collect(progress)
+
+    if timings is not None:
+        stage_times["startup"] = stage_times["startup"] or 0.0
+        timings.update(stage_times)
+
+    if writer is not None:
+        return None
+
+    return AnnotationStore.concat(all_annotations)
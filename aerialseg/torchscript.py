@@ -0,0 +1,413 @@
+# -*- coding: utf-8 -*-
+import json
+import math
+import os
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from PIL import Image
+
+# Field names of the outputs of an exported model, in the order they are
+# flattened by tracing.
+OUTPUT_FIELDS = ("pred_boxes", "pred_classes", "pred_masks", "scores")
+
+
+class Boxes:
+    """A minimal stand-in for detectron2's Boxes, holding a (N, 4) tensor of
+    XYXY boxes.
+
+    Args:
+        tensor (torch.Tensor): A (N, 4) tensor of boxes
+    """
+
+    def __init__(self, tensor):
+        self.tensor = tensor
+
+    def __len__(self):
+        return self.tensor.shape[0]
+
+    def __getitem__(self, item):
+        return Boxes(self.tensor[item].view(-1, 4))
+
+    def __array__(self, dtype=None):
+        # Lets detectron2's Visualizer draw the boxes.
+        array = self.tensor.detach().cpu().numpy()
+        return array if dtype is None else array.astype(dtype)
+
+    def to(self, device):
+        return Boxes(self.tensor.to(device))
+
+    def clone(self):
+        return Boxes(self.tensor.clone())
+
+    def scale(self, scale_x: float, scale_y: float):
+        self.tensor[:, 0::2] *= scale_x
+        self.tensor[:, 1::2] *= scale_y
+
+    def clip(self, box_size: tuple):
+        height, width = box_size
+        self.tensor[:, 0::2] = self.tensor[:, 0::2].clamp(min=0, max=width)
+        self.tensor[:, 1::2] = self.tensor[:, 1::2].clamp(min=0, max=height)
+
+    def nonempty(self):
+        widths = self.tensor[:, 2] - self.tensor[:, 0]
+        heights = self.tensor[:, 3] - self.tensor[:, 1]
+        return (widths > 0) & (heights > 0)
+
+
+class Instances:
+    """A minimal stand-in for detectron2's Instances, so the predictions of
+    TorchScriptPredictor can be used without importing detectron2.
+
+    Supports the fields API used by aerialseg.utils.output_to_arrays and
+    aerialseg.export: attribute access, has, get_fields, len, indexing
+    and to.
+
+    Args:
+        image_size (tuple): The (H, W) size of the image
+        **fields: The fields of the instances
+    """
+
+    def __init__(self, image_size: tuple, **fields):
+        self._image_size = image_size
+        self._fields = {}
+        for name, value in fields.items():
+            self.set(name, value)
+
+    @property
+    def image_size(self) -> tuple:
+        return self._image_size
+
+    def __setattr__(self, name, value):
+        if name.startswith("_"):
+            super().__setattr__(name, value)
+        else:
+            self.set(name, value)
+
+    def __getattr__(self, name):
+        if name == "_fields" or name not in self._fields:
+            raise AttributeError(f"Cannot find field '{name}' in the given Instances!")
+        return self._fields[name]
+
+    def set(self, name: str, value):
+        self._fields[name] = value
+
+    def has(self, name: str) -> bool:
+        return name in self._fields
+
+    def get(self, name: str):
+        return self._fields[name]
+
+    def get_fields(self) -> dict:
+        return self._fields
+
+    def __len__(self):
+        for value in self._fields.values():
+            return len(value)
+        return 0
+
+    def __getitem__(self, item):
+        return Instances(
+            self._image_size, **{k: v[item] for k, v in self._fields.items()}
+        )
+
+    def to(self, device):
+        return Instances(
+            self._image_size, **{k: v.to(device) for k, v in self._fields.items()}
+        )
+
+
+def resized_shape(height: int, width: int, short_edge: int, max_size: int) -> tuple:
+    """Returns the shape of an image resized as detectron2's
+    ResizeShortestEdge does.
+
+    Args:
+        height (int): height of the image
+        width (int): width of the image
+        short_edge (int): target length of the shortest edge
+        max_size (int): maximum length of the longest edge
+
+    Returns:
+        tuple: The (H, W) resized shape
+    """
+    scale = short_edge / min(height, width)
+    if height < width:
+        new_height, new_width = short_edge, scale * width
+    else:
+        new_height, new_width = scale * height, short_edge
+    if max(new_height, new_width) > max_size:
+        scale = max_size / max(new_height, new_width)
+        new_height, new_width = new_height * scale, new_width * scale
+
+    return int(new_height + 0.5), int(new_width + 0.5)
+
+
+def paste_masks(masks, boxes, image_size: tuple, threshold: float = 0.5):
+    """Pastes ROI mask probabilities into full-image binary masks, as
+    detectron2's paste_masks_in_image does on the CPU.
+
+    Args:
+        masks (torch.Tensor): A (N, M, M) tensor of ROI mask probabilities
+        boxes (torch.Tensor): A (N, 4) tensor of XYXY boxes in image coordinates
+        image_size (tuple): The (H, W) size of the image
+        threshold (float, optional): Probability threshold of the masks. Defaults to 0.5.
+
+    Returns:
+        torch.Tensor: A (N, H, W) bool tensor of masks
+    """
+    height, width = image_size
+    image_masks = torch.zeros((len(masks), height, width), dtype=torch.bool)
+    for i, (mask, box) in enumerate(zip(masks, boxes)):
+        # Only the pixels around the box are sampled.
+        x0 = max(int(math.floor(box[0].item())) - 1, 0)
+        y0 = max(int(math.floor(box[1].item())) - 1, 0)
+        x1 = min(int(math.ceil(box[2].item())) + 1, width)
+        y1 = min(int(math.ceil(box[3].item())) + 1, height)
+        grid_y = torch.arange(y0, y1, dtype=torch.float32) + 0.5
+        grid_x = torch.arange(x0, x1, dtype=torch.float32) + 0.5
+        grid_y = (grid_y - box[1]) / (box[3] - box[1]) * 2 - 1
+        grid_x = (grid_x - box[0]) / (box[2] - box[0]) * 2 - 1
+        grid = torch.stack(
+            [
+                grid_x[None, :].expand(len(grid_y), len(grid_x)),
+                grid_y[:, None].expand(len(grid_y), len(grid_x)),
+            ],
+            dim=2,
+        )
+        pasted = F.grid_sample(
+            mask[None, None].float(), grid[None], align_corners=False
+        )
+        image_masks[i, y0:y1, x0:x1] = pasted[0, 0] >= threshold
+
+    return image_masks
+
+
+class TorchScriptPredictor:
+    """Runs a Mask R-CNN exported to TorchScript by aerialseg.export, with the
+    call contract of Detectron2's DefaultPredictor, without importing
+    detectron2.
+
+    Handles both export methods, as get_tracing_inputs and
+    get_scripting_inputs do in scripts/benchmark.cpp: a traced model takes
+    the (3, H, W) image tensor and returns a tuple of outputs, a scripted
+    model takes a tuple of {"image": tensor} dicts and returns a dict of
+    outputs per image. Images are resized and padded as
+    aerialseg.predictors.OnnxPredictor does, and the predictions hold
+    Instances compatible with aerialseg.utils.extract_output_annotations.
+
+    Args:
+        model_path (str): Path to the TorchScript model
+        export_method (str, optional): "tracing" or "scripting". If None, it is read from the export.json written next to the model by aerialseg.export, or defaults to "tracing". Defaults to None.
+        min_size (int, optional): Length the shortest image edge is resized to (INPUT.MIN_SIZE_TEST). Defaults to 800.
+        max_size (int, optional): Maximum length of the longest resized edge (INPUT.MAX_SIZE_TEST). Defaults to 1333.
+        input_format (str, optional): "BGR" or "RGB" (INPUT.FORMAT). Defaults to "BGR".
+        pixel_mean (list, optional): The pixel mean of the model (MODEL.PIXEL_MEAN), used to pad images. Defaults to [103.53, 116.28, 123.675].
+        score_threshold (float, optional): Instances scoring below it are dropped (MODEL.ROI_HEADS.SCORE_THRESH_TEST). Defaults to 0.05.
+        paste_masks (bool, optional): If false, the ROI mask probabilities are returned as pred_mask_probs instead of full-image pred_masks, as with aerialseg.predictors.BatchPredictor. Defaults to True.
+        size_divisibility (int, optional): Input images are padded to a multiple of it. Defaults to 32.
+        device (str, optional): Device the model runs on. Defaults to "cpu".
+    """
+
+    def __init__(
+        self,
+        model_path: str,
+        export_method: str = None,
+        min_size: int = 800,
+        max_size: int = 1333,
+        input_format: str = "BGR",
+        pixel_mean: list = (103.53, 116.28, 123.675),
+        score_threshold: float = 0.05,
+        paste_masks: bool = True,
+        size_divisibility: int = 32,
+        device: str = "cpu",
+    ):
+        if export_method is None:
+            export_method = _read_export_method(model_path)
+        assert export_method in (
+            "tracing",
+            "scripting",
+        ), "export_method must be 'tracing' or 'scripting'."
+        self.export_method = export_method
+        self.min_size = min_size
+        self.max_size = max_size
+        self.input_format = input_format
+        self.pixel_mean = np.asarray(pixel_mean, dtype=np.float32)
+        self.score_threshold = score_threshold
+        self.paste_masks = paste_masks
+        self.size_divisibility = size_divisibility
+        self.device = device
+        self.model = torch.jit.load(model_path, map_location=device)
+        self.model.eval()
+
+    @classmethod
+    def from_config(cls, cfg, model_path: str = None, **kwargs):
+        """Creates a predictor with the preprocessing of a Detectron2 config.
+
+        Args:
+            cfg: Detectron2 config of the exported model, or any object with the same attributes. Its MODEL.WEIGHTS is the TorchScript model path unless model_path is given.
+            model_path (str, optional): Path to the TorchScript model. Defaults to None.
+            **kwargs: Any other arguments of TorchScriptPredictor
+
+        Returns:
+            TorchScriptPredictor: The predictor
+        """
+        kwargs.setdefault("device", cfg.MODEL.DEVICE)
+        return cls(
+            model_path or cfg.MODEL.WEIGHTS,
+            min_size=cfg.INPUT.MIN_SIZE_TEST,
+            max_size=cfg.INPUT.MAX_SIZE_TEST,
+            input_format=cfg.INPUT.FORMAT,
+            pixel_mean=cfg.MODEL.PIXEL_MEAN,
+            score_threshold=cfg.MODEL.ROI_HEADS.SCORE_THRESH_TEST,
+            **kwargs,
+        )
+
+    def __call__(self, original_image):
+        return self.predict_batch([original_image])[0]
+
+    def prepare_input(self, original_image):
+        """Resizes and pads a BGR image into the input of the model.
+
+        Args:
+            original_image (np.ndarray): an image of shape (H, W, C) (in BGR order).
+
+        Returns:
+            image (torch.Tensor): the padded (3, H', W') float32 input
+            image_size (tuple): the (H, W) size of the resized image, without padding
+        """
+        if self.input_format == "RGB":
+            original_image = original_image[:, :, ::-1]
+        height, width = resized_shape(
+            *original_image.shape[:2], self.min_size, self.max_size
+        )
+        # Resized with PIL, as detectron2's ResizeTransform does for uint8 images.
+        image = np.asarray(
+            Image.fromarray(np.ascontiguousarray(original_image)).resize(
+                (width, height), Image.BILINEAR
+            )
+        )
+        divisibility = self.size_divisibility
+        padded_height = int(math.ceil(height / divisibility)) * divisibility
+        padded_width = int(math.ceil(width / divisibility)) * divisibility
+
+        # Padding with the pixel mean pads zeros once the model normalizes.
+        padded = np.empty((3, padded_height, padded_width), dtype=np.float32)
+        padded[:] = self.pixel_mean[:, None, None]
+        padded[:, :height, :width] = image.astype(np.float32).transpose(2, 0, 1)
+
+        return torch.from_numpy(padded).to(self.device), (height, width)
+
+    def run(self, image):
+        """Runs the TorchScript model on a prepared input.
+
+        Args:
+            image (torch.Tensor): the padded (3, H', W') float32 input
+
+        Returns:
+            tuple: the boxes, classes, ROI masks and scores predicted
+        """
+        if self.export_method == "scripting":
+            output = self.model(({"image": image},))[0]
+            return tuple(output[name] for name in OUTPUT_FIELDS)
+
+        return tuple(self.model(image)[:4])
+
+    def predict_batch(self, original_images: list):
+        """Predicts a list of images, one model call per image.
+
+        Args:
+            original_images (list): a list of images of shape (H, W, C) (in BGR order).
+
+        Returns:
+            list: a list of prediction dicts, one per image, in the same order as the inputs.
+        """
+        predictions = []
+        with torch.inference_mode():
+            for original_image in original_images:
+                image, image_size = self.prepare_input(original_image)
+                outputs = self.run(image)
+                height, width = original_image.shape[:2]
+                instances = self.postprocess_outputs(
+                    outputs, image_size, height, width
+                )
+                predictions.append({"instances": instances})
+
+        return predictions
+
+    def postprocess_outputs(
+        self, outputs: tuple, image_size: tuple, height: int, width: int
+    ) -> Instances:
+        """Converts the outputs of run into instances of the original image.
+
+        Args:
+            outputs (tuple): the boxes, classes, ROI masks and scores returned by run
+            image_size (tuple): the (H, W) size of the resized image, without padding
+            height (int): height of the original image
+            width (int): width of the original image
+
+        Returns:
+            Instances: the instances, with full-image pred_masks, or pred_mask_probs if paste_masks is false
+        """
+        boxes, classes, masks, scores = outputs
+        keep = scores >= self.score_threshold
+        results = Instances(
+            image_size,
+            pred_boxes=Boxes(boxes[keep].to("cpu").float()),
+            pred_classes=classes[keep].to("cpu"),
+            pred_masks=masks[keep].to("cpu"),
+            scores=scores[keep].to("cpu"),
+        )
+
+        return postprocess(results, height, width, self.paste_masks)
+
+
+def postprocess(
+    results, output_height: int, output_width: int, paste: bool = True
+) -> Instances:
+    """Rescales raw model results to the original image size, as
+    detectron2's detector_postprocess does, or as
+    aerialseg.predictors.roi_postprocess does if paste is false.
+
+    Args:
+        results (Instances): raw results of the model, in the resized input image coordinates. pred_masks holds the (N, 1, M, M) ROI mask probabilities.
+        output_height (int): height of the original image
+        output_width (int): width of the original image
+        paste (bool, optional): If true, the ROI masks are pasted into full-image pred_masks. Otherwise they are returned as (N, M, M) pred_mask_probs. Defaults to True.
+
+    Returns:
+        Instances: the results in original image coordinates
+    """
+    scale_x = output_width / results.image_size[1]
+    scale_y = output_height / results.image_size[0]
+    image_size = (output_height, output_width)
+
+    boxes = results.pred_boxes.clone()
+    boxes.scale(scale_x, scale_y)
+    boxes.clip(image_size)
+    keep = boxes.nonempty()
+    boxes = boxes[keep]
+    roi_masks = results.pred_masks[keep][:, 0, :, :]
+
+    output = Instances(
+        image_size,
+        pred_boxes=boxes,
+        scores=results.scores[keep],
+        pred_classes=results.pred_classes[keep],
+    )
+    if paste:
+        output.pred_masks = paste_masks(roi_masks, boxes.tensor, image_size)
+    else:
+        output.pred_mask_probs = roi_masks
+
+    return output
+
+
+def _read_export_method(model_path: str) -> str:
+    """Returns the export method recorded next to a model by
+    aerialseg.export, or "tracing" if there is no record."""
+    path = os.path.join(os.path.dirname(model_path), "export.json")
+    if not os.path.exists(path):
+        return "tracing"
+    with open(path, "r") as f:
+        return json.load(f).get("export_method", "tracing")
@@ -1,18 +1,23 @@
 # -*- coding: utf-8 -*-
+import contextlib
 import os
+import time
 import warnings
 
 import cv2
 import numpy as np
-import pandas as pd
 import supervision as sv
 from aerial_conversion import coco
-from detectron2.utils.visualizer import Visualizer
 from matplotlib import pylab as plt
 from PIL import Image
+from pycocotools import mask as mask_util
 from shapely.geometry import Polygon
 from tqdm import tqdm
 
+from aerialseg import memory, profiling
+from aerialseg.annotations import AnnotationStore
+from aerialseg.pipeline import PolygonizerPool, Prefetcher, batched
+
 """
 Plotting and visualisation utilities
 """
@@ -76,6 +81,7 @@ def plot_polygons(polygons):
   plt.show()
 
 
+@profiling.traced()
 def polygon_prep(
     polygon, simplify_tolerance: float = 0.0, minimum_rotated_rectangle: bool = False
 ):
@@ -93,6 +99,7 @@ def polygon_prep(
         warnings.warn(
             f"The polygon has less than 3 points! This is not an actual polygon, and can be a line or point(s). Polygon: {polygon}."
         )
+    profiling.count("vertices_before_simplify", len(polygon))
     polygon = Polygon(polygon)
     if minimum_rotated_rectangle:
         polygon = polygon.minimum_rotated_rectangle
@@ -100,38 +107,233 @@ def polygon_prep(
         if simplify_tolerance > 0:
             polygon = polygon.simplify(simplify_tolerance)
     polygon = np.array(polygon.exterior.coords)
+    profiling.count("vertices_after_simplify", len(polygon))
 
     return polygon
 
 
-def extract_output_annotations(
-    output,
+def mask_crop_bounds(mask, box, margin: int = 3):
+    """Finds the region of an instance mask around its bounding box that
+    contains the whole mask.
+
+    Only the border pixels of the region are checked: if none is set, the
+    mask is taken to lie within the region. This relies on detectron2
+    pasting each mask within a pixel of its box. Pixels of an arbitrary mask
+    further outside the box that do not reach the border are left out.
+
+    Args:
+        mask (np.ndarray): A (H, W) or (H, W, 1) binary mask
+        box (np.ndarray): The (x0, y0, x1, y1) bounding box of the instance
+        margin (int, optional): Margin in pixels around the box. Defaults to 3.
+
+    Returns:
+        tuple: The (x0, y0, x1, y1) pixel bounds of the region. The whole image if the mask touches the edges of the box region.
+    """
+    height, width = mask.shape[:2]
+    x0 = max(int(np.floor(box[0])) - margin, 0)
+    y0 = max(int(np.floor(box[1])) - margin, 0)
+    x1 = min(int(np.ceil(box[2])) + margin + 1, width)
+    y1 = min(int(np.ceil(box[3])) + margin + 1, height)
+    if x0 >= x1 or y0 >= y1:
+        return 0, 0, width, height
+
+    crop = mask[y0:y1, x0:x1]
+    # Crop edges on the image edges are fine; any other edge must be empty.
+    if (
+        (x0 > 0 and crop[:, 0].any())
+        or (y0 > 0 and crop[0].any())
+        or (x1 < width and crop[:, -1].any())
+        or (y1 < height and crop[-1].any())
+    ):
+        return 0, 0, width, height
+
+    return x0, y0, x1, y1
+
+
+def mask_to_polygons_in_box(mask, box, margin: int = 3):
+    """Traces the polygons of an instance mask within its bounding box.
+
+    Contours are traced on the mask cropped to the box plus a margin, and
+    offset back to image coordinates, which gives the same polygons as
+    sv.mask_to_polygons on the full mask at a fraction of the cost. Falls
+    back to the full mask if the mask touches the crop edges.
+
+    Args:
+        mask (np.ndarray): A (H, W) or (H, W, 1) binary mask
+        box (np.ndarray): The (x0, y0, x1, y1) bounding box of the instance
+        margin (int, optional): Margin in pixels around the box. Defaults to 3.
+
+    Returns:
+        list: A list of polygons, each a (K, 2) array of [x, y] vertices
+    """
+    x0, y0, x1, y1 = mask_crop_bounds(mask, box, margin=margin)
+    if (x1 - x0, y1 - y0) == (mask.shape[1], mask.shape[0]):
+        return sv.mask_to_polygons(mask)
+
+    crop = mask[y0:y1, x0:x1]
+
+    return [polygon + np.array([x0, y0]) for polygon in sv.mask_to_polygons(crop)]
+
+
+def encode_mask(mask, box, mask_format: str = "full"):
+    """Encodes an instance mask in a compact representation.
+
+    Args:
+        mask (np.ndarray): A (H, W) or (H, W, 1) binary mask
+        box (np.ndarray): The (x0, y0, x1, y1) bounding box of the instance
+        mask_format (str, optional): "full" returns the mask as is. "rle" returns a COCO RLE dict. "packbits" returns a dict with the "offset" (x0, y0) and "shape" (h, w) of the mask cropped to its box, and the crop as np.packbits "bits". Defaults to "full".
+
+    Returns:
+        The encoded mask
+    """
+    if mask_format == "full":
+        return mask
+
+    mask = mask.reshape(mask.shape[:2])
+    if mask_format == "rle":
+        return mask_util.encode(np.asfortranarray(mask, dtype=np.uint8))
+    elif mask_format == "packbits":
+        x0, y0, x1, y1 = mask_crop_bounds(mask, box)
+        crop = mask[y0:y1, x0:x1]
+        return {
+            "offset": (x0, y0),
+            "shape": crop.shape,
+            "bits": np.packbits(crop, axis=None),
+        }
+    else:
+        raise ValueError(
+            f"mask_format must be 'full', 'rle' or 'packbits', not {mask_format}."
+        )
+
+
+def decode_mask(encoded_mask, image_shape: tuple = None):
+    """Decodes a mask encoded by encode_mask into a full binary mask.
+
+    Args:
+        encoded_mask: A mask encoded as a COCO RLE dict or as a packbits dict
+        image_shape (tuple, optional): The (H, W) shape of the image. Required for packbits masks.
+
+    Returns:
+        np.ndarray: A (H, W) binary mask
+    """
+    if "counts" in encoded_mask:
+        return mask_util.decode(encoded_mask).astype(bool)
+
+    assert image_shape is not None, "image_shape is required for packbits masks."
+    x0, y0 = encoded_mask["offset"]
+    height, width = encoded_mask["shape"]
+    mask = np.zeros(image_shape[:2], dtype=bool)
+    mask[y0 : y0 + height, x0 : x0 + width] = np.unpackbits(
+        encoded_mask["bits"], count=height * width
+    ).reshape(height, width)
+
+    return mask
+
+
+def roi_mask_to_polygons(
+    mask_prob, box, resolution: int = 0, mask_threshold: float = 0.5
+):
+    """Traces the polygons of a low resolution ROI mask, in image
+    coordinates, without pasting it into a full-image mask.
+
+    Args:
+        mask_prob (np.ndarray): A (M, M) array of mask probabilities over the box, as predicted by the mask head (usually 28x28)
+        box (np.ndarray): The (x0, y0, x1, y1) bounding box of the instance
+        resolution (int, optional): Size the mask is resized to before tracing. If 0, the mask is resized to the box size in pixels, which is closest to tracing the pasted full-image mask. Defaults to 0.
+        mask_threshold (float, optional): Probability above which a mask cell is foreground. Defaults to 0.5.
+
+    Returns:
+        list: A list of polygons, each a (K, 2) array of [x, y] vertices
+    """
+    box_width = box[2] - box[0]
+    box_height = box[3] - box[1]
+    if resolution > 0:
+        width, height = resolution, resolution
+    else:
+        width = max(int(np.ceil(box_width)), 1)
+        height = max(int(np.ceil(box_height)), 1)
+    if mask_prob.shape != (height, width):
+        mask_prob = cv2.resize(
+            mask_prob.astype(np.float32),
+            (width, height),
+            interpolation=cv2.INTER_LINEAR,
+        )
+
+    # Map mask cell centres onto image pixel centres within the box.
+    scale = np.array([box_width / width, box_height / height])
+    offset = np.array([box[0], box[1]])
+
+    return [
+        offset + (polygon + 0.5) * scale - 0.5
+        for polygon in sv.mask_to_polygons(mask_prob > mask_threshold)
+    ]
+
+
+def output_to_arrays(output):
+    """Returns the masks, bounding boxes, labels and scores of a prediction
+    output as numpy arrays.
+
+    Args:
+        output: Detectron2 prediction output. If the instances have pred_mask_probs (see aerialseg.predictors.BatchPredictor with paste_masks=False), the low resolution ROI masks are returned instead of full-image masks.
+
+    Returns:
+        mask_array (np.ndarray): A (N, H, W) array of binary masks, or a (N, M, M) array of ROI mask probabilities
+        bbox (np.ndarray): A (N, 4) array of bounding boxes
+        labels (np.ndarray): A (N,) array of labels
+        roi_masks (bool): True if mask_array holds ROI mask probabilities
+        scores (np.ndarray): A (N,) array of scores
+    """
+    instances = output["instances"]
+    roi_masks = instances.has("pred_mask_probs")
+    if roi_masks:
+        mask_array = instances.pred_mask_probs.to("cpu").numpy()
+    else:
+        mask_array = instances.pred_masks.to("cpu").numpy()
+    scores = instances.scores.to("cpu").numpy()
+    labels = instances.pred_classes.to("cpu").numpy()
+    bbox = instances.pred_boxes.to("cpu").tensor.numpy()
+
+    return mask_array, bbox, labels, roi_masks, scores
+
+
+@profiling.traced()
+def extract_mask_annotations(
+    mask_array,
+    bbox,
+    labels,
     flatten: bool = False,
     simplify_tolerance: float = 0.0,
     minimum_rotated_rectangle: bool = False,
+    roi_masks: bool = False,
+    mask_resolution: int = 0,
+    return_masks: bool = True,
+    mask_format: str = "full",
 ):
-    """Extracts polygons, bounding boxes, and binary masks from prediction
-    ouputs.
+    """Extracts polygons from an array of instance masks.
 
     Args:
-        output: Detectron2 prediction output
+        mask_array (np.ndarray): A (N, H, W) array of binary instance masks, or a (N, M, M) array of ROI mask probabilities if roi_masks is true
+        bbox (np.ndarray): A (N, 4) array of bounding boxes
+        labels (np.ndarray): A (N,) array of labels
         flatten (bool): If true, will flatten polygons, as such used in coco segmentations.
         simplify_tolerance (float, optional): Tolerance for simplifying polygons. Accepts values between 0.0 and 1.0. Defaults to 0.0.
         minimum_rotated_rectangle (bool, optional): If true, will return the minimum rotated rectangle of the polygon. Defaults to False.
+        roi_masks (bool, optional): If true, mask_array holds ROI mask probabilities, which are polygonized in box coordinates. Defaults to False.
+        mask_resolution (int, optional): Size ROI masks are resized to before tracing. If 0, they are resized to the box size in pixels. Defaults to 0.
+        return_masks (bool, optional): If false, no masks are returned (mask_arrays is empty), so the mask array can be freed as soon as the polygons are extracted. Defaults to True.
+        mask_format (str, optional): Representation of the returned full-image masks, see encode_mask. "full" returns (H, W, 1) views of mask_array, "rle" COCO RLE dicts, and "packbits" box-cropped bit-packed masks with their offsets. Masks of an instance with several polygons are encoded once and shared. ROI masks are always returned as they are. Defaults to "full".
 
     Returns:
-        mask_arrays (list): A list of binary masks
+        mask_arrays (list): A list of masks in mask_format (ROI mask probabilities if roi_masks is true)
         polygons (list): A list of polygons
         bbox (list): A list of bounding boxes
         labels (list): A list of labels
     """
-    mask_array = output["instances"].pred_masks.to("cpu").numpy()
     num_instances = mask_array.shape[0]
-    # scores = output['instances'].scores.to("cpu").numpy()
-    labels = output["instances"].pred_classes.to("cpu").numpy()
-    bbox = output["instances"].pred_boxes.to("cpu").tensor.numpy()
+    profiling.count("instances_per_tile", num_instances)
     # print(mask_array.shape)
-    mask_array = np.moveaxis(mask_array, 0, -1)
+    if not roi_masks:
+        mask_array = np.moveaxis(mask_array, 0, -1)
     mask_arrays = []
     polygons = []
     labels_list = []
@@ -139,19 +341,32 @@ def extract_output_annotations(
 
     for i in range(num_instances):
         # img = np.zeros_like(image)
-        mask_array_instance = mask_array[:, :, i : (i + 1)]
+        with profiling.span("mask_to_polygons"):
+            if roi_masks:
+                mask_array_instance = mask_array[i]
+                polygon_sv = roi_mask_to_polygons(
+                    mask_array_instance, bbox[i], resolution=mask_resolution
+                )
+            else:
+                mask_array_instance = mask_array[:, :, i : (i + 1)]
 
-        # img = np.where(mask_array_instance[i] == True, 255, img)
-        polygon_sv = sv.mask_to_polygons(mask_array_instance)
+                # img = np.where(mask_array_instance[i] == True, 255, img)
+                polygon_sv = mask_to_polygons_in_box(mask_array_instance, bbox[i])
+        profiling.count("polygons_per_instance", len(polygon_sv))
 
         if len(polygon_sv) > 0:  # if there is at least one polygon
+            if return_masks and not roi_masks:
+                mask_array_instance = encode_mask(
+                    mask_array_instance, bbox[i], mask_format=mask_format
+                )
             for polygon in polygon_sv:
                 polygon = polygon_prep(
                     polygon,
                     simplify_tolerance=simplify_tolerance,
                     minimum_rotated_rectangle=minimum_rotated_rectangle,
                 )
-                mask_arrays.append(mask_array_instance)
+                if return_masks:
+                    mask_arrays.append(mask_array_instance)
                 labels_list.append(labels[i])
                 bbox_list.append(bbox[i])
 
@@ -166,6 +381,206 @@ def extract_output_annotations(
     return mask_arrays, polygons, bbox_list, labels_list
 
 
+@profiling.traced()
+def extract_output_annotations(
+    output,
+    flatten: bool = False,
+    simplify_tolerance: float = 0.0,
+    minimum_rotated_rectangle: bool = False,
+    mask_resolution: int = 0,
+    return_masks: bool = True,
+    mask_format: str = "full",
+):
+    """Extracts polygons, bounding boxes, and binary masks from prediction
+    ouputs.
+
+    Args:
+        output: Detectron2 prediction output
+        flatten (bool): If true, will flatten polygons, as such used in coco segmentations.
+        simplify_tolerance (float, optional): Tolerance for simplifying polygons. Accepts values between 0.0 and 1.0. Defaults to 0.0.
+        minimum_rotated_rectangle (bool, optional): If true, will return the minimum rotated rectangle of the polygon. Defaults to False.
+        mask_resolution (int, optional): Size ROI masks are resized to before tracing, for outputs predicted without pasting masks. If 0, they are resized to the box size in pixels. Defaults to 0.
+        return_masks (bool, optional): If false, no masks are returned (mask_arrays is empty). Defaults to True.
+        mask_format (str, optional): Representation of the returned masks: "full", "rle" (COCO RLE) or "packbits" (box-cropped and bit-packed). See encode_mask. Defaults to "full".
+
+    Returns:
+        mask_arrays (list): A list of masks in mask_format
+        polygons (list): A list of polygons
+        bbox (list): A list of bounding boxes
+        labels (list): A list of labels
+    """
+    with profiling.span("output_to_arrays"):
+        mask_array, bbox, labels, roi_masks, _ = output_to_arrays(output)
+
+    return extract_mask_annotations(
+        mask_array,
+        bbox,
+        labels,
+        flatten=flatten,
+        simplify_tolerance=simplify_tolerance,
+        minimum_rotated_rectangle=minimum_rotated_rectangle,
+        roi_masks=roi_masks,
+        mask_resolution=mask_resolution,
+        return_masks=return_masks,
+        mask_format=mask_format,
+    )
+
+
+def extract_mask_annotation_store(
+    mask_array,
+    bbox,
+    labels,
+    image_id,
+    scores=None,
+    simplify_tolerance: float = 0.0,
+    minimum_rotated_rectangle: bool = False,
+    roi_masks: bool = False,
+    mask_resolution: int = 0,
+):
+    """Extracts annotations of an array of instance masks into a columnar
+    store.
+
+    Args:
+        mask_array (np.ndarray): A (N, H, W) array of binary instance masks, or a (N, M, M) array of ROI mask probabilities if roi_masks is true
+        bbox (np.ndarray): A (N, 4) array of bounding boxes
+        labels (np.ndarray): A (N,) array of labels
+        image_id (int): an id for the image tile. Usually a unique int
+        scores (np.ndarray, optional): A (N,) array of scores. Defaults to None.
+        simplify_tolerance (float, optional): Tolerance for simplifying polygons. Accepts values between 0.0 and 1.0. Defaults to 0.0.
+        minimum_rotated_rectangle (bool, optional): If true, will return the minimum rotated rectangle of the polygon. Defaults to False.
+        roi_masks (bool, optional): If true, mask_array holds ROI mask probabilities, which are polygonized in box coordinates. Defaults to False.
+        mask_resolution (int, optional): Size ROI masks are resized to before tracing. If 0, they are resized to the box size in pixels. Defaults to 0.
+
+    Returns:
+        AnnotationStore: A store of the annotations
+    """
+    # Pass instance indices as labels, to look up the label and score of
+    # each polygon.
+    _, polygons, _, instances = extract_mask_annotations(
+        mask_array,
+        bbox,
+        np.arange(len(labels)),
+        simplify_tolerance=simplify_tolerance,
+        minimum_rotated_rectangle=minimum_rotated_rectangle,
+        roi_masks=roi_masks,
+        mask_resolution=mask_resolution,
+        return_masks=False,
+    )
+    instances = np.asarray(instances, dtype=int)
+
+    return AnnotationStore.from_polygons(
+        polygons,
+        image_id,
+        np.asarray(labels)[instances],
+        score=None if scores is None else np.asarray(scores)[instances],
+    )
+
+
+def extract_output_annotation_store(
+    output,
+    image_id,
+    simplify_tolerance: float = 0.0,
+    minimum_rotated_rectangle: bool = False,
+    mask_resolution: int = 0,
+):
+    """Extracts annotations of a single prediction output into a columnar
+    store.
+
+    Args:
+        output: Detectron2 prediction output
+        image_id (int): an id for the image tile. Usually a unique int
+        simplify_tolerance (float, optional): Tolerance for simplifying polygons. Accepts values between 0.0 and 1.0. Defaults to 0.0.
+        minimum_rotated_rectangle (bool, optional): If true, will return the minimum rotated rectangle of the polygon. Defaults to False.
+        mask_resolution (int, optional): Size ROI masks are resized to before tracing, for outputs predicted without pasting masks. If 0, they are resized to the box size in pixels. Defaults to 0.
+
+    Returns:
+        AnnotationStore: A store of the annotations
+    """
+    mask_array, bbox, labels, roi_masks, scores = output_to_arrays(output)
+
+    return extract_mask_annotation_store(
+        mask_array,
+        bbox,
+        labels,
+        image_id,
+        scores=scores,
+        simplify_tolerance=simplify_tolerance,
+        minimum_rotated_rectangle=minimum_rotated_rectangle,
+        roi_masks=roi_masks,
+        mask_resolution=mask_resolution,
+    )
+
+
+def extract_mask_annotations_df(
+    mask_array,
+    bbox,
+    labels,
+    image_id,
+    simplify_tolerance: float = 0.0,
+    minimum_rotated_rectangle: bool = False,
+    roi_masks: bool = False,
+    mask_resolution: int = 0,
+):
+    """Extracts annotations of an array of instance masks as a dataframe.
+
+    Args:
+        mask_array (np.ndarray): A (N, H, W) array of binary instance masks, or a (N, M, M) array of ROI mask probabilities if roi_masks is true
+        bbox (np.ndarray): A (N, 4) array of bounding boxes
+        labels (np.ndarray): A (N,) array of labels
+        image_id (int): an id for the image tile. Usually a unique int
+        simplify_tolerance (float, optional): Tolerance for simplifying polygons. Accepts values between 0.0 and 1.0. Defaults to 0.0.
+        minimum_rotated_rectangle (bool, optional): If true, will return the minimum rotated rectangle of the polygon. Defaults to False.
+        roi_masks (bool, optional): If true, mask_array holds ROI mask probabilities, which are polygonized in box coordinates. Defaults to False.
+        mask_resolution (int, optional): Size ROI masks are resized to before tracing. If 0, they are resized to the box size in pixels. Defaults to 0.
+
+    Returns:
+        Pandas.DataFrame: A dataframe of annotations
+    """
+    annotations = extract_mask_annotation_store(
+        mask_array,
+        bbox,
+        labels,
+        image_id,
+        simplify_tolerance=simplify_tolerance,
+        minimum_rotated_rectangle=minimum_rotated_rectangle,
+        roi_masks=roi_masks,
+        mask_resolution=mask_resolution,
+    ).to_pandas(as_lists=True)
+
+    # "annot_id" should be added later
+    return annotations[["pixel_polygon", "image_id", "class_id"]]
+
+
+def extract_output_annotations_df(
+    output,
+    image_id,
+    simplify_tolerance: float = 0.0,
+    minimum_rotated_rectangle: bool = False,
+    mask_resolution: int = 0,
+):
+    """Extracts annotations of a single prediction output as a dataframe.
+
+    Args:
+        output: Detectron2 prediction output
+        image_id (int): an id for the image tile. Usually a unique int
+        simplify_tolerance (float, optional): Tolerance for simplifying polygons. Accepts values between 0.0 and 1.0. Defaults to 0.0.
+        minimum_rotated_rectangle (bool, optional): If true, will return the minimum rotated rectangle of the polygon. Defaults to False.
+        mask_resolution (int, optional): Size ROI masks are resized to before tracing, for outputs predicted without pasting masks. If 0, they are resized to the box size in pixels. Defaults to 0.
+
+    Returns:
+        Pandas.DataFrame: A dataframe of annotations
+    """
+    annotations = extract_output_annotation_store(
+        output,
+        image_id,
+        simplify_tolerance=simplify_tolerance,
+        minimum_rotated_rectangle=minimum_rotated_rectangle,
+        mask_resolution=mask_resolution,
+    ).to_pandas(as_lists=True)
+
+    return annotations[["pixel_polygon", "image_id", "class_id"]]
+
+
 def extract_tile_annotations_df(
     image_path,
     image_id,
@@ -187,56 +602,254 @@ def extract_tile_annotations_df(
     """
     image = cv2.imread(image_path)
     output = predictor(image)
-    _, polygons, _, labels = extract_output_annotations(
+    annotations = extract_output_annotations_df(
         output,
+        image_id,
         simplify_tolerance=simplify_tolerance,
         minimum_rotated_rectangle=minimum_rotated_rectangle,
     )
-    annotations = pd.DataFrame(
-        {"pixel_polygon": polygons, "image_id": image_id, "class_id": labels}
-    )  # "annot_id" should be added later
 
     return annotations
 
 
-def extract_all_annotations_df(
+def predict_images(images: list, predictor):
+    """Predicts a batch of images, in a single forward pass if the predictor
+    supports it.
+
+    Args:
+        images (list): A list of images of shape (H, W, C) (in BGR order)
+        predictor: Detectron2 predictor object. If it has a predict_batch method (e.g. aerialseg.predictors.BatchPredictor), it will be used.
+
+    Returns:
+        list: A list of prediction outputs, one per image
+    """
+    if hasattr(predictor, "predict_batch"):
+        return predictor.predict_batch(images)
+
+    return [predictor(image) for image in images]
+
+
+def predict_arrays(images: list, predictor, cache=None) -> list:
+    """Predicts a batch of images and returns the prediction arrays of each,
+    replaying cached predictions where possible.
+
+    Args:
+        images (list): A list of images of shape (H, W, C) (in BGR order)
+        predictor: Detectron2 predictor object
+        cache (optional): An aerialseg.cache.PredictionCache. Only the images missing from the cache are predicted, and their predictions are added to it. Defaults to None.
+
+    Returns:
+        list: A list of (mask_array, bbox, labels, roi_masks, scores) tuples as returned by output_to_arrays, one per image
+    """
+    if cache is None:
+        with memory.stage("forward"):
+            outputs = predict_images(images, predictor)
+        with memory.stage("mask_transfer"):
+            return [output_to_arrays(output) for output in outputs]
+
+    keys = [cache.key(image) for image in images]
+    arrays = [cache.get(key) for key in keys]
+    missing = [i for i, tile_arrays in enumerate(arrays) if tile_arrays is None]
+    if missing:
+        with memory.stage("forward"):
+            outputs = predict_images([images[i] for i in missing], predictor)
+        with memory.stage("mask_transfer"):
+            for i, output in zip(missing, outputs):
+                arrays[i] = output_to_arrays(output)
+        for i in missing:
+            cache.put(keys[i], arrays[i], images[i].shape)
+
+    return arrays
+
+
+def extract_all_annotations(
     images_list: list,
     predictor,
     simplify_tolerance: float = 0.0,
     minimum_rotated_rectangle: bool = False,
+    batch_size: int = 1,
+    prefetch: int = 0,
+    decode_workers: int = 2,
+    polygonize_workers: int = 0,
+    timings: dict = None,
+    load_fn=cv2.imread,
+    mask_resolution: int = 0,
+    writer=None,
+    cache=None,
 ):
-    """Extract and combine tile annotations into a single dataframe.
+    """Extract and combine tile annotations into a single columnar store.
 
     Args:
-        images_list (list): A list of image paths
+        images_list (list): A list of image paths, or of any items load_fn accepts
         predictor: Detectron2 predictor object
         simplify_tolerance (float, optional): Tolerance for simplifying polygons. Accepts values between 0.0 and 1.0. Defaults to 0.0.
         minimum_rotated_rectangle (bool, optional): If true, will return the minimum rotated rectangle of the polygon. Defaults to False.
+        batch_size (int, optional): Number of tiles to predict in a single forward pass. Requires a predictor with a predict_batch method (e.g. aerialseg.predictors.BatchPredictor), otherwise tiles are predicted one by one. Defaults to 1.
+        prefetch (int, optional): Number of tiles to decode ahead in background threads while the model runs. If 0, tiles are decoded in sequence with the predictions. Defaults to 0.
+        decode_workers (int, optional): Number of threads decoding tiles when prefetch > 0. Defaults to 2.
+        polygonize_workers (int, optional): Number of worker processes polygonizing masks while the model keeps predicting. If 0, masks are polygonized in sequence with the predictions. Defaults to 0.
+        timings (dict, optional): If given, will be filled with the time (seconds) spent in each stage: "decode", "decode_wait", "decode_hidden", "predict" and "postprocess". Defaults to None.
+        load_fn (callable, optional): Function loading an item of images_list as a BGR image, e.g. aerialseg.raster.RasterWindowReader to read raster windows straight into memory. Defaults to cv2.imread.
+        mask_resolution (int, optional): Size ROI masks are resized to before tracing, for predictors that do not paste full-image masks (aerialseg.predictors.BatchPredictor with paste_masks=False). If 0, they are resized to the box size in pixels. Defaults to 0.
+        writer (optional): A writer with add_image and add_annotations methods, e.g. aerialseg.writers.StreamingCocoWriter. If given, tiles and their annotations are written to it as soon as they are ready instead of being collected in memory, and None is returned. Defaults to None.
+        cache (optional): An aerialseg.cache.PredictionCache of raw model outputs. Cached tiles are replayed instead of predicted, and new predictions are added to the cache. The "predict" timing then includes hashing tiles and reading the cache. Defaults to None.
 
     Returns:
-        Pandas.DataFrame: A dataframe of annotations
+        AnnotationStore: A store of annotations, or None if a writer is given
     """
+    assert batch_size >= 1, "batch_size must be at least 1."
+    if batch_size > 1 and not hasattr(predictor, "predict_batch"):
+        warnings.warn(
+            "The predictor does not support batched prediction. Tiles will be predicted one by one."
+        )
+
+    prefetcher = Prefetcher(
+        images_list, load_fn=load_fn, depth=prefetch, num_workers=decode_workers
+    )
+    predict_time = 0.0
+    postprocess_time = 0.0
+
+    if polygonize_workers > 0:
+        polygonizer_context = PolygonizerPool(
+            polygonize_workers,
+            simplify_tolerance=simplify_tolerance,
+            minimum_rotated_rectangle=minimum_rotated_rectangle,
+            mask_resolution=mask_resolution,
+        )
+    else:
+        polygonizer_context = contextlib.nullcontext()
 
     all_annotations = []
-    for image_index, image in tqdm(enumerate(images_list), total=len(images_list)):
-        all_annotations.append(
-            extract_tile_annotations_df(
-                image,
-                image_index,
-                predictor,
-                simplify_tolerance=simplify_tolerance,
-                minimum_rotated_rectangle=minimum_rotated_rectangle,
-            )
+    if writer is not None:
+        # Annotations go straight to the writer instead of being collected.
+        all_annotations = _AnnotationsWriter(writer)
+
+    def polygonize_batch(batch_arrays, image_index):
+        # Polygonizes the tiles of a batch, or hands them to the polygonizer.
+        for mask_array, bbox, labels, roi_masks, scores in batch_arrays:
+            if polygonizer is not None:
+                polygonizer.submit_arrays(
+                    (mask_array, bbox, labels, roi_masks, scores), image_index
+                )
+            else:
+                all_annotations.append(
+                    extract_mask_annotation_store(
+                        mask_array,
+                        bbox,
+                        labels,
+                        image_index,
+                        scores=scores,
+                        simplify_tolerance=simplify_tolerance,
+                        minimum_rotated_rectangle=minimum_rotated_rectangle,
+                        roi_masks=roi_masks,
+                        mask_resolution=mask_resolution,
+                    )
+                )
+            image_index += 1
+        if polygonizer is not None:
+            all_annotations.extend(polygonizer.collect())
+
+        return image_index
+
+    image_index = 0
+    with polygonizer_context as polygonizer, tqdm(total=len(images_list)) as progress:
+        for batch in batched(prefetcher, batch_size):
+            images = [image for _, image in batch]
+            if writer is not None:
+                for offset, (item, image) in enumerate(batch):
+                    writer.add_image(
+                        image_index + offset, tile_file_name(item), *image.shape[:2]
+                    )
+
+            tile_names = [tile_file_name(item) for item, _ in batch]
+            with memory.tile(tile_names) as memory_record:
+                start = time.perf_counter()
+                with profiling.span("predict"), memory.stage("predict"):
+                    batch_arrays = predict_arrays(images, predictor, cache=cache)
+                predict_time += time.perf_counter() - start
+                if memory_record is not None:
+                    memory_record["instances"] = [len(a[2]) for a in batch_arrays]
+
+                start = time.perf_counter()
+                with profiling.span("postprocess"), memory.stage("postprocess"):
+                    image_index = polygonize_batch(batch_arrays, image_index)
+                postprocess_time += time.perf_counter() - start
+            progress.update(len(batch))
+
+        if polygonizer is not None:
+            start = time.perf_counter()
+            with profiling.span("postprocess"):
+                all_annotations.extend(polygonizer.collect(wait=True))
+            postprocess_time += time.perf_counter() - start
+
+    if timings is not None:
+        timings.update(
+            {
+                "decode": prefetcher.decode_time,
+                "decode_wait": prefetcher.wait_time,
+                "decode_hidden": prefetcher.hidden_time,
+                "predict": predict_time,
+                "postprocess": postprocess_time,
+            }
         )
 
-    all_annotations = pd.concat(all_annotations)
-    all_annotations = all_annotations.reset_index(drop=True)
-    all_annotations = all_annotations.reset_index()
-    all_annotations.columns = ["annot_id", "pixel_polygon", "image_id", "class_id"]
+    if writer is not None:
+        return None
+
+    return AnnotationStore.concat(all_annotations)
+
+
+def extract_all_annotations_df(images_list: list, predictor, **kwargs):
+    """Extract and combine tile annotations into a single dataframe.
+
+    Args:
+        images_list (list): A list of image paths, or of any items load_fn accepts
+        predictor: Detectron2 predictor object
+        **kwargs: Any other arguments of extract_all_annotations
+
+    Returns:
+        Pandas.DataFrame: A dataframe of annotations, or None if a writer is given
+    """
+    all_annotations = extract_all_annotations(images_list, predictor, **kwargs)
+    if all_annotations is None:
+        return None
+
+    all_annotations = all_annotations.to_pandas(as_lists=True)
+
+    return all_annotations[["annot_id", "pixel_polygon", "image_id", "class_id"]]
 
-    return all_annotations
 
+class _AnnotationsWriter:
+    """Stands in for the list of tile annotations, passing them on to a
+    writer."""
 
+    def __init__(self, writer):
+        self.writer = writer
+
+    def append(self, annotations):
+        self.writer.add_annotations(annotations)
+
+    def extend(self, annotations_list):
+        for annotations in annotations_list:
+            self.writer.add_annotations(annotations)
+
+
+def tile_file_name(tile) -> str:
+    """Returns the file name of a tile for its COCO image record.
+
+    Args:
+        tile: An image path, or a rasterio window of a raster tile
+
+    Returns:
+        str: The base name of the image path, or "tile_{col}-{row}.png" for a raster window
+    """
+    if isinstance(tile, str):
+        return os.path.basename(tile)
+
+    return f"tile_{int(tile.col_off)}-{int(tile.row_off)}.png"
+
+
+@profiling.traced()
 def assemble_coco_json(
     annotations,
     images,
@@ -248,8 +861,9 @@ def assemble_coco_json(
     """Generate a coco json object.
 
     Args:
-        annotations (Pandas.DataFrame): a dataframe of annotations, usually generated via extract_all_annotations_df function.
-        images (list): a list of image paths
+        annotations (Pandas.DataFrame or AnnotationStore): a dataframe of annotations, usually generated via extract_all_annotations_df function, or a store of annotations generated via extract_all_annotations.
+        images (list): a list of image paths, or a list of COCO image dicts (e.g. from aerialseg.raster.window_image_records)
+        categories (dict, optional): categories keyed by class id, each with a "name" and a "supercategory". Defaults to None.
         license (str): license of the dataset
         info (str): info of the dataset
         type (str, optional): type of the segmentation. Defaults to "instances"
@@ -257,30 +871,53 @@ def assemble_coco_json(
     Returns:
         coco_json: a coco json object
     """
+    if isinstance(annotations, AnnotationStore):
+        with profiling.span("annotations_to_pandas"):
+            with memory.stage("annotations_to_pandas"):
+                annotations = annotations.to_pandas(as_lists=True)
+        annotations = annotations[["annot_id", "pixel_polygon", "image_id", "class_id"]]
+
     coco_json = coco.coco_json()
-    coco_json.images = coco.create_coco_images_object_png(images).images
-    coco_json.annotations = coco.coco_polygon_annotations(
-        annotations
-    )  # [tmp2]#[annots_tmp[0]]#
+    if len(images) > 0 and isinstance(images[0], dict):
+        coco_json.images = list(images)
+    else:
+        coco_json.images = coco.create_coco_images_object_png(images).images
+    with profiling.span("coco_polygon_annotations"):
+        with memory.stage("coco_polygon_annotations"):
+            coco_json.annotations = coco.coco_polygon_annotations(
+                annotations
+            )  # [tmp2]#[annots_tmp[0]]#
     coco_json.license = license
     coco_json.type = type
     coco_json.info = info
+    coco_json.categories = make_coco_categories(
+        annotations.groupby("class_id").groups.keys(), categories=categories
+    )
+
+    return coco_json
+
+
+def make_coco_categories(class_ids, categories: dict = None) -> list:
+    """Generate the coco categories of the predicted classes.
+
+    Args:
+        class_ids (iterable): the class ids found in the annotations
+        categories (dict, optional): categories keyed by class id, each with a "name" and a "supercategory". If None, the class ids are used as names. Defaults to None.
+
+    Returns:
+        list: a list of coco categories
+    """
     if categories is not None:
-        coco_json.categories = [
+        return [
             coco.make_category(
                 class_name=str(categories[cat]["name"]),
                 class_id=cat,
                 supercategory=categories[cat]["supercategory"],
             )
-            for cat in annotations.groupby("class_id").groups.keys()
-        ]
-    else:
-        coco_json.categories = [
-            coco.make_category(class_name=str(cat), class_id=cat)
-            for cat in annotations.groupby("class_id").groups.keys()
+            for cat in class_ids
         ]
 
-    return coco_json
+    return [coco.make_category(class_name=str(cat), class_id=cat) for cat in class_ids]
 
 
 def visualize_or_save_image(image: str, predictor, meta=None, png_out: str = ""):
@@ -296,6 +933,9 @@ def visualize_or_save_image(image: str, predictor, meta=None, png_out: str = "")
     Returns:
         None
     """
+    # Imported here, so the annotation utilities can run without detectron2.
+    from detectron2.utils.visualizer import Visualizer
+
     im = cv2.imread(image)
     # Could serialise the outputs to a file
     outputs = predictor(im)
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+from aerial_conversion import coco
+
+from aerialseg.annotations import AnnotationStore
+from aerialseg.utils import make_coco_categories
+
+
+def _json_default(obj):
+    """Serializes numpy values and coco objects for json.dumps."""
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+
+    return obj.__dict__
+
+
+class StreamingCocoWriter:
+    """Writes a COCO JSON file incrementally, as tiles are predicted.
+
+    Annotations are appended to the output file as soon as they are added,
+    and image records are spooled to a temporary file, so memory use does
+    not grow with the number of tiles or annotations. The JSON arrays are
+    closed and the categories written when the writer is closed. Until then
+    the output is written to a ".part" file next to the final path.
+
+    Args:
+        path (str): Path of the COCO JSON file to write
+        categories (dict, optional): categories keyed by class id, each with a "name" and a "supercategory". If None, the class ids are used as names. Defaults to None.
+        license (str, optional): license of the dataset. Defaults to "".
+        info (str, optional): info of the dataset. Defaults to "".
+        type (str, optional): type of the segmentation. Defaults to "instances".
+    """
+
+    def __init__(
+        self,
+        path: str,
+        categories: dict = None,
+        license: str = "",
+        info: str = "",
+        type: str = "instances",
+    ):
+        self.path = path
+        self.categories = categories
+        self.license = license
+        self.info = info
+        self.type = type
+        self.num_images = 0
+        self.num_annotations = 0
+        self.class_ids = set()
+
+        self._part_path = f"{path}.part"
+        self._file = open(self._part_path, "w")
+        self._file.write('{"annotations": [')
+        self._images_file = tempfile.TemporaryFile(
+            "w+", dir=os.path.dirname(os.path.abspath(path))
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def add_image(self, image_id: int, file_name: str, height: int, width: int):
+        """Writes a COCO image record.
+
+        Args:
+            image_id (int): an id for the image tile. Usually a unique int
+            file_name (str): file name of the image tile
+            height (int): height of the image tile in pixels
+            width (int): width of the image tile in pixels
+        """
+        record = {
+            "id": int(image_id),
+            "file_name": file_name,
+            "height": int(height),
+            "width": int(width),
+        }
+        if self.num_images > 0:
+            self._images_file.write(",")
+        self._images_file.write(json.dumps(record))
+        self.num_images += 1
+
+    def add_annotations(self, annotations):
+        """Writes the annotations of a tile.
+
+        Args:
+            annotations (Pandas.DataFrame or AnnotationStore): a dataframe of annotations with pixel_polygon, image_id and class_id columns, or a store of annotations. Annotation ids are assigned by the writer.
+        """
+        if len(annotations) == 0:
+            return
+
+        if isinstance(annotations, AnnotationStore):
+            annotations = annotations.to_pandas(as_lists=True)
+
+        annotations = annotations[["pixel_polygon", "image_id", "class_id"]].copy()
+        annotations.insert(
+            0,
+            "annot_id",
+            np.arange(self.num_annotations, self.num_annotations + len(annotations)),
+        )
+        for annotation in coco.coco_polygon_annotations(annotations):
+            if self.num_annotations > 0:
+                self._file.write(",")
+            self._file.write(json.dumps(annotation, default=_json_default))
+            self.num_annotations += 1
+        self.class_ids.update(annotations["class_id"].tolist())
+
+    def close(self):
+        """Closes the JSON arrays, writes the categories and moves the file to
+        its final path."""
+        if self._file is None:
+            return
+
+        categories = make_coco_categories(
+            sorted(self.class_ids), categories=self.categories
+        )
+        self._file.write('], "images": [')
+        self._images_file.seek(0)
+        shutil.copyfileobj(self._images_file, self._file)
+        self._file.write("], ")
+        self._file.write(
+            json.dumps(
+                {
+                    "categories": categories,
+                    "license": self.license,
+                    "info": self.info,
+                    "type": self.type,
+                },
+                default=_json_default,
+            )[1:]
+        )
+        self._file.close()
+        self._images_file.close()
+        self._file = None
+        os.replace(self._part_path, self.path)
+
+    def abort(self):
+        """Closes the writer without completing the file, leaving the partial
+        ".part" file for inspection."""
+        if self._file is None:
+            return
+
+        self._file.close()
+        self._images_file.close()
+        self._file = None
@@ -4,34 +4,76 @@
 python scripts/benchmark.py --input-dir demo_data --output-dir
 output_data --config-yaml weights/poc_cfg.yaml --model-weights
 weights/model_final.pth --roi-score-thresh 0.2
+
+python scripts/benchmark.py --sweep --output-dir output_data --config-yaml
+weights/poc_cfg.yaml --model-weights weights/model_final.pth
+--batch-sizes 1 2 4 --thread-counts 1 2 4 --worker-counts 1 2
 """
 import argparse
+import contextlib
+import functools
+import json
 import os
+import platform
+import tempfile
 import time
 
 import cv2
 import numpy as np
+import torch
 from detectron2.config import get_cfg
-from detectron2.engine import DefaultPredictor
-from detectron2.utils.visualizer import ColorMode, Visualizer
-from PIL import Image
+from detectron2.modeling.postprocessing import detector_postprocess
+
+from aerialseg import memory
+from aerialseg.annotations import AnnotationStore
+from aerialseg.export import agreement, latency_stats, timed_predictions
+from aerialseg.predictors import BatchPredictor, create_predictor, roi_postprocess
+from aerialseg.quantization import QuantizedPredictor
+from aerialseg.replicas import extract_all_annotations_replicated
+from aerialseg.utils import (
+    extract_all_annotations,
+    mask_to_polygons_in_box,
+    output_to_arrays,
+    polygon_prep,
+    roi_mask_to_polygons,
+)
+from aerialseg.writers import StreamingCocoWriter
+
+# Stages of the production pipeline, in order.
+STAGES = [
+    "decode",
+    "preprocess",
+    "forward",
+    "mask_transfer",
+    "polygonize",
+    "simplify",
+    "serialize",
+]
+
+PERCENTILES = [50, 95, 99]
 
 
 def parse_arguments():
     parser = argparse.ArgumentParser(
-        description="Segment buildings in images using Detectron2"
+        description="Benchmark each stage of the Detectron2 building segmentation pipeline on a directory of tiles"
     )
     parser.add_argument(
-        "--input-dir", required=True, help="Input directory containing images"
+        "--input-dir",
+        default="demo_data",
+        help="Input directory containing images. Defaults to demo_data",
     )
     parser.add_argument(
-        "--output-dir", required=True, help="Output directory to save annotated images"
+        "--output-dir",
+        required=True,
+        help="Output directory to save the benchmark report and the predicted COCO JSON",
     )
     parser.add_argument(
         "--config-yaml", required=True, help="Path to the Detectron2 config YAML file"
     )
     parser.add_argument(
-        "--model-weights", required=True, help="Path to the model weights file"
+        "--model-weights",
+        required=True,
+        help="Path to the model weights file, or to an exported model with --backend onnx or torchscript",
     )
     parser.add_argument(
         "--roi-score-thresh",
@@ -39,11 +81,239 @@ def parse_arguments():
         default=0.5,
         help="ROI score threshold for detection",
     )
+    parser.add_argument(
+        "--backend",
+        choices=["torch", "onnx", "torchscript"],
+        default="torch",
+        help="Inference backend",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=0,
+        help="Number of CPU threads used for inference. 0 keeps the default of the backend",
+    )
+    parser.add_argument(
+        "--roi-masks",
+        action="store_true",
+        help="Polygonize the ROI masks of the mask head instead of pasting full-image masks",
+    )
+    parser.add_argument(
+        "--roi-mask-resolution",
+        type=int,
+        default=0,
+        help="Size ROI masks are resized to before tracing, with --roi-masks. 0 resizes them to their box size",
+    )
+    parser.add_argument(
+        "--simplify-tolerance",
+        type=float,
+        default=0.0,
+        help="Tolerance for simplifying polygons",
+    )
+    parser.add_argument(
+        "--minimum-rotated-rectangle",
+        action="store_true",
+        help="Replace polygons by their minimum rotated rectangle",
+    )
+    parser.add_argument(
+        "--warmup",
+        type=int,
+        default=3,
+        help="Number of tiles run through the pipeline before timing",
+    )
+    parser.add_argument(
+        "--repeats",
+        type=int,
+        default=1,
+        help="Number of timed passes over the input tiles",
+    )
+    parser.add_argument(
+        "--report",
+        default=None,
+        help="Path of the JSON report. Defaults to benchmark.json in the output directory",
+    )
+    parser.add_argument(
+        "--quantized-weights",
+        default=None,
+        help="Path to the same model quantized by quantize_aerialseg. If given, its speed-up and agreement with the float model are reported",
+    )
+    parser.add_argument(
+        "--memory",
+        action="store_true",
+        help="Also track the peak RSS and the peak Python allocations (tracemalloc) of each stage and timed tile, and report the tiles with the highest peaks. Tracing allocations slows the stages down",
+    )
+    parser.add_argument(
+        "--memory-top-k",
+        type=int,
+        default=10,
+        help="Number of tiles with the highest peak RSS reported with --memory",
+    )
+    parser.add_argument(
+        "--sweep",
+        action="store_true",
+        help="Instead of timing each stage, run the tiles through the pipeline with each combination of --batch-sizes, --thread-counts and --worker-counts, and report the throughput, CPU utilization and peak RSS of each",
+    )
+    parser.add_argument(
+        "--batch-sizes",
+        type=int,
+        nargs="+",
+        default=[1, 2, 4],
+        help="Batch sizes swept with --sweep",
+    )
+    parser.add_argument(
+        "--thread-counts",
+        type=int,
+        nargs="+",
+        default=[1, 2, 4],
+        help="Torch thread counts (per worker process) swept with --sweep",
+    )
+    parser.add_argument(
+        "--worker-counts",
+        type=int,
+        nargs="+",
+        default=[1, 2],
+        help="Numbers of worker processes swept with --sweep. 1 runs in the main process, more run model replicas as with --replicas of the prediction scripts",
+    )
+    parser.add_argument(
+        "--max-cores",
+        type=int,
+        default=None,
+        help="Configurations with more workers times threads than this are skipped by --sweep. Defaults to the number of available cores",
+    )
+    parser.add_argument(
+        "--pin-cores",
+        action="store_true",
+        help="Pin each worker process to its own block of cores with --sweep (Linux only)",
+    )
     return parser.parse_args()
 
 
+class StageTimer:
+    """Records the time spent in each pipeline stage, tile by tile."""
+
+    def __init__(self):
+        self.times = {stage: [] for stage in STAGES}
+        self.totals = []
+        self._tile = None
+
+    def start_tile(self):
+        self._tile = dict.fromkeys(STAGES, 0.0)
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            with memory.stage(name):
+                yield
+        finally:
+            self._tile[name] += time.perf_counter() - start
+
+    def end_tile(self, record: bool = True):
+        if record:
+            for stage, seconds in self._tile.items():
+                self.times[stage].append(seconds)
+            self.totals.append(sum(self._tile.values()))
+        self._tile = None
+
+
+def process_tile(path, image_id, predictor, writer, timer, args):
+    """Runs a tile through each stage of the production pipeline, the way
+    aerialseg.utils.extract_all_annotations does with a streaming writer."""
+    with timer.stage("decode"):
+        image = cv2.imread(path)
+    height, width = image.shape[:2]
+
+    if isinstance(predictor, BatchPredictor):
+        with timer.stage("preprocess"):
+            inputs = predictor.prepare_input(image)
+        with timer.stage("forward"):
+            results = predictor.model.inference([inputs], do_postprocess=False)[0]
+        with timer.stage("mask_transfer"):
+            # Pasting the ROI masks, or rescaling them, then copying to numpy.
+            if args.roi_masks:
+                instances = roi_postprocess(results, height, width)
+            else:
+                instances = detector_postprocess(results, height, width)
+            arrays = output_to_arrays({"instances": instances})
+    else:
+        with timer.stage("preprocess"):
+            model_input, image_size = predictor.prepare_input(image)
+        with timer.stage("forward"):
+            outputs = predictor.run(model_input)
+        with timer.stage("mask_transfer"):
+            instances = predictor.postprocess_outputs(
+                outputs, image_size, height, width
+            )
+            arrays = output_to_arrays({"instances": instances})
+    mask_array, bbox, labels, roi_masks, scores = arrays
+
+    # The steps of extract_mask_annotations, split so that tracing and
+    # polygon_prep (which runs once per polygon, simplifying or not) are
+    # timed separately.
+    with timer.stage("polygonize"):
+        traced, indices = [], []
+        if not roi_masks:
+            mask_array = np.moveaxis(mask_array, 0, -1)
+        for i in range(len(labels)):
+            if roi_masks:
+                instance_polygons = roi_mask_to_polygons(
+                    mask_array[i], bbox[i], resolution=args.roi_mask_resolution
+                )
+            else:
+                instance_polygons = mask_to_polygons_in_box(
+                    mask_array[:, :, i : (i + 1)], bbox[i]
+                )
+            traced.extend(instance_polygons)
+            indices.extend([i] * len(instance_polygons))
+    with timer.stage("simplify"):
+        polygons = [
+            polygon_prep(
+                polygon,
+                simplify_tolerance=args.simplify_tolerance,
+                minimum_rotated_rectangle=args.minimum_rotated_rectangle,
+            ).tolist()
+            for polygon in traced
+        ]
+    with timer.stage("serialize"):
+        indices = np.asarray(indices, dtype=int)
+        annotations = AnnotationStore.from_polygons(
+            polygons, image_id, labels[indices], score=scores[indices]
+        )
+        writer.add_image(image_id, os.path.basename(path), height, width)
+        writer.add_annotations(annotations)
+
+    return len(annotations), len(labels)
+
+
+def percentile_stats(seconds: list) -> dict:
+    """Returns the total (s), mean and percentile latencies (ms) of a stage."""
+    milliseconds = 1000 * np.asarray(seconds)
+    stats = {
+        "total_s": float(np.sum(seconds)),
+        "mean_ms": float(np.mean(milliseconds)),
+    }
+    for percentile in PERCENTILES:
+        stats[f"p{percentile}_ms"] = float(np.percentile(milliseconds, percentile))
+
+    return stats
+
+
+def environment() -> dict:
+    """Returns the software and hardware the benchmark ran on."""
+    return {
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "torch_threads": torch.get_num_threads(),
+        "cpu_count": os.cpu_count(),
+        "available_cores": len(os.sched_getaffinity(0)),
+    }
+
+
 def main():
     args = parse_arguments()
+    assert (
+        args.quantized_weights is None or args.backend == "torch"
+    ), "--quantized-weights is compared with the float model of the torch backend."
 
     # Set up Detectron2 configuration and model
     cfg = get_cfg()
@@ -52,61 +322,268 @@ def main():
     cfg.MODEL.ROI_HEADS.SCORE_THRESH_TEST = args.roi_score_thresh
     # cfg.MODEL.ROI_HEADS.NUM_CLASSES = 8
     cfg.MODEL.DEVICE = "cpu"
-    predictor = DefaultPredictor(cfg)
 
     os.makedirs(args.output_dir, exist_ok=True)
-    iteration_time_sum = 0.0
-    io_time_sum = 0.0
-    predict_time_sum = 0.0
-    total_images = 0
-
-    for filename in os.listdir(args.input_dir):
-        if (
-            filename.endswith(".jpg")
-            or filename.endswith(".png")
-            or filename.endswith(".tif")
-        ):
-            input_path = os.path.join(args.input_dir, filename)
-            output_path = os.path.join(args.output_dir, filename)
-
-            start_time = time.time()
-            im = cv2.imread(input_path)
-            after_read_time = time.time()
-            annotated_im = segment_buildings(im, predictor)
-            after_predict_time = time.time()
-            annotated_im.save(output_path)
-            end_time = time.time()
-
-            read_time = after_read_time - start_time
-            predict_time = after_predict_time - after_read_time
-            write_time = end_time - after_predict_time
-            iteration_time = end_time - start_time
-            iteration_time_sum += iteration_time
-            io_time_sum += read_time + write_time
-            predict_time_sum += predict_time
-            print(
-                f"Processed: {filename} | "
-                f"Read+Write time: {read_time + write_time:.2f} s | "
-                f"Predict time: {predict_time:.2f} s | "
-                f"Total time: {iteration_time:.2f} s"
-            )
-            total_images += 1
+    paths = [
+        os.path.join(args.input_dir, filename)
+        for filename in sorted(os.listdir(args.input_dir))
+        if filename.endswith((".jpg", ".png", ".tif"))
+    ]
+    assert len(paths) > 0, f"No images found in {args.input_dir}."
+
+    if args.sweep:
+        sweep(cfg, paths, args)
+        return
+
+    predictor = create_predictor(
+        cfg,
+        backend=args.backend,
+        paste_masks=not args.roi_masks,
+        num_threads=args.threads,
+    )
+
+    timer = StageTimer()
+    coco_out = os.path.join(args.output_dir, "benchmark-coco.json")
+    num_annotations = 0
+    with torch.inference_mode(), StreamingCocoWriter(coco_out) as writer:
+        # Warm-up tiles are written to a throwaway file, so only the timed
+        # tiles are saved.
+        with tempfile.TemporaryDirectory() as warmup_dir, StreamingCocoWriter(
+            os.path.join(warmup_dir, "warmup-coco.json")
+        ) as warmup_writer:
+            for i in range(args.warmup):
+                timer.start_tile()
+                path = paths[i % len(paths)]
+                process_tile(path, i, predictor, warmup_writer, timer, args)
+                timer.end_tile(record=False)
+
+        image_id = 0
+        if args.memory:
+            # Warm-up tiles are not tracked.
+            memory.enable(top_k=args.memory_top_k)
+        start = time.perf_counter()
+        for _ in range(args.repeats):
+            for path in paths:
+                timer.start_tile()
+                with memory.tile([os.path.basename(path)]) as memory_record:
+                    tile_annotations, tile_instances = process_tile(
+                        path, image_id, predictor, writer, timer, args
+                    )
+                if memory_record is not None:
+                    memory_record["instances"] = [tile_instances]
+                num_annotations += tile_annotations
+                timer.end_tile()
+                image_id += 1
+        wall_time = time.perf_counter() - start
+
+        # Closing the writer assembles the COCO JSON.
+        start = time.perf_counter()
+        writer.close()
+        close_time = time.perf_counter() - start
+
+    num_tiles = len(timer.totals)
+    stages = {stage: percentile_stats(timer.times[stage]) for stage in STAGES}
+    stages["serialize"]["close_s"] = close_time
+    report = {
+        "config": vars(args),
+        "environment": environment(),
+        "tiles": num_tiles,
+        "annotations": num_annotations,
+        "wall_s": wall_time,
+        "tiles_per_s": num_tiles / wall_time,
+        "tile": percentile_stats(timer.totals),
+        "stages": stages,
+    }
 
     # Calculate and print performance benchmarks
-    print("\nPerformance Benchmarks:")
-    print(f"Total Images Processed: {total_images}")
-    print(f"Average Read/Write Time: {io_time_sum / total_images:.2f} s")
-    print(f"Average Predict Time: {predict_time_sum / total_images:.2f} s")
-    print(f"Average Iteration Time: {iteration_time_sum / total_images:.2f} s")
-
-
-def segment_buildings(im, predictor):
-    im = np.array(im)
-    outputs = predictor(im)
-    v = Visualizer(im[:, :, ::-1], scale=0.5, instance_mode=ColorMode.IMAGE_BW)
-    print(len(outputs["instances"]), "buildings detected.")
-    out = v.draw_instance_predictions(outputs["instances"].to("cpu"))
-    return Image.fromarray(out.get_image()[:, :, ::-1])
+    print(f"\nPerformance Benchmarks ({num_tiles} tiles, {args.warmup} warm-up):")
+    header = "".join(f"{'p' + str(p) + ' ms':>10}" for p in PERCENTILES)
+    print(f"{'Stage':<14}{'Total s':>10}{'Share':>8}{header}")
+    total_time = sum(stats["total_s"] for stats in stages.values())
+    for stage, stats in list(stages.items()) + [("tile", report["tile"])]:
+        share = stats["total_s"] / total_time if total_time else 0.0
+        print(
+            f"{stage:<14}{stats['total_s']:>10.2f}{share:>8.1%}"
+            + "".join(f"{stats[f'p{p}_ms']:>10.1f}" for p in PERCENTILES)
+        )
+    print(f"Throughput: {report['tiles_per_s']:.2f} tiles/s")
+    if args.memory:
+        tracker = memory.get_tracker()
+        report["memory"] = tracker.summary()
+        print(f"\nMemory:\n{tracker.format_summary()}")
+        memory.disable()
+
+    if args.quantized_weights is not None:
+        report["quantized"] = compare_quantized(
+            cfg, args.quantized_weights, [cv2.imread(path) for path in paths]
+        )
+
+    report_path = args.report or os.path.join(args.output_dir, "benchmark.json")
+    with open(report_path, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Report written to {report_path}")
+
+
+def run_configuration(cfg, paths, args, batch_size, threads, workers) -> dict:
+    """Runs the tiles through the production pipeline with a batch size,
+    thread count and number of worker processes, and returns its
+    throughput, CPU utilization and peak RSS."""
+    predictor_factory = functools.partial(
+        create_predictor,
+        cfg,
+        backend=args.backend,
+        paste_masks=not args.roi_masks,
+        num_threads=threads,
+    )
+    options = {
+        "simplify_tolerance": args.simplify_tolerance,
+        "minimum_rotated_rectangle": args.minimum_rotated_rectangle,
+        "batch_size": batch_size,
+        "mask_resolution": args.roi_mask_resolution,
+    }
+    tiles = paths * args.repeats
+
+    cpu_start = os.times()
+    with memory.RssSampler() as rss:
+        start = time.perf_counter()
+        if workers > 1:
+            timings = {}
+            store = extract_all_annotations_replicated(
+                tiles,
+                predictor_factory,
+                num_replicas=workers,
+                threads_per_replica=threads,
+                pin_cores=args.pin_cores,
+                timings=timings,
+                **options,
+            )
+            # The first batch came back once the workers were up; the rest
+            # of the tiles ran at the steady rate.
+            startup = timings["startup"]
+            steady_tiles = max(len(tiles) - batch_size, 0)
+        else:
+            cv2.setNumThreads(threads)
+            predictor = predictor_factory()
+            startup = time.perf_counter() - start
+            steady_tiles = len(tiles)
+            with torch.inference_mode():
+                store = extract_all_annotations(tiles, predictor, **options)
+        wall_time = time.perf_counter() - start
+    cpu_end = os.times()
+
+    # User and system time of this process and of its finished workers.
+    cpu_time = sum(cpu_end[:4]) - sum(cpu_start[:4])
+    steady_time = wall_time - startup
+    return {
+        "batch_size": batch_size,
+        "threads": threads,
+        "workers": workers,
+        "tiles": len(tiles),
+        "annotations": len(store),
+        "wall_s": wall_time,
+        "startup_s": startup,
+        "tiles_per_s": len(tiles) / wall_time,
+        "steady_tiles_per_s": (
+            steady_tiles / steady_time if steady_tiles and steady_time > 0 else None
+        ),
+        "cpu_s": cpu_time,
+        "cpu_utilization": cpu_time / (wall_time * len(os.sched_getaffinity(0))),
+        "peak_rss_mb": rss.peak / 2**20,
+    }
+
+
+def sweep(cfg, paths, args):
+    """Runs each combination of batch size, thread count and number of
+    worker processes, then prints and writes the scaling curve and the
+    configuration with the highest throughput."""
+    max_cores = args.max_cores or len(os.sched_getaffinity(0))
+    results = []
+    skipped = []
+    for workers in args.worker_counts:
+        for threads in args.thread_counts:
+            for batch_size in args.batch_sizes:
+                configuration = {
+                    "batch_size": batch_size,
+                    "threads": threads,
+                    "workers": workers,
+                }
+                if workers * threads > max_cores:
+                    skipped.append(configuration)
+                    continue
+                print(f"\nRunning {configuration}")
+                results.append(
+                    run_configuration(cfg, paths, args, batch_size, threads, workers)
+                )
+    assert results, f"All configurations need more than {max_cores} cores."
+
+    def throughput(result):
+        # Start-up is paid once per job, so configurations are ranked on
+        # their steady throughput when it could be measured.
+        return result["steady_tiles_per_s"] or result["tiles_per_s"]
+
+    best = max(results, key=throughput)
+
+    print(f"\nThroughput Scaling ({len(paths) * args.repeats} tiles per run):")
+    print(
+        f"{'Workers':>8}{'Threads':>8}{'Batch':>7}{'Tiles/s':>10}"
+        f"{'Steady':>10}{'Start s':>9}{'CPU':>7}{'RSS MB':>9}"
+    )
+    for result in results:
+        steady = result["steady_tiles_per_s"]
+        print(
+            f"{result['workers']:>8}{result['threads']:>8}{result['batch_size']:>7}"
+            f"{result['tiles_per_s']:>10.2f}"
+            + (f"{steady:>10.2f}" if steady is not None else f"{'-':>10}")
+            + f"{result['startup_s']:>9.1f}{result['cpu_utilization']:>7.0%}"
+            f"{result['peak_rss_mb']:>9.0f}"
+            + (" *" if result is best else "")
+        )
+    if skipped:
+        print(
+            f"Skipped {len(skipped)} configurations needing more than "
+            f"{max_cores} cores"
+        )
+    print(
+        f"Best: {best['workers']} workers x {best['threads']} threads, "
+        f"batch size {best['batch_size']}: {throughput(best):.2f} tiles/s"
+    )
+
+    report = {
+        "config": vars(args),
+        "environment": environment(),
+        "results": results,
+        "skipped": skipped,
+        "best": best,
+    }
+    report_path = args.report or os.path.join(args.output_dir, "benchmark-sweep.json")
+    with open(report_path, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Report written to {report_path}")
+
+
+def compare_quantized(cfg, quantized_weights, images):
+    """Prints and returns the speed-up of a quantized model over the float
+    model, and the agreement of their predictions."""
+    float_predictor = BatchPredictor(cfg)
+    quantized_cfg = cfg.clone()
+    quantized_cfg.MODEL.WEIGHTS = quantized_weights
+    quantized_predictor = QuantizedPredictor(quantized_cfg)
+
+    reference, float_latencies = timed_predictions(float_predictor, images)
+    predictions, latencies = timed_predictions(quantized_predictor, images)
+    float_stats = latency_stats(float_latencies)
+    stats = {**latency_stats(latencies), **agreement(reference, predictions)}
+    stats["speedup"] = float_stats["latency_median_ms"] / stats["latency_median_ms"]
+
+    print("\nQuantized Model:")
+    print(f"Float Median Predict Time: {float_stats['latency_median_ms']:.1f} ms")
+    print(f"Quantized Median Predict Time: {stats['latency_median_ms']:.1f} ms")
+    print(f"Speed-up: {stats['speedup']:.2f}x")
+    print(f"Instances Matched: {stats['matched_fraction']:.1%}")
+    print(f"Mean Box IoU: {stats['box_iou']:.3f}")
+    print(f"Mean Mask IoU: {stats['mask_iou']:.3f}")
+
+    return stats
 
 
 if __name__ == "__main__":
@@ -1,10 +1,18 @@
 # -*- coding: utf-8 -*-
 import argparse
+import functools
 import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
 
 import geopandas as gpd
 import numpy as np
-from shapely.geometry import Polygon
+import pandas as pd
+import pyogrio
+import rasterio as rio
+import shapely
+from rasterio import features
+from rasterio.transform import from_origin
 from tqdm import tqdm
 
 # set up logging
@@ -217,6 +225,408 @@ def density_estimate_area_area(
     return density
 
 
+def cell_polygons(x_coords, y_coords, tile_size: float):
+    """Creates the square cells of a grid from the coordinates of their lower
+    left corners, column by column.
+
+    Args:
+        x_coords (np.ndarray): The minimum x of each column of cells
+        y_coords (np.ndarray): The minimum y of each row of cells
+        tile_size (float): The size of the cells
+
+    Returns:
+        cells (np.ndarray): An array of shapely polygons, the cells of each x before the next x, from the bottom up
+    """
+    x = np.repeat(x_coords, len(y_coords))
+    y = np.tile(y_coords, len(x_coords))
+    corners = np.stack(
+        [
+            np.stack([x, y], axis=-1),
+            np.stack([x + tile_size, y], axis=-1),
+            np.stack([x + tile_size, y + tile_size], axis=-1),
+            np.stack([x, y + tile_size], axis=-1),
+        ],
+        axis=1,
+    )
+
+    return shapely.polygons(corners)
+
+
+def grid_cells(
+    x_min: float, y_min: float, x_max: float, y_max: float, tile_size: float
+):
+    """Creates the square cells of a grid over an extent, column by column.
+
+    Args:
+        x_min (float): Minimum x of the extent
+        y_min (float): Minimum y of the extent
+        x_max (float): Maximum x of the extent
+        y_max (float): Maximum y of the extent
+        tile_size (float): The size of the cells
+
+    Returns:
+        cells (np.ndarray): An array of shapely polygons, the cells of each x before the next x, from the bottom up
+    """
+    return cell_polygons(
+        np.arange(x_min, x_max, tile_size),
+        np.arange(y_min, y_max, tile_size),
+        tile_size,
+    )
+
+
+def cell_average_storeys(
+    storeys, cell_index, num_cells: int, storey_column: str = "storeys"
+):
+    """Gets the average number of storeys of the buildings in each grid cell,
+    as storey_averager does for the buildings clipped to a single cell.
+
+    Args:
+        storeys (pd.Series): The storeys of each clipped building part, in the order of the parts within each cell. None if the annotations have no storeys column.
+        cell_index (np.ndarray): The grid cell of each clipped building part
+        num_cells (int): The number of grid cells
+        storey_column (str): The column name of the storey information, for the warning. Defaults to "storeys".
+
+    Returns:
+        average_storeys (np.ndarray): The average number of storeys of each cell
+    """
+    if storeys is None:
+        logger.warning(
+            f"No {storey_column} column found in the annotation geodataframe. Will assume that all buildings have 1 storey."
+        )
+        return np.ones(num_cells)
+
+    # storey_averager leaves out the last building part with no storeys,
+    # and falls back to 1 storey if there is none.
+    missing = np.flatnonzero(storeys.eq("None") | storeys.eq("0") | storeys.eq(0))
+    last_missing = np.full(num_cells, -1)
+    np.maximum.at(last_missing, cell_index[missing], missing)
+    has_missing = last_missing >= 0
+    keep = np.ones(len(storeys), dtype=bool)
+    keep[last_missing[has_missing]] = False
+
+    values = pd.to_numeric(storeys, errors="coerce").to_numpy(dtype=float)
+    keep &= ~np.isnan(values)
+    totals = np.bincount(cell_index[keep], weights=values[keep], minlength=num_cells)
+    counts = np.bincount(cell_index[keep], minlength=num_cells)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        average_storeys = np.where(has_missing, totals / counts, 1.0)
+    if not has_missing.all():
+        logger.warning(
+            f"No buildings without storeys found in {np.sum(~has_missing)} grid cells. Will assume that their buildings have 1 storey."
+        )
+
+    return average_storeys
+
+
+def cell_densities(
+    gdf: gpd.GeoDataFrame,
+    cells,
+    area: float,
+    crs=None,
+    average_storeys: int = None,
+    footprint_ratio: float = 0.5,
+    storey_column: str = "storeys",
+):
+    """Gets the combined density of each grid cell, as
+    density_estimate_combined_area does for the buildings clipped to a
+    single cell, for all cells at once.
+
+    The buildings intersecting each cell are found with a single bulk query
+    of the spatial index, clipped to their cells and split into parts; the
+    parts are then counted and their areas summed per cell.
+
+    Args:
+        gdf (geodataframe): A geodataframe of annotations, in the crs of the cells.
+        cells (np.ndarray): An array of shapely polygons, the grid cells.
+        area (float): The area the densities are normalised by.
+        crs (str): The crs the footprint areas are calculated in, as for density_estimate_combined_area. If None, will use 'EPSG:3857'. Defaults to None.
+        average_storeys (int): The average number of storeys of buildings in the annotation geodataframe. If None, will calculate the average number of storeys of each cell using the meta data. Defaults to None.
+        footprint_ratio (float): The ratio of the footprint-area-based density to number-based density calculations. Defaults to 0.5.
+        storey_column (str): The column name of the storey information. Defaults to "storeys".
+
+    Returns:
+        density (np.ndarray): The combined density of each cell.
+    """
+    assert (
+        footprint_ratio >= 0 and footprint_ratio <= 1
+    ), "footprint_ratio must be between 0 and 1"
+    num_cells = len(cells)
+
+    # The same masks gdf.clip used for each cell.
+    masks = shapely.union_all(shapely.buffer(cells, 0)[:, np.newaxis], axis=1)
+    cell_index, building_index = gdf.sindex.query(masks, predicate="intersects")
+    # Within a cell, buildings keep the order of a query of the cell alone,
+    # so the areas are summed in the same order.
+    order = np.argsort(cell_index, kind="stable")
+    cell_index = cell_index[order]
+    building_index = building_index[order]
+
+    clipped = shapely.intersection(
+        np.asarray(gdf.geometry.array)[building_index], masks[cell_index]
+    )
+    parts, part_index = shapely.get_parts(clipped, return_index=True)
+    part_cells = cell_index[part_index]
+    part_buildings = building_index[part_index]
+
+    if crs is None:
+        crs = "EPSG:3857"
+    if gdf.crs != crs:
+        part_areas = gpd.GeoSeries(parts, crs=gdf.crs).to_crs(crs).area.to_numpy()
+    else:
+        part_areas = shapely.area(parts)
+    number = np.bincount(part_cells, minlength=num_cells)
+    footprint_area = np.bincount(part_cells, weights=part_areas, minlength=num_cells)
+
+    if average_storeys is None:
+        if storey_column in gdf.columns:
+            storeys = gdf[storey_column].iloc[part_buildings].reset_index(drop=True)
+        else:
+            storeys = None
+        average_storeys = cell_average_storeys(
+            storeys, part_cells, num_cells, storey_column
+        )
+    elif average_storeys == 0:
+        average_storeys = 1
+        logger.warning(
+            "Average storeys cannot be 0. Will assume that all buildings have 1 storey."
+        )
+    else:
+        average_storeys = int(average_storeys)
+
+    density_area = (footprint_area * average_storeys) / area
+    density_number = (number * average_storeys) / area
+
+    return (
+        density_area * footprint_ratio + density_number * (1 - footprint_ratio)
+    ) / 2
+
+
+def density_raster(
+    gdf: gpd.GeoDataFrame,
+    bounds,
+    tile_size: float,
+    area: float,
+    average_storeys: int = None,
+    footprint_ratio: float = 0.5,
+    storey_column: str = "storeys",
+    supersample: int = 4,
+    block_rows: int = 256,
+    shape: tuple = None,
+):
+    """Gets the combined density of each cell of a grid straight into an
+    array, without creating a polygon for each cell.
+
+    Footprint areas are estimated by rasterizing the buildings at supersample
+    times the grid resolution and summing the covered subpixels of each cell.
+    Buildings are counted in the cell their centroid falls in. The grid is
+    rasterized in strips of block_rows rows, so the memory used by the
+    supersampled raster does not grow with the grid.
+
+    Args:
+        gdf (geodataframe): A geodataframe of annotations, in a projected crs. Areas are calculated in the units of its crs.
+        bounds (tuple): The (x_min, y_min, x_max, y_max) extent of the grid.
+        tile_size (float): The size of the cells.
+        area (float): The area the densities are normalised by.
+        average_storeys (int): The average number of storeys of buildings in the annotation geodataframe. If None, will calculate the average number of storeys of each cell using the meta data. Defaults to None.
+        footprint_ratio (float): The ratio of the footprint-area-based density to number-based density calculations. Defaults to 0.5.
+        storey_column (str): The column name of the storey information. Defaults to "storeys".
+        supersample (int): The number of subpixels along each side of a cell used to estimate the footprint areas. Defaults to 4.
+        block_rows (int): The number of grid rows rasterized at once. Defaults to 256.
+        shape (tuple): The (rows, columns) of the grid. If None, will use the cells covering bounds. Defaults to None.
+
+    Returns:
+        density (np.ndarray): The (rows, columns) combined densities, from the top row down.
+        transform (affine.Affine): The affine transform of the grid.
+    """
+    assert (
+        footprint_ratio >= 0 and footprint_ratio <= 1
+    ), "footprint_ratio must be between 0 and 1"
+    assert supersample >= 1, "supersample must be at least 1."
+    assert block_rows >= 1, "block_rows must be at least 1."
+
+    x_min, y_min, x_max, y_max = bounds
+    if shape is None:
+        rows = len(np.arange(y_min, y_max, tile_size))
+        columns = len(np.arange(x_min, x_max, tile_size))
+    else:
+        rows, columns = shape
+    num_cells = rows * columns
+    y_top = y_min + rows * tile_size
+    transform = from_origin(x_min, y_top, tile_size, tile_size)
+
+    # Count each building in the cell its centroid falls in, leaving out
+    # buildings centred outside the grid.
+    centroids = shapely.centroid(np.asarray(gdf.geometry.array))
+    column = np.floor((shapely.get_x(centroids) - x_min) / tile_size).astype(int)
+    row = np.floor((y_top - shapely.get_y(centroids)) / tile_size).astype(int)
+    inside = np.flatnonzero(
+        (column >= 0) & (column < columns) & (row >= 0) & (row < rows)
+    )
+    cell_index = row[inside] * columns + column[inside]
+    number = np.bincount(cell_index, minlength=num_cells)
+
+    subpixel = tile_size / supersample
+    footprint_area = np.zeros((rows, columns))
+    geometries = np.asarray(gdf.geometry.array)
+    for top in range(0, rows, block_rows):
+        strip_rows = min(block_rows, rows - top)
+        strip_top = y_top - top * tile_size
+        strip = shapely.box(
+            x_min,
+            strip_top - strip_rows * tile_size,
+            x_min + columns * tile_size,
+            strip_top,
+        )
+        shapes = geometries[gdf.sindex.query(strip, predicate="intersects")]
+        if len(shapes) == 0:
+            continue
+        coverage = features.rasterize(
+            shapes,
+            out_shape=(strip_rows * supersample, columns * supersample),
+            transform=from_origin(x_min, strip_top, subpixel, subpixel),
+            fill=0,
+            default_value=1,
+            dtype="uint16",
+            merge_alg=features.MergeAlg.add,
+        )
+        footprint_area[top : top + strip_rows] = (
+            coverage.reshape(strip_rows, supersample, columns, supersample).sum(
+                axis=(1, 3)
+            )
+            * subpixel**2
+        )
+
+    if average_storeys is None:
+        if storey_column in gdf.columns:
+            order = np.argsort(cell_index, kind="stable")
+            storeys = gdf[storey_column].iloc[inside[order]].reset_index(drop=True)
+            average_storeys = cell_average_storeys(
+                storeys, cell_index[order], num_cells, storey_column
+            ).reshape(rows, columns)
+        else:
+            average_storeys = cell_average_storeys(
+                None, cell_index, num_cells, storey_column
+            ).reshape(rows, columns)
+    elif average_storeys == 0:
+        average_storeys = 1
+        logger.warning(
+            "Average storeys cannot be 0. Will assume that all buildings have 1 storey."
+        )
+    else:
+        average_storeys = int(average_storeys)
+
+    density_area = (footprint_area * average_storeys) / area
+    density_number = (number.reshape(rows, columns) * average_storeys) / area
+    density = (
+        density_area * footprint_ratio + density_number * (1 - footprint_ratio)
+    ) / 2
+
+    return density, transform
+
+
+def write_density_raster(density, transform, crs, output_path: str):
+    """Saves a density grid as a tiled, compressed single band GeoTIFF.
+
+    Args:
+        density (np.ndarray): The (rows, columns) densities, from the top row down.
+        transform (affine.Affine): The affine transform of the grid.
+        crs: The crs of the grid.
+        output_path (str): The path to save the GeoTIFF.
+    """
+    rows, columns = density.shape
+    profile = {
+        "driver": "GTiff",
+        "width": columns,
+        "height": rows,
+        "count": 1,
+        "dtype": "float32",
+        "crs": crs,
+        "transform": transform,
+        "tiled": True,
+        "blockxsize": 256,
+        "blockysize": 256,
+        "compress": "deflate",
+        "predictor": 3,
+        "BIGTIFF": "IF_SAFER",
+    }
+    with rio.open(output_path, "w", **profile) as raster:
+        raster.write(density.astype(np.float32), 1)
+        raster.set_band_description(1, "density")
+
+
+def grid_scale(bounds, tile_size: float = 100, size_unit: str = None):
+    """Gets the cell size of the density grid over an extent, and the area
+    the densities are normalised by.
+
+    Args:
+        bounds (np.ndarray): The (x_min, y_min, x_max, y_max) extent of the grid.
+        tile_size (float): The size of the tile. Defaults to 100.
+        size_unit (str): The unit of the tile size. If is None, will use the unit of the crs of the extent. If set to 'percent', will use the percentage of the width of the extent. Defaults to None.
+
+    Returns:
+        tile_size (float): The size of the cells, in the units of the crs of the extent.
+        area (float): The area the densities are normalised by.
+    """
+    width = abs(bounds[2] - bounds[0])
+    area = width * width
+
+    # Get the tile size
+    if size_unit == "percent":
+        tile_size = width * tile_size / 100
+    elif size_unit is None:
+        pass
+    else:
+        logger.warning("size_unit must be 'percent' or None. Will assume None.")
+
+    assert tile_size > 0, "tile_size must be greater than 0."
+
+    return tile_size, area
+
+
+def prepare_annotations(
+    gdf: gpd.GeoDataFrame,
+    tile_size: float = 100,
+    size_unit: str = None,
+    area_unit: str = "utm",
+):
+    """Reprojects the annotations for the density calculations, and gets the
+    grid extent, cell size and normalising area.
+
+    Args:
+        gdf (geodataframe): A geodataframe of annotations.
+        tile_size (float): The size of the tile. Defaults to 100.
+        size_unit (str): The unit of the tile size. If is None, will use the unit of the crs of the gdf or from 'area_unit'. If set to 'percent', will use the percentage of the width of the gdf bounds. Defaults to None.
+        area_unit (str): The unit of the area. Defaults to "utm".
+
+    Returns:
+        gdf (geodataframe): The annotations with an area, made valid, in the crs of the grid.
+        crs: The crs the areas are calculated in, for density_estimate_combined_area.
+        bounds (np.ndarray): The (x_min, y_min, x_max, y_max) extent of the grid.
+        tile_size (float): The size of the cells, in the units of the crs of the grid.
+        area (float): The area the densities are normalised by.
+    """
+    if area_unit == "meter":
+        crs = 3857
+        gdf = gdf.to_crs(epsg=crs)
+    elif area_unit == "utm":
+        crs = gdf.estimate_utm_crs()
+        gdf = gdf.to_crs(crs)
+    elif area_unit is None:
+        crs = None
+    else:
+        logger.warning("area_unit must be 'meter', 'utm', or None.")
+
+    # Get the bounds of the gdf
+    bounds = gdf.total_bounds
+    tile_size, area = grid_scale(bounds, tile_size, size_unit)
+
+    gdf = gdf[gdf.geometry.area > 0]
+    gdf = gdf.reset_index(drop=True)
+    gdf["geometry"] = gdf["geometry"].buffer(0)
+
+    return gdf, crs, bounds, tile_size, area
+
+
 def density_map_maker(
     gdf: gpd.GeoDataFrame,
     average_storeys: int = None,
@@ -241,93 +651,319 @@ def density_map_maker(
         grid (geodataframe): A geodataframe of the density map.
     """
 
-    # Prepare the gdf
+    gdf, crs, bounds, tile_size, area = prepare_annotations(
+        gdf, tile_size=tile_size, size_unit=size_unit, area_unit=area_unit
+    )
+
+    # Create the grid
+    cells = grid_cells(*bounds, tile_size)
+    grid = gpd.GeoDataFrame({"geometry": cells}, crs=gdf.crs)
+
+    logger.info(
+        f"Created a grid of {grid.shape[0]} tiles. Now getting the grid densities..."
+    )
+    # Get the density for each tile
+    grid["density"] = cell_densities(
+        gdf,
+        cells,
+        area,
+        crs=crs,
+        average_storeys=average_storeys,
+        footprint_ratio=footprint_ratio,
+        storey_column=storey_column,
+    )
+
+    return grid
+
+
+def density_raster_maker(
+    gdf: gpd.GeoDataFrame,
+    average_storeys: int = None,
+    footprint_ratio: float = 0.5,
+    tile_size: int = 100,
+    size_unit: str = None,
+    area_unit: str = "utm",
+    storey_column: str = "storeys",
+    supersample: int = 4,
+):
+    """This function will use the density_raster function to create a density
+    map as a raster, with a pixel for each tile.
+
+    Args:
+        gdf (geodataframe): A geodataframe of annotations.
+        average_storeys (int): The average number of storeys of buildings in the annotation geodataframe. If None, will not calculate the average number of storeys using the meta data. Defaults to None.
+        footprint_ratio (float): The ratio of the footprint-area-based density to number-based density calculations. It should be a number between 0 and 1. 0 means the footprint area density won't be considered and 1 means number density won't be considered. Defaults to 0.5.
+        tile_size (int): The size of the tile. Defaults to 100.
+        size_unit (str): The unit of the tile size. If is None, will use the unit of the crs of the gdf or from 'area_unit'. If set to 'percent', will use the percentage of the width of the gdf bounds. Defaults to None.
+        area_unit (str): The unit of the area. Defaults to "utm".
+        supersample (int): The number of subpixels along each side of a tile used to estimate the footprint areas. Defaults to 4.
+
+    Returns:
+        density (np.ndarray): The (rows, columns) density map, from the top row down.
+        transform (affine.Affine): The affine transform of the density map.
+        crs: The crs of the density map.
+    """
+    gdf, _, bounds, tile_size, area = prepare_annotations(
+        gdf, tile_size=tile_size, size_unit=size_unit, area_unit=area_unit
+    )
+    density, transform = density_raster(
+        gdf,
+        bounds,
+        tile_size,
+        area,
+        average_storeys=average_storeys,
+        footprint_ratio=footprint_ratio,
+        storey_column=storey_column,
+        supersample=supersample,
+    )
+    logger.info(
+        f"Created a density raster of {density.shape[0]}x{density.shape[1]} tiles."
+    )
+
+    return density, transform, gdf.crs
+
+
+def annotation_extent(
+    input_path: str, area_unit: str = "utm", chunk_size: int = 100_000
+):
+    """Gets the crs and extent of the density grid of an annotation file, as
+    prepare_annotations does, in a single pass over the file reading
+    chunk_size annotations at a time.
+
+    Args:
+        input_path (str): A path to a geojson file of annotations.
+        area_unit (str): The unit of the area. Defaults to "utm".
+        chunk_size (int): The number of annotations read at a time. Defaults to 100000.
+
+    Returns:
+        crs: The crs of the grid.
+        area_crs: The crs the areas are calculated in, for density_estimate_combined_area.
+        bounds (np.ndarray): The (x_min, y_min, x_max, y_max) extent of the grid.
+    """
+    info = pyogrio.read_info(input_path, force_total_bounds=True)
     if area_unit == "meter":
-        crs = 3857
-        gdf = gdf.to_crs(epsg=crs)
+        crs = area_crs = 3857
     elif area_unit == "utm":
-        crs = gdf.estimate_utm_crs()
-        gdf = gdf.to_crs(crs)
+        crs = area_crs = gpd.GeoSeries(
+            [shapely.box(*info["total_bounds"])], crs=info["crs"]
+        ).estimate_utm_crs()
     elif area_unit is None:
-        crs = None
+        crs, area_crs = info["crs"], None
     else:
         logger.warning("area_unit must be 'meter', 'utm', or None.")
 
-    # Get the bounds of the gdf
-    bounds = gdf.total_bounds
-    width = abs(bounds[2] - bounds[0])
-    area = width * width
-    x_min, y_min, x_max, y_max = bounds
+    # The annotations are reprojected, rather than the bounds of each chunk,
+    # so the extent is that of the reprojected geodataframe.
+    bounds = np.array([np.inf, np.inf, -np.inf, -np.inf])
+    with pyogrio.open_arrow(input_path, batch_size=chunk_size) as (meta, reader):
+        geometry_name = meta["geometry_name"] or "wkb_geometry"
+        for batch in reader:
+            wkb = batch.column(batch.schema.get_field_index(geometry_name))
+            chunk = gpd.GeoSeries(
+                shapely.from_wkb(wkb.to_numpy(zero_copy_only=False)),
+                crs=meta["crs"],
+            )
+            if crs is not None and chunk.crs != crs:
+                chunk = chunk.to_crs(crs)
+            chunk_bounds = chunk.total_bounds
+            bounds[:2] = np.fmin(bounds[:2], chunk_bounds[:2])
+            bounds[2:] = np.fmax(bounds[2:], chunk_bounds[2:])
 
-    # Get the tile size
-    if size_unit == "percent":
-        tile_size = width * tile_size / 100
-    elif size_unit is None:
-        pass
-    else:
-        logger.warning("size_unit must be 'percent' or None. Will assume None.")
+    return crs, area_crs, bounds
 
-    assert tile_size > 0, "tile_size must be greater than 0."
 
-    # Create the grid
-    x_coords = np.arange(x_min, x_max, tile_size)
-    y_coords = np.arange(y_min, y_max, tile_size)
-    polygons = []
-    for x in x_coords:
-        for y in y_coords:
-            polygons.append(
-                Polygon(
-                    [
-                        (x, y),
-                        (x + tile_size, y),
-                        (x + tile_size, y + tile_size),
-                        (x, y + tile_size),
-                    ]
-                )
-            )
-    grid = gpd.GeoDataFrame({"geometry": polygons}, crs=gdf.crs)
+def block_densities(
+    block: tuple,
+    input_path: str,
+    crs,
+    area_crs,
+    tile_size: float,
+    area: float,
+    average_storeys: int = None,
+    footprint_ratio: float = 0.5,
+    storey_column: str = "storeys",
+    output_format: str = "geojson",
+    supersample: int = 4,
+):
+    """Gets the densities of a block of grid cells, reading only the
+    annotations that intersect the block and a halo of one cell around it.
+
+    The bounding box of the read is reprojected to the crs of the file from
+    its corners only, so in another crs its edges may bow past the corners;
+    the halo keeps annotations along the edges from being left out. The
+    annotations read are clipped to the cells of the block, or counted by
+    their centroids, so blocks can be processed independently.
+
+    Args:
+        block (tuple): The (x_coords, y_coords) of the columns and rows of cells of the block, as for cell_polygons.
+        input_path (str): A path to a geojson file of annotations.
+        crs: The crs of the grid.
+        area_crs: The crs the areas are calculated in, for density_estimate_combined_area.
+        tile_size (float): The size of the cells.
+        area (float): The area the densities are normalised by.
+        average_storeys (int): The average number of storeys of buildings in the annotation geodataframe. If None, will calculate the average number of storeys of each cell using the meta data. Defaults to None.
+        footprint_ratio (float): The ratio of the footprint-area-based density to number-based density calculations. Defaults to 0.5.
+        storey_column (str): The column name of the storey information. Defaults to "storeys".
+        output_format (str): "geojson" to use cell_densities, or "geotiff" to use density_raster. Defaults to "geojson".
+        supersample (int): The number of subpixels along each side of a cell, for density_raster. Defaults to 4.
+
+    Returns:
+        density (np.ndarray): The (columns, rows) densities of the cells, from the bottom up, for "geojson", or the (rows, columns) densities from the top row down for "geotiff".
+    """
+    x_coords, y_coords = block
+    extent = (
+        x_coords[0],
+        y_coords[0],
+        x_coords[-1] + tile_size,
+        y_coords[-1] + tile_size,
+    )
+    halo = shapely.box(*extent).buffer(tile_size, join_style="mitre")
+    gdf = gpd.read_file(input_path, bbox=gpd.GeoSeries([halo], crs=crs))
+    if crs is not None and gdf.crs != crs:
+        gdf = gdf.to_crs(crs)
     gdf = gdf[gdf.geometry.area > 0]
     gdf = gdf.reset_index(drop=True)
 
+    if output_format == "geotiff":
+        shape = (len(y_coords), len(x_coords))
+    else:
+        shape = (len(x_coords), len(y_coords))
+    if gdf.empty:
+        return np.zeros(shape)
+
     gdf["geometry"] = gdf["geometry"].buffer(0)
+    if output_format == "geotiff":
+        density, _ = density_raster(
+            gdf,
+            extent,
+            tile_size,
+            area,
+            average_storeys=average_storeys,
+            footprint_ratio=footprint_ratio,
+            storey_column=storey_column,
+            supersample=supersample,
+            shape=shape,
+        )
+        return density
 
-    logger.info(
-        f"Created a grid of {grid.shape[0]} tiles. Now getting the grid densities..."
-    )
-    # Get the density for each tile
-    density_map = []
-    for extent in tqdm(grid.geometry, total=grid.shape[0]):
-        raster_extent = gpd.GeoDataFrame({"id": 1, "geometry": [extent]}, crs=gdf.crs)
+    return cell_densities(
+        gdf,
+        cell_polygons(x_coords, y_coords, tile_size),
+        area,
+        crs=area_crs,
+        average_storeys=average_storeys,
+        footprint_ratio=footprint_ratio,
+        storey_column=storey_column,
+    ).reshape(shape)
 
-        # save polygon extent to shp
-        # raster_extent_cp = raster_extent.copy()
-        # raster_extent_cp["geometry"] = raster_extent_cp["geometry"].buffer(0)
-        # set crs
-        # raster_extent_cp.crs = gdf.crs
-        # raster_extent_cp.to_file("raster_extent.shp")
 
-        raster_extent = raster_extent.buffer(0)
+def density_map_blocks(
+    input_path: str,
+    average_storeys: int = None,
+    footprint_ratio: float = 0.5,
+    tile_size: int = 100,
+    size_unit: str = None,
+    area_unit: str = "utm",
+    storey_column: str = "storeys",
+    output_format: str = "geojson",
+    supersample: int = 4,
+    block_size: int = 256,
+    workers: int = None,
+):
+    """This function creates the density map of an annotation file block by
+    block, in a pool of worker processes, without loading the whole file.
+
+    The grid is split into blocks of block_size by block_size cells, and the
+    annotations of each block are read with a bounding box filter, so the
+    memory used by each worker is bounded by the block size rather than the
+    size of the file. The densities are the same as those of
+    density_map_maker or density_raster_maker on the whole file.
 
-        tile_polygons = gdf.clip(raster_extent)
+    Args:
+        input_path (str): A path to a geojson file of annotations.
+        average_storeys (int): The average number of storeys of buildings in the annotation geodataframe. If None, will not calculate the average number of storeys using the meta data. Defaults to None.
+        footprint_ratio (float): The ratio of the footprint-area-based density to number-based density calculations. It should be a number between 0 and 1. 0 means the footprint area density won't be considered and 1 means number density won't be considered. Defaults to 0.5.
+        tile_size (int): The size of the tile. Defaults to 100.
+        size_unit (str): The unit of the tile size. If is None, will use the unit of the crs of the gdf or from 'area_unit'. If set to 'percent', will use the percentage of the width of the gdf bounds. Defaults to None.
+        area_unit (str): The unit of the area. Defaults to "utm".
+        output_format (str): "geojson" for a grid of polygons, or "geotiff" for a density raster. Defaults to "geojson".
+        supersample (int): The number of subpixels along each side of a tile used to estimate the footprint areas of a GeoTIFF density map. Defaults to 4.
+        block_size (int): The number of tiles along each side of a block. Defaults to 256.
+        workers (int): The number of worker processes. If None, will use the number of CPUs. Defaults to None.
 
-        # Split multipolygon
-        tile_polygons = tile_polygons.explode(index_parts=False)
-        tile_polygons = tile_polygons.reset_index(drop=True)
+    Returns:
+        grid (geodataframe): A geodataframe of the density map for "geojson", or a (density, transform, crs) tuple as returned by density_raster_maker for "geotiff".
+    """
+    assert block_size >= 1, "block_size must be at least 1."
 
-        # get density for each tile
-        density = density_estimate_combined_area(
-            tile_polygons,
-            crs=crs,
-            average_storeys=average_storeys,
-            storey_column=storey_column,
-            footprint_ratio=footprint_ratio,
-            area=area,
-        )
-        # print("grid density:", density, "\n=======")
-        density_map.append(density)
+    crs, area_crs, bounds = annotation_extent(input_path, area_unit)
+    x_min, y_min, x_max, y_max = bounds
+    tile_size, area = grid_scale(bounds, tile_size, size_unit)
 
-    # Create the density map
-    grid["density"] = density_map
+    x_coords = np.arange(x_min, x_max, tile_size)
+    y_coords = np.arange(y_min, y_max, tile_size)
+    columns, rows = len(x_coords), len(y_coords)
+    blocks = [
+        (column, row)
+        for column in range(0, columns, block_size)
+        for row in range(0, rows, block_size)
+    ]
+    logger.info(
+        f"Created a grid of {columns * rows} tiles in {len(blocks)} blocks. Now getting the block densities..."
+    )
+
+    get_densities = functools.partial(
+        block_densities,
+        input_path=input_path,
+        crs=crs,
+        area_crs=area_crs,
+        tile_size=tile_size,
+        area=area,
+        average_storeys=average_storeys,
+        footprint_ratio=footprint_ratio,
+        storey_column=storey_column,
+        output_format=output_format,
+        supersample=supersample,
+    )
+    if output_format == "geotiff":
+        density = np.zeros((rows, columns))
+    else:
+        density = np.zeros((columns, rows))
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        results = executor.map(
+            get_densities,
+            [
+                (
+                    x_coords[column : column + block_size],
+                    y_coords[row : row + block_size],
+                )
+                for column, row in blocks
+            ],
+        )
+        for (column, row), block_density in tqdm(
+            zip(blocks, results), total=len(blocks)
+        ):
+            if output_format == "geotiff":
+                # Raster rows run from the top down.
+                top = rows - row - block_density.shape[0]
+                density[
+                    top : top + block_density.shape[0],
+                    column : column + block_density.shape[1],
+                ] = block_density
+            else:
+                density[
+                    column : column + block_density.shape[0],
+                    row : row + block_density.shape[1],
+                ] = block_density
+
+    if output_format == "geotiff":
+        transform = from_origin(x_min, y_min + rows * tile_size, tile_size, tile_size)
+        return density, transform, crs
+
+    grid = gpd.GeoDataFrame(
+        {"geometry": cell_polygons(x_coords, y_coords, tile_size)}, crs=crs
+    )
+    grid["density"] = density.ravel()
 
     return grid
 
@@ -341,9 +977,15 @@ def density_maker_geojson(
     area_unit: str = "utm",
     output_path: str = None,
     storey_column: str = "storeys",
-) -> gpd.GeoDataFrame:
+    output_format: str = "geojson",
+    supersample: int = 4,
+    block_size: int = None,
+    workers: int = None,
+):
     """This function is a wrapper function for density_map_maker calculating
-    and saving the density map as a geojson.
+    and saving the density map as a geojson, or for density_raster_maker
+    calculating and saving it as a GeoTIFF. If block_size is given, the
+    density map is calculated block by block with density_map_blocks instead.
 
     Args:
         gdf (str): A path to a geojson file of annotations.
@@ -353,26 +995,67 @@ def density_maker_geojson(
         size_unit (str): The unit of the tile size. If is None, will use the unit of the crs of the gdf or from 'area_unit'. If set to 'percent', will use the percentage of the width of the gdf bounds. Defaults to percent. Overall, this can be ignored as long as percentage of width is the preferred window size.
         area_unit (str): The unit of the area. Defaults to "utm".
         output_path (str): The path to save the output geojson. If None, will not save the output geojson. Defaults to None.
+        output_format (str): The format of the density map, "geojson" for a polygon per tile or "geotiff" for a raster with a pixel per tile. Defaults to "geojson".
+        supersample (int): The number of subpixels along each side of a tile used to estimate the footprint areas of a GeoTIFF density map. Defaults to 4.
+        block_size (int): The number of tiles along each side of a block, to calculate the density map block by block without loading the whole geojson. If None, will load the whole geojson. Defaults to None.
+        workers (int): The number of worker processes calculating blocks. If None, will use the number of CPUs. Defaults to None.
 
     Returns:
-        grid (geodataframe): A geodataframe of the density map.
+        grid (geodataframe): A geodataframe of the density map, or the (rows, columns) density array for the "geotiff" format.
     """
-    # read the geojson
-    gdf = gpd.read_file(input_path)
+    assert output_format in (
+        "geojson",
+        "geotiff",
+    ), "output_format must be 'geojson' or 'geotiff'."
+
+    if block_size is not None:
+        result = density_map_blocks(
+            input_path,
+            average_storeys=average_storeys,
+            footprint_ratio=footprint_ratio,
+            tile_size=tile_size,
+            size_unit=size_unit,
+            area_unit=area_unit,
+            storey_column=storey_column,
+            output_format=output_format,
+            supersample=supersample,
+            block_size=block_size,
+            workers=workers,
+        )
+    elif output_format == "geotiff":
+        # read the geojson
+        result = density_raster_maker(
+            gpd.read_file(input_path),
+            average_storeys=average_storeys,
+            footprint_ratio=footprint_ratio,
+            tile_size=tile_size,
+            size_unit=size_unit,
+            area_unit=area_unit,
+            storey_column=storey_column,
+            supersample=supersample,
+        )
+    else:
+        # read the geojson
+        result = density_map_maker(
+            gpd.read_file(input_path),
+            average_storeys=average_storeys,
+            footprint_ratio=footprint_ratio,
+            tile_size=tile_size,
+            size_unit=size_unit,
+            area_unit=area_unit,
+            storey_column=storey_column,
+        )
 
-    # print("Geodataframe:\n",gdf)
+    if output_format == "geotiff":
+        density, transform, crs = result
+        if output_path is None:
+            output_path = input_path.replace(".geojson", "_density.tif")
+        write_density_raster(density, transform, crs, output_path)
+        logger.info(f"Saved the density map to {output_path}")
 
-    # create the density map
-    grid = density_map_maker(
-        gdf,
-        average_storeys=average_storeys,
-        footprint_ratio=footprint_ratio,
-        tile_size=tile_size,
-        size_unit=size_unit,
-        area_unit=area_unit,
-        storey_column=storey_column,
-    )
+        return density
 
+    grid = result
     print("Grid:\n", grid)
 
     # save the density map
@@ -447,6 +1130,31 @@ def create_parser():
         default="utm",
         help="The unit of the area. Defaults to 'utm'.",
     )
+    parser.add_argument(
+        "--output-format",
+        type=str,
+        choices=["geojson", "geotiff"],
+        default="geojson",
+        help="The format of the density map. 'geojson' saves a polygon per tile, 'geotiff' saves a tiled, compressed raster with a pixel per tile, which is much smaller and faster for fine grids. Defaults to 'geojson'.",
+    )
+    parser.add_argument(
+        "--supersample",
+        type=int,
+        default=4,
+        help="The number of subpixels along each side of a tile used to estimate the footprint areas of a GeoTIFF density map. Defaults to 4.",
+    )
+    parser.add_argument(
+        "--block-size",
+        type=int,
+        default=None,
+        help="The number of tiles along each side of a block. If given, the density map is calculated block by block in worker processes, each reading only the annotations of its block, so memory is bounded by the block size rather than the size of the geojson. Defaults to None, which loads the whole geojson.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="The number of worker processes calculating blocks, with --block-size. Defaults to the number of CPUs.",
+    )
     return parser
 
 
@@ -463,8 +1171,12 @@ def main(args=None):
         area_unit=args.area_unit,
         output_path=args.output_path,
         storey_column=args.storey_column,
+        output_format=args.output_format,
+        supersample=args.supersample,
+        block_size=args.block_size,
+        workers=args.workers,
     )
 
 
-if main:
+if __name__ == "__main__":
     main()
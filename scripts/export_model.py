@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import argparse
+import glob
+import json
+import os
+import sys
+
+import cv2
+from detectron2.config import get_cfg
+
+from aerialseg.export import EXPORT_FORMATS, export_model, parity_check
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(
+        description="Export a Detectron2 Mask R-CNN to TorchScript and/or ONNX, and check its outputs against the eager model."
+    )
+    parser.add_argument(
+        "--config",
+        "-c",
+        type=str,
+        required=True,
+        help="Model configuration YAML file from Detectron2.",
+    )
+    parser.add_argument(
+        "--weights",
+        "-w",
+        type=str,
+        required=True,
+        help="Path to a weights .pth file output from Detectron2 training.",
+    )
+    parser.add_argument(
+        "--output-dir",
+        "-o",
+        type=str,
+        required=True,
+        help="Directory to write the exported models, their config and the export report to.",
+    )
+    parser.add_argument(
+        "--formats",
+        type=str,
+        nargs="+",
+        choices=list(EXPORT_FORMATS),
+        default=["torchscript", "onnx"],
+        help="Formats to export. Default: %(default)s.",
+    )
+    parser.add_argument(
+        "--export-method",
+        type=str,
+        choices=["tracing", "scripting"],
+        default="tracing",
+        help="Export method. 'scripting' only exports TorchScript. Default: %(default)s.",
+    )
+    parser.add_argument(
+        "--threshold",
+        "-t",
+        type=float,
+        default=0.05,
+        help="Detection threshold of the exported model. Predictors filter their outputs again with the threshold of their config. Default: %(default)s.",
+    )
+    parser.add_argument(
+        "--opset",
+        type=int,
+        default=16,
+        help="ONNX opset version. Default: %(default)s.",
+    )
+    parser.add_argument(
+        "--sample-dir",
+        type=str,
+        default="demo_data",
+        help="Directory of the sample tiles used for tracing and the parity check. Default: %(default)s.",
+    )
+    parser.add_argument(
+        "--sample-pattern",
+        type=str,
+        default="*.png",
+        help="Glob pattern of the sample tiles within --sample-dir. Default: %(default)s.",
+    )
+    parser.add_argument(
+        "--num-samples",
+        type=int,
+        default=8,
+        help="Number of sample tiles in the parity check. Default: %(default)s.",
+    )
+    parser.add_argument(
+        "--no-parity",
+        action="store_true",
+        help="Skip the parity check against the eager model.",
+    )
+    parser.add_argument(
+        "--min-box-iou",
+        type=float,
+        default=0.95,
+        help="Mean box IoU with the eager model an exported model must reach to pass the parity check. Default: %(default)s.",
+    )
+    parser.add_argument(
+        "--min-mask-iou",
+        type=float,
+        default=0.9,
+        help="Mean mask IoU with the eager model an exported model must reach to pass the parity check. Default: %(default)s.",
+    )
+    parser.add_argument(
+        "--min-matched",
+        type=float,
+        default=0.95,
+        help="Fraction of instances an exported model must match with the eager model to pass the parity check. Default: %(default)s.",
+    )
+    return parser
+
+
+def main(args=None):
+    parser = create_parser()
+    args = parser.parse_args(args)
+    if args.export_method == "scripting" and "onnx" in args.formats:
+        parser.error("ONNX can only be exported with --export-method tracing.")
+
+    cfg = get_cfg()
+    cfg.merge_from_file(args.config)
+    cfg.MODEL.WEIGHTS = args.weights
+    cfg.MODEL.ROI_HEADS.SCORE_THRESH_TEST = args.threshold
+    cfg.MODEL.DEVICE = "cpu"
+
+    sample_files = sorted(glob.glob(os.path.join(args.sample_dir, args.sample_pattern)))
+    sample_files = sample_files[: args.num_samples]
+    if not sample_files:
+        parser.error(
+            f"No sample tiles match {args.sample_pattern} in {args.sample_dir}."
+        )
+    images = [cv2.imread(f) for f in sample_files]
+
+    artifacts = export_model(
+        cfg,
+        args.output_dir,
+        images[0],
+        formats=args.formats,
+        export_method=args.export_method,
+        opset=args.opset,
+    )
+    for export_format, path in artifacts.items():
+        print(f"Exported {export_format}: {path}")
+    if args.no_parity:
+        return
+
+    report = parity_check(cfg, artifacts, images, export_method=args.export_method)
+    failed = []
+    for backend, stats in report.items():
+        line = (
+            f"{backend}: {stats['latency_median_ms']:.1f} ms median latency, "
+            f"{stats['instances']} instances"
+        )
+        if backend != "eager":
+            line += (
+                f", {stats['matched_fraction']:.1%} matched, "
+                f"box IoU {stats['box_iou']:.3f}, mask IoU {stats['mask_iou']:.3f}"
+            )
+            stats["passed"] = (
+                stats["matched_fraction"] >= args.min_matched
+                and stats["box_iou"] >= args.min_box_iou
+                and stats["mask_iou"] >= args.min_mask_iou
+            )
+            if not stats["passed"]:
+                failed.append(backend)
+        print(line)
+
+    with open(os.path.join(args.output_dir, "parity.json"), "w") as f:
+        json.dump(
+            {"samples": sample_files, "backends": report},
+            f,
+            indent=2,
+        )
+    if failed:
+        print(f"Parity check failed for: {', '.join(failed)}")
+        sys.exit(1)
+    print("Parity check passed.")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,8 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+import contextlib
+import functools
 import glob
 import json
 import os
@@ -9,9 +11,18 @@ import os
 from detectron2.config import get_cfg
 
 # from detectron2.data import MetadataCatalog
-from detectron2.engine import DefaultPredictor
 
-from aerialseg.utils import assemble_coco_json, extract_all_annotations_df
+from aerialseg import memory, profiling
+from aerialseg.cache import PredictionCache
+from aerialseg.checkpoint import RunCheckpoint
+from aerialseg.predictors import create_predictor
+from aerialseg.replicas import extract_all_annotations_replicated
+from aerialseg.utils import (
+    assemble_coco_json,
+    extract_all_annotations,
+    tile_file_name,
+)
+from aerialseg.writers import StreamingCocoWriter
 
 
 def create_parser():
@@ -44,7 +55,25 @@ def create_parser():
         "-w",
         type=str,
         required=True,
-        help="Path to a weights .pth file output from Detectron2 training.",
+        help="Path to a weights .pth file output from Detectron2 training, or to an exported model with --backend onnx or torchscript.",
+    )
+    parser.add_argument(
+        "--backend",
+        type=str,
+        choices=["torch", "onnx", "torchscript"],
+        default="torch",
+        help="Inference backend. 'onnx' runs a Mask R-CNN exported to ONNX on onnxruntime, and 'torchscript' one exported to TorchScript, given as --weights, with --config still used for preprocessing. Default: %(default)s.",
+    )
+    parser.add_argument(
+        "--quantized",
+        action="store_true",
+        help="--weights is a model quantized to INT8 by quantize_aerialseg. Runs on the CPU with the torch backend.",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=0,
+        help="Number of CPU threads used for inference. 0 keeps the default of the backend. Default: %(default)s.",
     )
     parser.add_argument(
         "--threshold",
@@ -78,6 +107,93 @@ def create_parser():
         action=argparse.BooleanOptionalAction,
         help="If set, will force CPU inference.",
     )
+    parser.add_argument(
+        "--batch-size",
+        "-b",
+        type=int,
+        default=1,
+        help="Number of tiles to predict in a single forward pass. Default: %(default)s.",
+    )
+    parser.add_argument(
+        "--prefetch",
+        type=int,
+        default=0,
+        help="Number of tiles to decode ahead in background threads while the model runs. 0 disables prefetching. Default: %(default)s.",
+    )
+    parser.add_argument(
+        "--decode-workers",
+        type=int,
+        default=2,
+        help="Number of threads decoding tiles when prefetching. Default: %(default)s.",
+    )
+    parser.add_argument(
+        "--polygonize-workers",
+        type=int,
+        default=0,
+        help="Number of worker processes polygonizing masks while the model keeps predicting. 0 polygonizes in the main process. Default: %(default)s.",
+    )
+    parser.add_argument(
+        "--replicas",
+        type=int,
+        default=0,
+        help="Number of worker processes, each running its own model replica on a share of the tiles. Tiles are decoded, predicted and polygonized in the workers. 0 predicts in the main process. Default: %(default)s.",
+    )
+    parser.add_argument(
+        "--threads-per-replica",
+        type=int,
+        default=1,
+        help="Number of CPU threads of each replica, with --replicas. Default: %(default)s.",
+    )
+    parser.add_argument(
+        "--pin-cores",
+        action="store_true",
+        help="With --replicas, pin each replica to its own block of --threads-per-replica cores (Linux only).",
+    )
+    parser.add_argument(
+        "--roi-masks",
+        action=argparse.BooleanOptionalAction,
+        help="If set, will polygonize the low resolution masks of the mask head in box coordinates, instead of pasting them into full-image masks. Faster and lighter on CPU.",
+    )
+    parser.add_argument(
+        "--roi-mask-resolution",
+        type=int,
+        default=0,
+        help="Size the ROI masks are resized to before polygonizing, with --roi-masks. 0 resizes them to the box size in pixels, closest to the full-image masks; 28 uses the raw mask head output. Default: %(default)s.",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        type=str,
+        default=None,
+        help="Directory of a cache of raw model outputs, keyed by tile content, weights, config and threshold. Tiles already in the cache are not predicted again, so re-running with other post-processing options (e.g. --simplify-tolerance) only polygonizes. By default no cache is used.",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=float,
+        default=10.0,
+        help="Size cap of the cache in GB. Least recently used tiles are evicted beyond it. Default: %(default)s.",
+    )
+    parser.add_argument(
+        "--checkpoint-dir",
+        type=str,
+        default=None,
+        help="Directory to checkpoint the annotations of completed tiles to, so an interrupted run can be resumed with --resume. By default no checkpoint is kept.",
+    )
+    parser.add_argument(
+        "--resume",
+        action=argparse.BooleanOptionalAction,
+        help="If set, will resume the run checkpointed in --checkpoint-dir, skipping the tiles it completed.",
+    )
+    parser.add_argument(
+        "--stream",
+        action=argparse.BooleanOptionalAction,
+        help="If set, will write the COCO JSON incrementally as tiles are predicted, instead of holding all annotations in memory. Use for very large runs.",
+    )
+    parser.add_argument(
+        "--parquet-out",
+        type=str,
+        default=None,
+        help="Path to a GeoParquet file to save the predictions to, as a columnar table with a GeoArrow polygon column. The polygons are in pixel coordinates of their tiles, identified by image_id. By default no GeoParquet file is written.",
+    )
     parser.add_argument(
         "--coco-out",
         "-o",
@@ -85,6 +201,22 @@ def create_parser():
         default=None,
         help="Path to a COCO JSON file to save the predictions to. By default will save to the same directory as the input image with 'coco-out.json' name.",
     )
+    parser.add_argument(
+        "--profile",
+        action=argparse.BooleanOptionalAction,
+        help="If set, will time the stages of the pipeline and count instances, polygons and vertices, then print a summary and write a Chrome trace (viewable in chrome://tracing or ui.perfetto.dev). Also switched on by the AERIALSEG_PROFILE environment variable.",
+    )
+    parser.add_argument(
+        "--profile-memory",
+        action=argparse.BooleanOptionalAction,
+        help="If set, will also track the peak RSS and the peak Python allocations (tracemalloc) of each stage and tile, and report the tiles with the highest peaks and their instance counts. Implies --profile, and slows the run down. Also switched on by the AERIALSEG_PROFILE_MEMORY environment variable.",
+    )
+    parser.add_argument(
+        "--profile-out",
+        type=str,
+        default=None,
+        help="Path to the profile JSON, with the Chrome trace and the summary. By default will save next to the COCO JSON, with a '-profile.json' suffix.",
+    )
 
     return parser
 
@@ -100,6 +232,22 @@ def create_parser():
 def main(args=None):
     parser = create_parser()
     args = parser.parse_args()
+    if args.profile or args.profile_memory:
+        profiling.enable()
+    if args.profile_memory:
+        memory.enable()
+    if args.quantized and args.backend != "torch":
+        parser.error("--quantized models only run on the torch backend.")
+    if args.replicas > 0 and (args.prefetch > 0 or args.polygonize_workers > 0):
+        parser.error(
+            "--replicas decode and polygonize tiles in their own processes; drop --prefetch and --polygonize-workers."
+        )
+    if args.resume and args.checkpoint_dir is None:
+        parser.error("--resume needs the --checkpoint-dir of the run to resume.")
+    if args.stream and args.checkpoint_dir is not None:
+        parser.error("--stream cannot be combined with --checkpoint-dir.")
+    if args.stream and args.parquet_out is not None:
+        parser.error("--parquet-out needs the annotations in memory; drop --stream.")
 
     config_file = args.config
     weights_file = args.weights
@@ -134,22 +282,34 @@ def main(args=None):
     if args.force_cpu:
         cfg.MODEL.DEVICE = "cpu"
 
-    predictor = DefaultPredictor(cfg)
+    if args.replicas > 0:
+        # Each replica builds its own predictor in its worker process.
+        predictor = functools.partial(
+            create_predictor,
+            cfg,
+            backend=args.backend,
+            paste_masks=not args.roi_masks,
+            num_threads=args.threads_per_replica,
+            quantized=args.quantized,
+        )
+    else:
+        predictor = create_predictor(
+            cfg,
+            backend=args.backend,
+            paste_masks=not args.roi_masks,
+            num_threads=args.threads,
+            quantized=args.quantized,
+        )
+    if args.cache_dir is not None:
+        cache = PredictionCache(
+            args.cache_dir,
+            cfg,
+            paste_masks=not args.roi_masks,
+            max_bytes=int(args.cache_size * 10**9),
+        )
+    else:
+        cache = None
 
-    all_annotations = extract_all_annotations_df(
-        images,
-        predictor,
-        simplify_tolerance=args.simplify_tolerance,
-        minimum_rotated_rectangle=args.minimum_rotated_rectangle,
-    )
-    coco_json = assemble_coco_json(
-        all_annotations,
-        images,
-        categories=categories_keyed,
-        license="",
-        info="",
-        type="instances",
-    )
     if args.coco_out is None:
         if args.minimum_rotated_rectangle:
             args.coco_out = os.path.join(args.indir, "coco-out-mrr.json")
@@ -158,7 +318,95 @@ def main(args=None):
                 args.indir, f"coco-out-tol_{str(args.simplify_tolerance)}.json"
             )
 
-    coco_json.write_to_file(args.coco_out)
+    pending_tiles = images
+    if args.stream:
+        writer_context = StreamingCocoWriter(args.coco_out, categories=categories_keyed)
+    elif args.checkpoint_dir is not None:
+        writer_context = RunCheckpoint(
+            args.checkpoint_dir,
+            params={
+                "config": os.path.abspath(config_file),
+                "weights": os.path.abspath(weights_file),
+                "threshold": args.threshold,
+                "simplify_tolerance": args.simplify_tolerance,
+                "minimum_rotated_rectangle": args.minimum_rotated_rectangle,
+                "roi_masks": args.roi_masks,
+                "roi_mask_resolution": args.roi_mask_resolution,
+            },
+            resume=args.resume,
+        )
+        pending_tiles = writer_context.pending(images)
+        if args.resume:
+            print(
+                f"Resuming: {len(images) - len(pending_tiles)} of {len(images)} tiles already done"
+            )
+    else:
+        writer_context = contextlib.nullcontext()
+
+    timings = {}
+    with writer_context as writer:
+        if args.replicas > 0:
+            all_annotations = extract_all_annotations_replicated(
+                pending_tiles,
+                predictor,
+                num_replicas=args.replicas,
+                threads_per_replica=args.threads_per_replica,
+                pin_cores=args.pin_cores,
+                simplify_tolerance=args.simplify_tolerance,
+                minimum_rotated_rectangle=args.minimum_rotated_rectangle,
+                batch_size=args.batch_size,
+                timings=timings,
+                mask_resolution=args.roi_mask_resolution,
+                writer=writer,
+                cache=cache,
+            )
+        else:
+            all_annotations = extract_all_annotations(
+                pending_tiles,
+                predictor,
+                simplify_tolerance=args.simplify_tolerance,
+                minimum_rotated_rectangle=args.minimum_rotated_rectangle,
+                batch_size=args.batch_size,
+                prefetch=args.prefetch,
+                decode_workers=args.decode_workers,
+                polygonize_workers=args.polygonize_workers,
+                timings=timings,
+                mask_resolution=args.roi_mask_resolution,
+                writer=writer,
+                cache=cache,
+            )
+    print(
+        "Stage timings: "
+        + ", ".join(f"{stage}: {seconds:.2f} s" for stage, seconds in timings.items())
+    )
+    if cache is not None:
+        print(f"Prediction cache: {cache.hits} hits, {cache.misses} misses")
+    if args.checkpoint_dir is not None:
+        all_annotations = writer_context.load([tile_file_name(tile) for tile in images])
+    if not args.stream:
+        coco_json = assemble_coco_json(
+            all_annotations,
+            images,
+            categories=categories_keyed,
+            license="",
+            info="",
+            type="instances",
+        )
+        with profiling.span("write_coco_json"), memory.stage("write_coco_json"):
+            coco_json.write_to_file(args.coco_out)
+
+    if args.parquet_out is not None:
+        all_annotations.to_parquet(args.parquet_out)
+
+    if profiling.enabled() or memory.enabled():
+        profiler = profiling.enable()
+        print(profiler.format_summary())
+        if memory.enabled():
+            print(memory.get_tracker().format_summary())
+        if args.profile_out is None:
+            args.profile_out = f"{os.path.splitext(args.coco_out)[0]}-profile.json"
+        profiler.write_chrome_trace(args.profile_out)
+        print(f"Profile written to {args.profile_out}")
 
 
 if __name__ == "__main__":
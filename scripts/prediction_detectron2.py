@@ -6,8 +6,8 @@ import json
 
 from detectron2.config import get_cfg
 from detectron2.data import MetadataCatalog
-from detectron2.engine import DefaultPredictor
 
+from aerialseg.predictors import create_predictor
 from aerialseg.utils import visualize_or_save_image
 
 
@@ -28,7 +28,25 @@ def create_parser():
         "-w",
         type=str,
         required=True,
-        help="Path to a weights .pth file output from Detectron2 training.",
+        help="Path to a weights .pth file output from Detectron2 training, or to an exported model with --backend onnx or torchscript.",
+    )
+    parser.add_argument(
+        "--backend",
+        type=str,
+        choices=["torch", "onnx", "torchscript"],
+        default="torch",
+        help="Inference backend. 'onnx' runs a Mask R-CNN exported to ONNX on onnxruntime, and 'torchscript' one exported to TorchScript, given as --weights, with --config still used for preprocessing. Default: %(default)s.",
+    )
+    parser.add_argument(
+        "--quantized",
+        action="store_true",
+        help="--weights is a model quantized to INT8 by quantize_aerialseg. Runs on the CPU with the torch backend.",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=0,
+        help="Number of CPU threads used for inference. 0 keeps the default of the backend. Default: %(default)s.",
     )
     parser.add_argument(
         "--threshold",
@@ -57,6 +75,8 @@ def create_parser():
 def main(args=None):
     parser = create_parser()
     args = parser.parse_args()
+    if args.quantized and args.backend != "torch":
+        parser.error("--quantized models only run on the torch backend.")
     cfg = get_cfg()
 
     config_file = args.config
@@ -76,7 +96,12 @@ def main(args=None):
 
     # Just need the CPU for a single image
     cfg.MODEL.DEVICE = "cpu"
-    predictor = DefaultPredictor(cfg)
+    predictor = create_predictor(
+        cfg,
+        backend=args.backend,
+        num_threads=args.threads,
+        quantized=args.quantized,
+    )
 
     visualize_or_save_image(
         image=args.image, predictor=predictor, meta=meta, png_out=args.png_out
@@ -2,21 +2,36 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+import contextlib
+import functools
 import glob
 import json
 import logging
 import os
 
 # import geopandas as gpd
+import cv2
 import rasterio as rio
 from aerial_conversion.coco import raster_to_coco
 from aerial_conversion.tiles import save_tiles
 from detectron2.config import get_cfg
+from rasterio.windows import Window
 
 # from detectron2.data import MetadataCatalog
-from detectron2.engine import DefaultPredictor
 
-from aerialseg.utils import assemble_coco_json, extract_all_annotations_df
+from aerialseg import memory, profiling
+from aerialseg.cache import PredictionCache
+from aerialseg.checkpoint import RunCheckpoint
+from aerialseg.postprocess import merge_tile_predictions
+from aerialseg.predictors import create_predictor
+from aerialseg.raster import RasterWindowReader, raster_windows, window_image_records
+from aerialseg.replicas import extract_all_annotations_replicated
+from aerialseg.utils import (
+    assemble_coco_json,
+    extract_all_annotations,
+    tile_file_name,
+)
+from aerialseg.writers import StreamingCocoWriter
 
 # import traceback
 
@@ -60,7 +75,25 @@ def create_parser():
         "-w",
         type=str,
         required=True,
-        help="Path to a weights .pth file output from Detectron2 training.",
+        help="Path to a weights .pth file output from Detectron2 training, or to an exported model with --backend onnx or torchscript.",
+    )
+    parser.add_argument(
+        "--backend",
+        type=str,
+        choices=["torch", "onnx", "torchscript"],
+        default="torch",
+        help="Inference backend. 'onnx' runs a Mask R-CNN exported to ONNX on onnxruntime, and 'torchscript' one exported to TorchScript, given as --weights, with --config still used for preprocessing. Default: %(default)s.",
+    )
+    parser.add_argument(
+        "--quantized",
+        action="store_true",
+        help="--weights is a model quantized to INT8 by quantize_aerialseg. Runs on the CPU with the torch backend.",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=0,
+        help="Number of CPU threads used for inference. 0 keeps the default of the backend. Default: %(default)s.",
     )
     parser.add_argument(
         "--threshold",
@@ -94,6 +127,93 @@ def create_parser():
         action=argparse.BooleanOptionalAction,
         help="If set, will force CPU inference.",
     )
+    parser.add_argument(
+        "--batch-size",
+        "-b",
+        type=int,
+        default=1,
+        help="Number of tiles to predict in a single forward pass. Default: %(default)s.",
+    )
+    parser.add_argument(
+        "--prefetch",
+        type=int,
+        default=0,
+        help="Number of tiles to decode ahead in background threads while the model runs. 0 disables prefetching. Default: %(default)s.",
+    )
+    parser.add_argument(
+        "--decode-workers",
+        type=int,
+        default=2,
+        help="Number of threads decoding tiles when prefetching. Default: %(default)s.",
+    )
+    parser.add_argument(
+        "--polygonize-workers",
+        type=int,
+        default=0,
+        help="Number of worker processes polygonizing masks while the model keeps predicting. 0 polygonizes in the main process. Default: %(default)s.",
+    )
+    parser.add_argument(
+        "--replicas",
+        type=int,
+        default=0,
+        help="Number of worker processes, each running its own model replica on a share of the tiles. Tiles are decoded, predicted and polygonized in the workers. 0 predicts in the main process. Default: %(default)s.",
+    )
+    parser.add_argument(
+        "--threads-per-replica",
+        type=int,
+        default=1,
+        help="Number of CPU threads of each replica, with --replicas. Default: %(default)s.",
+    )
+    parser.add_argument(
+        "--pin-cores",
+        action="store_true",
+        help="With --replicas, pin each replica to its own block of --threads-per-replica cores (Linux only).",
+    )
+    parser.add_argument(
+        "--roi-masks",
+        action=argparse.BooleanOptionalAction,
+        help="If set, will polygonize the low resolution masks of the mask head in box coordinates, instead of pasting them into full-image masks. Faster and lighter on CPU.",
+    )
+    parser.add_argument(
+        "--roi-mask-resolution",
+        type=int,
+        default=0,
+        help="Size the ROI masks are resized to before polygonizing, with --roi-masks. 0 resizes them to the box size in pixels, closest to the full-image masks; 28 uses the raw mask head output. Default: %(default)s.",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        type=str,
+        default=None,
+        help="Directory of a cache of raw model outputs, keyed by tile content, weights, config and threshold. Tiles already in the cache are not predicted again, so re-running with other post-processing options (e.g. --simplify-tolerance) only polygonizes. By default no cache is used.",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=float,
+        default=10.0,
+        help="Size cap of the cache in GB. Least recently used tiles are evicted beyond it. Default: %(default)s.",
+    )
+    parser.add_argument(
+        "--checkpoint-dir",
+        type=str,
+        default=None,
+        help="Directory to checkpoint the annotations of completed tiles to, so an interrupted run can be resumed with --resume. By default no checkpoint is kept.",
+    )
+    parser.add_argument(
+        "--resume",
+        action=argparse.BooleanOptionalAction,
+        help="If set, will resume the run checkpointed in --checkpoint-dir, skipping the tiles it completed.",
+    )
+    parser.add_argument(
+        "--stream",
+        action=argparse.BooleanOptionalAction,
+        help="If set, will write the COCO JSON incrementally as tiles are predicted, instead of holding all annotations in memory. Use for very large runs.",
+    )
+    parser.add_argument(
+        "--parquet-out",
+        type=str,
+        default=None,
+        help="Path to a GeoParquet file to save the predictions to, as a columnar table with a GeoArrow polygon column. The polygons are georeferenced with their tile transforms, and tile overlaps are not merged. By default no GeoParquet file is written.",
+    )
     parser.add_argument(
         "--coco-out",
         "-o",
@@ -108,6 +228,47 @@ def create_parser():
         default=None,
         help="Path to a temporary directory to store the raster tiles. By default will use the system temp directory.",
     )
+    parser.add_argument(
+        "--in-memory",
+        action=argparse.BooleanOptionalAction,
+        help="If set, will read the tiles as windows straight from the raster into memory, instead of writing tile GeoTIFFs and PNGs to the temporary directory. The tile size is then in pixels.",
+    )
+    parser.add_argument(
+        "--vector-out",
+        "-v",
+        type=str,
+        default=None,
+        help="Path to a vector file (e.g. GeoJSON, GeoPackage, or GeoParquet with a .parquet extension) to save the predictions to, georeferenced and with duplicates in the tile overlaps merged. By default no vector file is written.",
+    )
+    parser.add_argument(
+        "--merge-method",
+        type=str,
+        choices=["iou", "core"],
+        default="iou",
+        help="How to merge duplicate predictions in the tile overlaps for --vector-out. 'iou' keeps the largest of overlapping polygons, 'core' keeps polygons whose centroid lies in the core region of their tile. Default: %(default)s.",
+    )
+    parser.add_argument(
+        "--merge-iou-threshold",
+        type=float,
+        default=0.5,
+        help="IoU above which overlapping polygons of neighbouring tiles are merged, for the 'iou' merge method. Default: %(default)s.",
+    )
+    parser.add_argument(
+        "--profile",
+        action=argparse.BooleanOptionalAction,
+        help="If set, will time the stages of the pipeline and count instances, polygons and vertices, then print a summary and write a Chrome trace (viewable in chrome://tracing or ui.perfetto.dev). Also switched on by the AERIALSEG_PROFILE environment variable.",
+    )
+    parser.add_argument(
+        "--profile-memory",
+        action=argparse.BooleanOptionalAction,
+        help="If set, will also track the peak RSS and the peak Python allocations (tracemalloc) of each stage and tile, and report the tiles with the highest peaks and their instance counts. Implies --profile, and slows the run down. Also switched on by the AERIALSEG_PROFILE_MEMORY environment variable.",
+    )
+    parser.add_argument(
+        "--profile-out",
+        type=str,
+        default=None,
+        help="Path to the profile JSON, with the Chrome trace and the summary. By default will save next to the COCO JSON, with a '-profile.json' suffix.",
+    )
 
     return parser
 
@@ -123,6 +284,24 @@ def create_parser():
 def main(args=None):
     parser = create_parser()
     args = parser.parse_args()
+    if args.profile or args.profile_memory:
+        profiling.enable()
+    if args.profile_memory:
+        memory.enable()
+    if args.quantized and args.backend != "torch":
+        parser.error("--quantized models only run on the torch backend.")
+    if args.replicas > 0 and (args.prefetch > 0 or args.polygonize_workers > 0):
+        parser.error(
+            "--replicas decode and polygonize tiles in their own processes; drop --prefetch and --polygonize-workers."
+        )
+    if args.resume and args.checkpoint_dir is None:
+        parser.error("--resume needs the --checkpoint-dir of the run to resume.")
+    if args.stream and args.checkpoint_dir is not None:
+        parser.error("--stream cannot be combined with --checkpoint-dir.")
+    if args.stream and (args.vector_out is not None or args.parquet_out is not None):
+        parser.error(
+            "--vector-out and --parquet-out need the annotations in memory; drop --stream."
+        )
 
     raster_path = args.raster_file
     tile_size = args.tile_size
@@ -130,39 +309,65 @@ def main(args=None):
     weights_file = args.weights
     offset = args.overlap
 
-    # Create a temporary directory to store the raster tiles.
-    if args.temp_dir is None:
-        out_path = os.path.join(".", ".tmp", "tiles")
-
-    if not os.path.exists(out_path):
-        os.makedirs(out_path)
+    if args.in_memory:
+        # Read tiles as windows of the raster, keeping their transforms in memory.
+        log.info(f"Creating {int(tile_size)} px windows from {raster_path}")
+        with rio.open(raster_path) as geotiff:
+            tile_windows = raster_windows(geotiff, int(tile_size), overlap=offset)
+        tiles = [window for window, _ in tile_windows]
+        images = window_image_records(tiles)
+        load_fn = RasterWindowReader(raster_path)
 
-    # Preapare raster and tiles
-    log.info(f"Creating {tile_size} m*m tiles from {raster_path}")
-
-    # Read input files
-    geotiff = rio.open(raster_path)
-
-    # Create raster tiles
-    save_tiles(
-        geotiff, out_path, tile_size, tile_template="tile_{}-{}.tif", offset=offset
-    )
-    geotiff.close()
+        log.info(f"{len(images)} raster windows created")
+    else:
+        # Create a temporary directory to store the raster tiles.
+        if args.temp_dir is None:
+            out_path = os.path.join(".", ".tmp", "tiles")
+        else:
+            out_path = args.temp_dir
 
-    # Read the created raster tiles into a list.
-    raster_file_list = []
-    for filename in glob.iglob(os.path.join(f"{out_path}", "*.tif")):
-        raster_file_list.append(filename)
+        if not os.path.exists(out_path):
+            os.makedirs(out_path)
 
-    log.info(f"{len(raster_file_list)} raster tiles created")
+        # Preapare raster and tiles
+        log.info(f"Creating {tile_size} m*m tiles from {raster_path}")
 
-    # Make png images from the tiles
-    images = []
-    for filename in raster_file_list:
-        raster_to_coco(filename, 0, "png")
-        images.append(filename.replace(".tif", ".png"))
+        # Read input files
+        geotiff = rio.open(raster_path)
 
-    log.info(f"{len(images)} png tiles created")
+        # Create raster tiles
+        with profiling.span("save_tiles"):
+            save_tiles(
+                geotiff,
+                out_path,
+                tile_size,
+                tile_template="tile_{}-{}.tif",
+                offset=offset,
+            )
+        geotiff.close()
+
+        # Read the created raster tiles into a list.
+        raster_file_list = []
+        for filename in glob.iglob(os.path.join(f"{out_path}", "*.tif")):
+            raster_file_list.append(filename)
+
+        log.info(f"{len(raster_file_list)} raster tiles created")
+
+        # Make png images from the tiles
+        images = []
+        tile_windows = []
+        for filename in raster_file_list:
+            with profiling.span("raster_to_png"):
+                raster_to_coco(filename, 0, "png")
+            images.append(filename.replace(".tif", ".png"))
+            with rio.open(filename) as tile:
+                tile_windows.append(
+                    (Window(0, 0, tile.width, tile.height), tile.transform)
+                )
+        tiles = images
+        load_fn = cv2.imread
+
+        log.info(f"{len(images)} png tiles created")
 
     # Prepare model
     cfg = get_cfg()
@@ -185,39 +390,171 @@ def main(args=None):
     else:
         categories_keyed = None
 
-    assert (
-        len(images) > 0
-    ), f"No images found in the input directory given the pattern {args.in_pattern}."
+    assert len(images) > 0, f"No tiles created from the raster {raster_path}."
 
     # If not many images are given, this should be okay to go with CPU inference.
     if args.force_cpu:
         cfg.MODEL.DEVICE = "cpu"
 
-    predictor = DefaultPredictor(cfg)
+    if args.replicas > 0:
+        # Each replica builds its own predictor in its worker process.
+        predictor = functools.partial(
+            create_predictor,
+            cfg,
+            backend=args.backend,
+            paste_masks=not args.roi_masks,
+            num_threads=args.threads_per_replica,
+            quantized=args.quantized,
+        )
+    else:
+        predictor = create_predictor(
+            cfg,
+            backend=args.backend,
+            paste_masks=not args.roi_masks,
+            num_threads=args.threads,
+            quantized=args.quantized,
+        )
+    if args.cache_dir is not None:
+        cache = PredictionCache(
+            args.cache_dir,
+            cfg,
+            paste_masks=not args.roi_masks,
+            max_bytes=int(args.cache_size * 10**9),
+        )
+    else:
+        cache = None
 
-    all_annotations = extract_all_annotations_df(
-        images,
-        predictor,
-        simplify_tolerance=args.simplify_tolerance,
-        minimum_rotated_rectangle=args.minimum_rotated_rectangle,
-    )
-    coco_json = assemble_coco_json(
-        all_annotations,
-        images,
-        categories=categories_keyed,
-        license="",
-        info="",
-        type="instances",
-    )
     if args.coco_out is None:
+        out_dir = os.path.dirname(os.path.abspath(raster_path))
         if args.minimum_rotated_rectangle:
-            args.coco_out = os.path.join(args.indir, "coco-out-mrr.json")
+            args.coco_out = os.path.join(out_dir, "coco-out-mrr.json")
         else:
             args.coco_out = os.path.join(
-                args.indir, f"coco-out-tol_{str(args.simplify_tolerance)}.json"
+                out_dir, f"coco-out-tol_{str(args.simplify_tolerance)}.json"
             )
 
-    coco_json.write_to_file(args.coco_out)
+    pending_tiles = tiles
+    if args.stream:
+        writer_context = StreamingCocoWriter(args.coco_out, categories=categories_keyed)
+    elif args.checkpoint_dir is not None:
+        writer_context = RunCheckpoint(
+            args.checkpoint_dir,
+            params={
+                "config": os.path.abspath(config_file),
+                "weights": os.path.abspath(weights_file),
+                "threshold": args.threshold,
+                "simplify_tolerance": args.simplify_tolerance,
+                "minimum_rotated_rectangle": args.minimum_rotated_rectangle,
+                "roi_masks": args.roi_masks,
+                "roi_mask_resolution": args.roi_mask_resolution,
+                "raster_file": os.path.abspath(raster_path),
+                "tile_size": tile_size,
+                "overlap": offset,
+                "in_memory": args.in_memory,
+            },
+            resume=args.resume,
+        )
+        pending_tiles = writer_context.pending(tiles)
+        if args.resume:
+            print(
+                f"Resuming: {len(tiles) - len(pending_tiles)} of {len(tiles)} tiles already done"
+            )
+    else:
+        writer_context = contextlib.nullcontext()
+
+    timings = {}
+    with writer_context as writer:
+        if args.replicas > 0:
+            all_annotations = extract_all_annotations_replicated(
+                pending_tiles,
+                predictor,
+                num_replicas=args.replicas,
+                threads_per_replica=args.threads_per_replica,
+                pin_cores=args.pin_cores,
+                simplify_tolerance=args.simplify_tolerance,
+                minimum_rotated_rectangle=args.minimum_rotated_rectangle,
+                batch_size=args.batch_size,
+                timings=timings,
+                load_fn=load_fn,
+                mask_resolution=args.roi_mask_resolution,
+                writer=writer,
+                cache=cache,
+            )
+        else:
+            all_annotations = extract_all_annotations(
+                pending_tiles,
+                predictor,
+                simplify_tolerance=args.simplify_tolerance,
+                minimum_rotated_rectangle=args.minimum_rotated_rectangle,
+                batch_size=args.batch_size,
+                prefetch=args.prefetch,
+                decode_workers=args.decode_workers,
+                polygonize_workers=args.polygonize_workers,
+                timings=timings,
+                load_fn=load_fn,
+                mask_resolution=args.roi_mask_resolution,
+                writer=writer,
+                cache=cache,
+            )
+    if args.in_memory:
+        load_fn.close()
+    print(
+        "Stage timings: "
+        + ", ".join(f"{stage}: {seconds:.2f} s" for stage, seconds in timings.items())
+    )
+    if cache is not None:
+        print(f"Prediction cache: {cache.hits} hits, {cache.misses} misses")
+    if args.checkpoint_dir is not None:
+        all_annotations = writer_context.load([tile_file_name(tile) for tile in tiles])
+    if not args.stream:
+        coco_json = assemble_coco_json(
+            all_annotations,
+            images,
+            categories=categories_keyed,
+            license="",
+            info="",
+            type="instances",
+        )
+        with profiling.span("write_coco_json"), memory.stage("write_coco_json"):
+            coco_json.write_to_file(args.coco_out)
+
+    if args.vector_out is not None or args.parquet_out is not None:
+        with rio.open(raster_path) as geotiff:
+            crs = geotiff.crs
+
+    if args.parquet_out is not None:
+        all_annotations.to_parquet(
+            args.parquet_out,
+            transforms=[transform for _, transform in tile_windows],
+            crs=crs,
+        )
+
+    if args.vector_out is not None:
+        with profiling.span("merge_tile_predictions"):
+            merged = merge_tile_predictions(
+                all_annotations,
+                tile_windows,
+                crs=crs,
+                method=args.merge_method,
+                iou_threshold=args.merge_iou_threshold,
+            )
+        log.info(
+            f"Merged {len(all_annotations)} tile predictions into {len(merged)} polygons"
+        )
+        if args.vector_out.endswith(".parquet"):
+            merged.to_parquet(args.vector_out)
+        else:
+            merged.to_file(args.vector_out)
+
+    if profiling.enabled() or memory.enabled():
+        profiler = profiling.enable()
+        print(profiler.format_summary())
+        if memory.enabled():
+            print(memory.get_tracker().format_summary())
+        if args.profile_out is None:
+            args.profile_out = f"{os.path.splitext(args.coco_out)[0]}-profile.json"
+        profiler.write_chrome_trace(args.profile_out)
+        print(f"Profile written to {args.profile_out}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import argparse
+import glob
+import json
+import os
+
+import cv2
+from detectron2.config import get_cfg
+
+from aerialseg.quantization import calibrate, save_quantized
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(
+        description="Quantize a Detectron2 Mask R-CNN to dynamic INT8 for CPU inference, calibrated on sample tiles."
+    )
+    parser.add_argument(
+        "--config",
+        "-c",
+        type=str,
+        required=True,
+        help="Model configuration YAML file from Detectron2.",
+    )
+    parser.add_argument(
+        "--weights",
+        "-w",
+        type=str,
+        required=True,
+        help="Path to a weights .pth file output from Detectron2 training.",
+    )
+    parser.add_argument(
+        "--output",
+        "-o",
+        type=str,
+        required=True,
+        help="Path of the quantized model (.pth). The calibration report is written next to it, with a .json extension.",
+    )
+    parser.add_argument(
+        "--sample-dir",
+        type=str,
+        default="demo_data",
+        help="Directory of the calibration tiles. Default: %(default)s.",
+    )
+    parser.add_argument(
+        "--sample-pattern",
+        type=str,
+        default="*.png",
+        help="Glob pattern of the calibration tiles within --sample-dir. Default: %(default)s.",
+    )
+    parser.add_argument(
+        "--num-samples",
+        type=int,
+        default=8,
+        help="Number of calibration tiles. Default: %(default)s.",
+    )
+    parser.add_argument(
+        "--threshold",
+        "-t",
+        type=float,
+        default=0.7,
+        help="Detection threshold the predictions are compared at. Default: %(default)s.",
+    )
+    parser.add_argument(
+        "--modules",
+        type=str,
+        nargs="+",
+        default=None,
+        help="Names of the candidate nn.Linear modules, e.g. roi_heads.box_head.fc1. Default: all of them.",
+    )
+    parser.add_argument(
+        "--min-mask-iou",
+        type=float,
+        default=0.95,
+        help="Mean mask IoU with the float model a quantized module must keep. Default: %(default)s.",
+    )
+    parser.add_argument(
+        "--min-matched",
+        type=float,
+        default=0.95,
+        help="Fraction of instances matched with the float model a quantized module must keep. Default: %(default)s.",
+    )
+    return parser
+
+
+def main(args=None):
+    parser = create_parser()
+    args = parser.parse_args(args)
+
+    cfg = get_cfg()
+    cfg.merge_from_file(args.config)
+    cfg.MODEL.WEIGHTS = args.weights
+    cfg.MODEL.ROI_HEADS.SCORE_THRESH_TEST = args.threshold
+    cfg.MODEL.DEVICE = "cpu"
+
+    sample_files = sorted(glob.glob(os.path.join(args.sample_dir, args.sample_pattern)))
+    sample_files = sample_files[: args.num_samples]
+    if not sample_files:
+        parser.error(
+            f"No sample tiles match {args.sample_pattern} in {args.sample_dir}."
+        )
+    images = [cv2.imread(f) for f in sample_files]
+
+    model, report = calibrate(
+        cfg,
+        images,
+        module_names=args.modules,
+        min_mask_iou=args.min_mask_iou,
+        min_matched=args.min_matched,
+    )
+    for name, stats in report["candidates"].items():
+        status = "quantized" if name in report["modules"] else "kept in float"
+        print(
+            f"{name}: mask IoU {stats['mask_iou']:.3f}, "
+            f"{stats['matched_fraction']:.1%} matched, {status}"
+        )
+    quantized = report["quantized"]
+    print(
+        f"Float: {report['float']['latency_median_ms']:.1f} ms, "
+        f"quantized: {quantized['latency_median_ms']:.1f} ms median latency "
+        f"({report['speedup']:.2f}x), mask IoU {quantized['mask_iou']:.3f}, "
+        f"{quantized['matched_fraction']:.1%} matched"
+    )
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    save_quantized(model, args.output, report["modules"])
+    with open(f"{os.path.splitext(args.output)[0]}.json", "w") as f:
+        json.dump(
+            {
+                "weights": os.path.abspath(args.weights),
+                "samples": sample_files,
+                **report,
+            },
+            f,
+            indent=2,
+        )
+    print(f"Saved the quantized model to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
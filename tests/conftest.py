@@ -0,0 +1,13 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+
+@pytest.fixture
+def square():
+    """Returns a function creating the closed ring of a square polygon, as a
+    list of [x, y] points."""
+
+    def make_square(x, y, size=10):
+        return [[x, y], [x + size, y], [x + size, y + size], [x, y + size], [x, y]]
+
+    return make_square
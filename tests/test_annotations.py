@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import shapely
+from rasterio.transform import from_origin
+
+from aerialseg.annotations import AnnotationStore
+
+
+def test_annotation_store_concat(square):
+    """Test AnnotationStore.concat shifts the offsets of each store."""
+    first = AnnotationStore.from_polygons([square(0, 0), square(20, 20, 5)], 0, [1, 2])
+    second = AnnotationStore.from_polygons([square(5, 5)], 1, 3, score=0.9)
+    store = AnnotationStore.concat([first, AnnotationStore.empty(), second])
+
+    assert len(store) == 3
+    assert store.ring_offsets.tolist() == [0, 5, 10, 15]
+    assert store.image_id.tolist() == [0, 0, 1]
+    assert store.class_id.tolist() == [1, 2, 3]
+    assert np.isnan(store.score[0]) and np.isclose(store.score[2], 0.9)
+
+    annotations = store.to_pandas(as_lists=True)
+    assert annotations["annot_id"].tolist() == [0, 1, 2]
+    assert annotations["pixel_polygon"].tolist()[2] == square(5, 5)
+
+
+def test_annotation_store_to_shapely(square):
+    """Test AnnotationStore.to_shapely georeferences polygons with the
+    transforms of their tiles."""
+    store = AnnotationStore.from_polygons([square(0, 0), square(0, 0)], [0, 1], 0)
+    transforms = [from_origin(0, 100, 1, 1), from_origin(50, 100, 1, 1)]
+
+    pixel_geometries = store.to_shapely()
+    geometries = store.to_shapely(transforms)
+
+    assert shapely.area(pixel_geometries).tolist() == [100.0, 100.0]
+    assert np.allclose(shapely.area(geometries), 100.0)
+    assert np.allclose(shapely.bounds(geometries[1]), [50.5, 89.5, 60.5, 99.5])
+
+
+def test_annotation_store_arrow_roundtrip(square):
+    """Test AnnotationStore survives a round trip through Arrow."""
+    store = AnnotationStore.from_polygons(
+        [square(0, 0), square(20, 20, 5)], [0, 1], [1, 2], score=[0.5, 0.75]
+    )
+    table = store.to_arrow()
+    restored = AnnotationStore.from_arrow(table)
+
+    assert b"geo" in table.schema.metadata
+    assert np.array_equal(restored.coords, store.coords)
+    assert np.array_equal(restored.ring_offsets, store.ring_offsets)
+    assert np.array_equal(restored.polygon_offsets, store.polygon_offsets)
+    assert restored.class_id.tolist() == [1, 2]
+    assert restored.score.tolist() == [0.5, 0.75]
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+import pickle
+
+import numpy as np
+from detectron2.config import get_cfg
+
+from aerialseg.cache import PredictionCache, pack_masks, unpack_masks
+from aerialseg.utils import roi_mask_to_polygons
+
+
+def make_cfg(tmp_path):
+    weights = tmp_path / "model_final.pth"
+    weights.write_bytes(b"weights")
+    cfg = get_cfg()
+    cfg.MODEL.WEIGHTS = str(weights)
+
+    return cfg
+
+
+def make_arrays():
+    mask_array = np.zeros((2, 40, 50), dtype=bool)
+    mask_array[0, 5:15, 10:30] = True
+    mask_array[1, 20:38, 2:9] = True
+    bbox = np.array([[10, 5, 29, 14], [2, 20, 8, 37]], dtype=np.float32)
+
+    return mask_array, bbox, np.array([0, 1]), False, np.array([0.9, 0.8])
+
+
+def test_pack_masks_roundtrip():
+    """Test unpack_masks restores the masks packed by pack_masks."""
+    mask_array, bbox, _, _, _ = make_arrays()
+    packed = pack_masks(mask_array, bbox)
+
+    assert np.array_equal(unpack_masks(packed, (40, 50)), mask_array)
+
+
+def test_prediction_cache(tmp_path):
+    """Test PredictionCache replays stored predictions and evicts the least
+    recently used tiles beyond its size cap."""
+    cache = PredictionCache(str(tmp_path / "cache"), make_cfg(tmp_path))
+    images = [np.full((40, 50, 3), value, dtype=np.uint8) for value in range(3)]
+    keys = [cache.key(image) for image in images]
+
+    assert len(set(keys)) == 3
+    assert cache.get(keys[0]) is None
+
+    cache.put(keys[0], make_arrays(), images[0].shape)
+    mask_array, bbox, labels, roi_masks, scores = cache.get(keys[0])
+
+    assert np.array_equal(mask_array, make_arrays()[0])
+    assert labels.tolist() == [0, 1] and not roi_masks
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    # Room for two entries: the least recently used one is evicted.
+    cache.max_bytes = 2 * cache.size
+    cache.put(keys[1], make_arrays(), images[1].shape)
+    cache.get(keys[0])
+    cache.put(keys[2], make_arrays(), images[2].shape)
+
+    assert cache.get(keys[1]) is None
+    assert cache.get(keys[0]) is not None
+
+
+def test_prediction_cache_pickle(tmp_path):
+    """Test a pickled PredictionCache, as sent to replica workers, reads the
+    entries of the original."""
+    cache = PredictionCache(str(tmp_path / "cache"), make_cfg(tmp_path))
+    image = np.zeros((40, 50, 3), dtype=np.uint8)
+    key = cache.key(image)
+    cache.put(key, make_arrays(), image.shape)
+
+    copy = pickle.loads(pickle.dumps(cache))
+
+    assert copy.key(image) == key
+    assert copy.get(key) is not None
+
+
+def test_prediction_cache_shared_cap(tmp_path):
+    """Test PredictionCache copies sharing a directory, as replica workers
+    do, keep it within the size cap together."""
+    cache = PredictionCache(str(tmp_path / "cache"), make_cfg(tmp_path))
+    images = [np.full((40, 50, 3), value, dtype=np.uint8) for value in range(4)]
+    cache.put(cache.key(images[0]), make_arrays(), images[0].shape)
+    cache.max_bytes = 2 * cache.size
+    copy = pickle.loads(pickle.dumps(cache))
+
+    cache.put(cache.key(images[1]), make_arrays(), images[1].shape)
+    copy.put(copy.key(images[2]), make_arrays(), images[2].shape)
+    copy.put(copy.key(images[3]), make_arrays(), images[3].shape)
+    entries = list((tmp_path / "cache").rglob("*.npz"))
+
+    assert sum(entry.stat().st_size for entry in entries) <= cache.max_bytes
+    assert cache.get(cache.key(images[3])) is not None
+
+
+def test_prediction_cache_roi_masks(tmp_path):
+    """Test a replayed ROI mask prediction polygonizes exactly like the
+    original, with probabilities close to the mask threshold."""
+    cache = PredictionCache(
+        str(tmp_path / "cache"), make_cfg(tmp_path), paste_masks=False
+    )
+    image = np.zeros((40, 50, 3), dtype=np.uint8)
+    key = cache.key(image)
+    rng = np.random.default_rng(0)
+    mask_probs = (0.5 + rng.uniform(-1e-3, 1e-3, (2, 28, 28))).astype(np.float32)
+    bbox = np.array([[10, 5, 29, 14], [2, 20, 8, 37]], dtype=np.float32)
+    arrays = (mask_probs, bbox, np.array([0, 1]), True, np.array([0.9, 0.8]))
+    cache.put(key, arrays, image.shape)
+
+    replayed, replayed_bbox, _, roi_masks, _ = cache.get(key)
+
+    assert roi_masks
+    assert np.array_equal(replayed, mask_probs)
+    for original, mask, box in zip(mask_probs, replayed, replayed_bbox):
+        expected = roi_mask_to_polygons(original, box)
+        polygons = roi_mask_to_polygons(mask, box)
+        assert len(polygons) == len(expected)
+        assert all(np.array_equal(a, b) for a, b in zip(polygons, expected))
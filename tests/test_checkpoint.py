@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from aerialseg.annotations import AnnotationStore
+from aerialseg.checkpoint import RunCheckpoint
+
+
+def test_run_checkpoint_resume(tmp_path, square):
+    """Test RunCheckpoint skips completed tiles on resume and assembles
+    their annotations with the image ids of the full run."""
+    checkpoint_dir = str(tmp_path / "checkpoint")
+    tiles = ["a.png", "b.png", "c.png"]
+
+    # The first run completes two tiles, one of them empty, then dies.
+    with RunCheckpoint(checkpoint_dir, params={"threshold": 0.7}) as checkpoint:
+        checkpoint.add_image(0, "a.png", 100, 100)
+        checkpoint.add_image(1, "b.png", 100, 100)
+        checkpoint.add_annotations(AnnotationStore.from_polygons([square(0, 0)], 0, 1))
+        checkpoint.add_annotations(AnnotationStore.empty())
+
+    with pytest.raises(FileExistsError):
+        RunCheckpoint(checkpoint_dir, params={"threshold": 0.7})
+    with pytest.raises(ValueError):
+        RunCheckpoint(checkpoint_dir, params={"threshold": 0.5}, resume=True)
+
+    with RunCheckpoint(
+        checkpoint_dir, params={"threshold": 0.7}, resume=True
+    ) as checkpoint:
+        assert checkpoint.pending(tiles) == ["c.png"]
+        checkpoint.add_image(0, "c.png", 100, 100)
+        checkpoint.add_annotations(
+            AnnotationStore.from_polygons([square(5, 5), square(20, 20)], 0, 2)
+        )
+
+    annotations = checkpoint.load(tiles)
+
+    assert annotations.image_id.tolist() == [0, 2, 2]
+    assert annotations.class_id.tolist() == [1, 2, 2]
+    assert annotations.to_pandas(as_lists=True)["pixel_polygon"][1] == square(5, 5)
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+import geopandas as gpd
+import numpy as np
+import shapely
+from shapely.geometry import Polygon, box
+
+from scripts.density_map import (
+    cell_densities,
+    density_estimate_combined_area,
+    density_map_blocks,
+    density_map_maker,
+    density_raster,
+    density_raster_maker,
+    grid_cells,
+)
+
+
+def buildings():
+    """Creates buildings crossing and touching the cells of a 10 m grid."""
+    return gpd.GeoDataFrame(
+        {
+            "storeys": [2, 0, 3, 1, 0, 4],
+            "geometry": [
+                box(1, 1, 4, 4),
+                box(8, 2, 13, 6),
+                box(12, 12, 18, 14),
+                box(5, 15, 25, 25),
+                box(21, 1, 24, 3),
+                box(10, 22, 14, 26),
+            ],
+        },
+        crs="EPSG:3857",
+    )
+
+
+def per_cell_densities(gdf, cells, area, average_storeys=None):
+    """Gets the densities by clipping the buildings to each cell in turn."""
+    densities = []
+    for cell in cells:
+        extent = gpd.GeoDataFrame(
+            {"id": [1], "geometry": [cell]}, crs=gdf.crs
+        ).buffer(0)
+        annotation = gdf.clip(extent).explode(index_parts=False)
+        densities.append(
+            density_estimate_combined_area(
+                annotation.reset_index(drop=True),
+                crs="EPSG:3857",
+                average_storeys=average_storeys,
+                area=area,
+            )
+        )
+
+    return np.array(densities)
+
+
+def test_grid_cells_order():
+    """Test grid_cells creates the cells column by column, from the bottom up."""
+    cells = grid_cells(0, 0, 25, 15, 10)
+    expected = [
+        Polygon([(x, y), (x + 10, y), (x + 10, y + 10), (x, y + 10)])
+        for x in (0, 10, 20)
+        for y in (0, 10)
+    ]
+
+    assert len(cells) == 6
+    assert [cell.wkt for cell in cells] == [cell.wkt for cell in expected]
+
+
+def test_cell_densities_match_per_cell_clip():
+    """Test cell_densities returns the densities of clipping each cell."""
+    gdf = buildings()
+    cells = grid_cells(0, 0, 30, 30, 10)
+
+    np.testing.assert_array_equal(
+        cell_densities(gdf, cells, 900.0, crs="EPSG:3857"),
+        per_cell_densities(gdf, cells, 900.0),
+    )
+    np.testing.assert_array_equal(
+        cell_densities(gdf, cells, 900.0, crs="EPSG:3857", average_storeys=2),
+        per_cell_densities(gdf, cells, 900.0, average_storeys=2),
+    )
+
+
+def test_density_raster_matches_cell_densities():
+    """Test density_raster returns the densities of cell_densities, from the
+    top row down, for buildings within single cells on the subpixel grid."""
+    gdf = gpd.GeoDataFrame(
+        {
+            "geometry": [
+                box(1, 1, 4, 4),
+                box(5, 2, 9, 8),
+                box(12, 12, 18, 14),
+                box(21, 15, 29, 19),
+                box(22, 2, 24, 8),
+            ]
+        },
+        crs="EPSG:3857",
+    )
+    cells = grid_cells(0, 0, 30, 20, 10)
+    expected = cell_densities(gdf, cells, 600.0, crs="EPSG:3857", average_storeys=2)
+
+    density, transform = density_raster(
+        gdf, (0, 0, 30, 20), 10, 600.0, average_storeys=2, supersample=10
+    )
+
+    assert density.shape == (2, 3)
+    assert (transform.c, transform.f) == (0, 20)
+    np.testing.assert_allclose(density, expected.reshape(3, 2).T[::-1])
+
+
+def test_density_map_blocks_match_density_map_maker(tmp_path):
+    """Test density_map_blocks returns the density map of the whole file,
+    with buildings crossing the borders of the blocks."""
+    input_path = str(tmp_path / "buildings.geojson")
+    buildings().to_file(input_path, driver="GeoJSON")
+    gdf = gpd.read_file(input_path)
+
+    grid = density_map_blocks(
+        input_path, tile_size=5, area_unit="meter", block_size=2, workers=2
+    )
+    expected = density_map_maker(gdf, tile_size=5, area_unit="meter")
+
+    assert [cell.wkt for cell in grid.geometry] == [
+        cell.wkt for cell in expected.geometry
+    ]
+    np.testing.assert_allclose(grid["density"], expected["density"])
+
+    density, transform, _ = density_map_blocks(
+        input_path,
+        tile_size=5,
+        area_unit="meter",
+        output_format="geotiff",
+        block_size=2,
+        workers=2,
+    )
+    expected_density, expected_transform, _ = density_raster_maker(
+        gdf, tile_size=5, area_unit="meter"
+    )
+
+    assert transform == expected_transform
+    np.testing.assert_allclose(density, expected_density)
+
+
+def test_density_map_blocks_reprojected_bbox(tmp_path):
+    """Test density_map_blocks reads all buildings of each block when the
+    file is in EPSG:4326 and the grid in UTM, across the central meridian."""
+    # Buildings every 40 m around the central meridian of UTM zone 56S.
+    x, y = np.meshgrid(
+        np.arange(499_500, 500_500, 40), np.arange(6_250_000, 6_251_000, 40)
+    )
+    x, y = x.ravel(), y.ravel()
+    gdf = gpd.GeoDataFrame(
+        {"geometry": shapely.box(x, y, x + 12, y + 8)}, crs="EPSG:32756"
+    ).to_crs("EPSG:4326")
+    input_path = str(tmp_path / "buildings.geojson")
+    gdf.to_file(input_path, driver="GeoJSON")
+
+    grid = density_map_blocks(
+        input_path, tile_size=100, area_unit="utm", block_size=3, workers=2
+    )
+    expected = density_map_maker(
+        gpd.read_file(input_path), tile_size=100, area_unit="utm"
+    )
+
+    assert grid.crs == expected.crs
+    np.testing.assert_allclose(grid["density"], expected["density"])
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+
+from aerialseg.export import box_iou, match_instances
+
+
+def test_box_iou():
+    """Test box_iou against hand-computed overlaps."""
+    boxes1 = np.array([[0, 0, 10, 10], [20, 20, 30, 30]])
+    boxes2 = np.array([[0, 0, 10, 10], [5, 0, 15, 10], [0, 0, 0, 0]])
+    iou = box_iou(boxes1, boxes2)
+
+    assert iou.shape == (2, 3)
+    np.testing.assert_allclose(iou[0], [1.0, 50 / 150, 0.0])
+    np.testing.assert_allclose(iou[1], [0.0, 0.0, 0.0])
+
+
+def test_match_instances():
+    """Test match_instances matches one to one, within the same class."""
+    boxes1 = np.array([[0, 0, 10, 10], [0, 0, 10, 11], [50, 50, 60, 60]])
+    boxes2 = np.array([[0, 0, 10, 10], [50, 50, 60, 60], [100, 100, 110, 110]])
+    matches = match_instances(boxes1, [0, 0, 1], boxes2, [0, 0, 1])
+
+    assert [(i, j) for i, j, _ in matches] == [(0, 0)]
+
+    matches = match_instances(boxes1, [0, 0, 1], boxes2, [0, 1, 1])
+
+    assert sorted((i, j) for i, j, _ in matches) == [(0, 0), (2, 1)]
+    assert match_instances(boxes1, [0, 0, 1], boxes2[:0], []) == []
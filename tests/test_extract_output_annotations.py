@@ -1,7 +1,16 @@
 # -*- coding: utf-8 -*-
 import os
 
-from aerialseg.utils import extract_output_annotations
+import numpy as np
+import supervision as sv
+
+from aerialseg.utils import (
+    decode_mask,
+    encode_mask,
+    extract_output_annotations,
+    mask_to_polygons_in_box,
+    roi_mask_to_polygons,
+)
 
 
 def test_output_dims():
@@ -41,3 +50,64 @@ def test_output_dims():
     assert len(polygons) >= 1
     assert len(bbox) >= 1
     assert len(labels) >= 1
+
+
+def test_mask_to_polygons_in_box():
+    """Test mask_to_polygons_in_box gives the same polygons as tracing the
+    full mask."""
+    cases = []
+    # An instance in two parts within its box.
+    instance = np.zeros((200, 300, 1), dtype=bool)
+    instance[40:60, 100:130] = True
+    instance[45:50, 140:150] = True
+    cases.append((instance, np.array([100.0, 40.0, 149.6, 59.2])))
+    # An instance touching the image edges.
+    instance = np.zeros((200, 300, 1), dtype=bool)
+    instance[180:200, 0:25] = True
+    cases.append((instance, np.array([0.0, 180.0, 24.5, 199.9])))
+    # An instance exceeding its box, which falls back to the full mask.
+    instance = np.zeros((200, 300, 1), dtype=bool)
+    instance[40:60, 100:130] = True
+    cases.append((instance, np.array([110.0, 42.0, 120.0, 50.0])))
+
+    for instance, box in cases:
+        expected = sv.mask_to_polygons(instance)
+        polygons = mask_to_polygons_in_box(instance, box)
+
+        assert len(polygons) == len(expected)
+        for polygon, expected_polygon in zip(polygons, expected):
+            assert np.array_equal(polygon, expected_polygon)
+
+
+def test_roi_mask_to_polygons():
+    """Test roi_mask_to_polygons maps a ROI mask onto its box in image
+    coordinates."""
+    mask_prob = np.zeros((28, 28), dtype=np.float32)
+    mask_prob[7:21, 7:21] = 1.0  # the central half of the box
+    box = np.array([100.0, 200.0, 156.0, 256.0])
+
+    for resolution in [0, 28]:
+        polygons = roi_mask_to_polygons(mask_prob, box, resolution=resolution)
+
+        assert len(polygons) == 1
+        x_min, y_min = polygons[0].min(axis=0)
+        x_max, y_max = polygons[0].max(axis=0)
+        assert abs(x_min - 114) <= 2 and abs(x_max - 142) <= 2
+        assert abs(y_min - 214) <= 2 and abs(y_max - 242) <= 2
+
+
+def test_encode_mask_roundtrip():
+    """Test compact mask encodings decode back to the original mask."""
+    mask = np.zeros((120, 160, 1), dtype=bool)
+    mask[30:52, 70:95] = True
+    mask[40:45, 60:70] = True
+    box = np.array([60.0, 30.0, 94.2, 51.7])
+
+    for mask_format in ["rle", "packbits"]:
+        encoded = encode_mask(mask, box, mask_format=mask_format)
+        decoded = decode_mask(encoded, image_shape=mask.shape)
+
+        assert np.array_equal(decoded, mask[:, :, 0])
+
+    packed = encode_mask(mask, box, mask_format="packbits")
+    assert packed["bits"].nbytes < mask.nbytes / 8
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+import subprocess
+import sys
+
+import pytest
+
+from aerialseg.memory import (
+    MemoryTracker,
+    RssSampler,
+    process_tree_rss,
+    reset_rss_high_water_mark,
+)
+
+
+def test_process_tree_rss():
+    """Test process_tree_rss counts the RSS of child processes."""
+    alone = process_tree_rss()
+    child = subprocess.Popen(
+        [sys.executable, "-c", "import sys; sys.stdin.read()"], stdin=subprocess.PIPE
+    )
+    try:
+        with RssSampler(interval=0.01) as rss:
+            with_child = process_tree_rss()
+    finally:
+        child.communicate(b"")
+
+    assert alone > 0
+    assert with_child > alone
+    assert rss.peak >= with_child
+
+
+def test_memory_tracker_stages():
+    """Test the peaks of a nested stage are carried into the enclosing
+    stage and tile."""
+    tracker = MemoryTracker(top_k=2)
+    try:
+        with tracker.tile(["tile_0.png"]) as record:
+            with tracker.stage("predict"):
+                with tracker.stage("forward"):
+                    buffer = bytearray(8 * 2**20)
+                    del buffer
+            record["instances"] = [3]
+    finally:
+        tracker.close()
+
+    summary = tracker.summary()
+    forward = summary["stages"]["forward"]
+    assert forward["calls"] == 1
+    assert forward["peak_traced_mb"] >= 8
+    assert summary["stages"]["predict"]["peak_traced_mb"] >= 8
+    assert summary["top_tiles"][0]["peak_traced_mb"] >= 8
+    assert summary["top_tiles"][0]["instances"] == [3]
+    assert summary["top_tiles"][0]["peak_rss_mb"] > 0
+
+
+@pytest.mark.skipif(
+    not reset_rss_high_water_mark(), reason="The peak RSS can not be reset."
+)
+def test_memory_tracker_top_tiles_and_merge():
+    """Test the top tiles are those with the highest peak RSS, across merged
+    trackers."""
+    tracker = MemoryTracker(top_k=2, trace_python=False)
+    worker = MemoryTracker(top_k=2, trace_python=False)
+    for name, size in [("a", 64), ("b", 1), ("c", 16)]:
+        owner = worker if name == "c" else tracker
+        with owner.tile([name]):
+            buffer = bytearray(size * 2**20)
+            buffer[::4096] = b"x" * len(buffer[::4096])
+            del buffer
+
+    tracker.merge(worker.drain())
+
+    summary = tracker.summary()
+    assert summary["tiles"] == 3
+    assert len(summary["tile_records"]) == 3
+    assert [record["tiles"] for record in summary["top_tiles"]] == [["a"], ["c"]]
+    assert worker.summary()["tiles"] == 0
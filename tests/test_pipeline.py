@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+
+from aerialseg.pipeline import PolygonizerPool, Prefetcher, batched
+from aerialseg.utils import extract_mask_annotation_store
+
+
+def test_batched():
+    """Test batched function."""
+    batches = list(batched(range(7), 3))
+
+    assert batches == [[0, 1, 2], [3, 4, 5], [6]]
+
+
+def test_prefetcher_order():
+    """Test Prefetcher yields items in input order, with and without
+    prefetching."""
+    items = list(range(20))
+    for depth in [0, 1, 4]:
+        prefetcher = Prefetcher(items, load_fn=lambda x: x * 2, depth=depth)
+        loaded = list(prefetcher)
+
+        assert [item for item, _ in loaded] == items
+        assert [image for _, image in loaded] == [x * 2 for x in items]
+        assert prefetcher.decode_time >= 0
+        assert prefetcher.hidden_time <= prefetcher.decode_time
+
+
+def make_tile(num_instances):
+    mask_array = np.zeros((num_instances, 40, 50), dtype=bool)
+    bbox = np.zeros((num_instances, 4), dtype=np.float32)
+    for i in range(num_instances):
+        x, y = 2 + 12 * i, 5 + 3 * i
+        mask_array[i, y : y + 10, x : x + 8] = True
+        bbox[i] = x, y, x + 7, y + 9
+    scores = np.linspace(0.9, 0.5, num_instances)
+
+    return mask_array, bbox, np.arange(num_instances) % 2, False, scores
+
+
+def test_polygonizer_pool_order():
+    """Test PolygonizerPool returns the annotations of each tile in
+    submission order, as polygonizing in process would, with an empty tile
+    and at most one tile in flight."""
+    tiles = [make_tile(num_instances) for num_instances in (2, 0, 3, 1)]
+    results = []
+    with PolygonizerPool(num_workers=2, max_pending=1) as pool:
+        for image_id, arrays in enumerate(tiles):
+            pool.submit_arrays(arrays, image_id)
+            results.extend(pool.collect())
+        results.extend(pool.collect(wait=True))
+
+    assert [len(annotations) for annotations in results] == [2, 0, 3, 1]
+    for image_id, (annotations, arrays) in enumerate(zip(results, tiles)):
+        mask_array, bbox, labels, _, scores = arrays
+        expected = extract_mask_annotation_store(
+            mask_array, bbox, labels, image_id, scores=scores
+        )
+        polygonized = annotations.to_pandas(as_lists=True).to_dict("list")
+
+        assert polygonized == expected.to_pandas(as_lists=True).to_dict("list")
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pandas as pd
+import rasterio.transform
+import shapely
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+
+from aerialseg.postprocess import georeference_polygons, merge_tile_predictions
+
+
+def test_merge_tile_predictions(square):
+    """Test merge_tile_predictions removes a building predicted on both
+    sides of a tile seam."""
+    tile_windows = [
+        (Window(0, 0, 60, 60), from_origin(0, 100, 1, 1)),
+        (Window(40, 0, 60, 60), from_origin(40, 100, 1, 1)),
+    ]
+    annotations = pd.DataFrame(
+        {
+            "annot_id": [0, 1, 2],
+            # A building only on the first tile, and one in the overlap strip.
+            "pixel_polygon": [square(5, 5), square(45, 10), square(5, 10)],
+            "image_id": [0, 0, 1],
+            "class_id": [0, 0, 0],
+        }
+    )
+
+    for method in ["iou", "core"]:
+        merged = merge_tile_predictions(
+            annotations, tile_windows, crs="EPSG:3857", method=method
+        )
+
+        assert len(merged) == 2
+        assert merged.crs == "EPSG:3857"
+        assert 0 in merged["annot_id"].tolist()
+        assert merged.geometry.area.tolist() == [100.0, 100.0]
+
+
+def test_georeference_polygons(square):
+    """Test georeference_polygons maps vertices as rasterio.transform.xy
+    does."""
+    transform = from_origin(151.2, -33.8, 0.001, 0.001)
+    polygons = [square(0, 0), np.array(square(20, 30, size=5)).flatten().tolist()]
+    geometries = georeference_polygons(polygons, transform)
+
+    assert len(geometries) == 2
+    for polygon, geometry in zip(polygons, geometries):
+        vertices = np.array(polygon).reshape(-1, 2)
+        xs, ys = rasterio.transform.xy(transform, vertices[:, 1], vertices[:, 0])
+        expected = np.column_stack([xs, ys])
+
+        assert np.allclose(shapely.get_coordinates(geometry), expected)
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+
+from aerialseg.predictors import exported_outputs_to_instances, roi_postprocess
+
+
+def test_exported_outputs_to_instances():
+    """Test exported_outputs_to_instances drops low scores, and its results
+    rescale to the original image with roi_postprocess."""
+    boxes = np.array([[10, 10, 50, 30], [0, 0, 20, 20]], dtype=np.float32)
+    masks = np.full((2, 1, 28, 28), 0.9, dtype=np.float32)
+    results = exported_outputs_to_instances(
+        boxes,
+        np.array([1, 0]),
+        masks,
+        np.array([0.9, 0.3], dtype=np.float32),
+        (100, 200),
+        score_threshold=0.5,
+    )
+
+    assert len(results) == 1
+    assert results.pred_classes.tolist() == [1]
+
+    instances = roi_postprocess(results, 200, 400)
+
+    assert instances.image_size == (200, 400)
+    assert instances.pred_boxes.tensor.tolist() == [[20.0, 20.0, 100.0, 60.0]]
+    assert tuple(instances.pred_mask_probs.shape) == (1, 28, 28)
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+import json
+
+import pytest
+
+from aerialseg import profiling
+
+
+@pytest.fixture
+def profiler():
+    profiling.disable()
+    yield profiling.enable()
+    profiling.disable()
+
+
+def test_disabled_spans_are_not_recorded():
+    """Test spans and counters do nothing while profiling is off."""
+    profiling.disable()
+    with profiling.span("predict"):
+        profiling.count("instances_per_tile", 3)
+
+    assert not profiling.enabled()
+    assert profiling.get_profiler() is None
+
+
+def test_spans_and_counters(profiler):
+    """Test spans and counters are summed per name."""
+
+    @profiling.traced()
+    def polygonize():
+        profiling.count("instances_per_tile", 2)
+
+    for _ in range(3):
+        with profiling.span("postprocess"):
+            polygonize()
+    profiling.count("instances_per_tile", 5)
+
+    summary = profiler.summary()
+    assert summary["spans"]["postprocess"]["calls"] == 3
+    assert summary["spans"]["polygonize"]["calls"] == 3
+    assert (
+        summary["spans"]["postprocess"]["total_s"]
+        >= summary["spans"]["polygonize"]["total_s"]
+    )
+    counter = summary["counters"]["instances_per_tile"]
+    assert counter["events"] == 4
+    assert counter["total"] == 11
+    assert counter["max"] == 5
+
+
+def test_drain_and_merge(profiler):
+    """Test the state drained from a profiler merges into another, keeping
+    at most max_events trace events."""
+    worker = profiling.Profiler()
+    for _ in range(3):
+        worker.add_span("predict", 0, 1000)
+    worker.count("instances_per_tile", 4)
+    profiler.max_events = 2
+    profiler.add_span("predict", 0, 3000)
+
+    profiler.merge(worker.drain())
+
+    summary = profiler.summary()
+    assert summary["spans"]["predict"]["calls"] == 4
+    assert summary["spans"]["predict"]["max_ms"] == pytest.approx(0.003)
+    assert summary["counters"]["instances_per_tile"]["total"] == 4
+    assert len(profiler.events) == 2
+    assert summary["dropped_events"] == 2
+    assert worker.summary()["spans"] == {}
+
+
+def test_chrome_trace(profiler, tmp_path):
+    """Test the Chrome trace holds a complete event per span, with the
+    summary."""
+    with profiling.span("decode"):
+        pass
+    path = tmp_path / "profile.json"
+    profiler.write_chrome_trace(str(path))
+
+    with open(path) as f:
+        trace = json.load(f)
+    spans = [event for event in trace["traceEvents"] if event["ph"] == "X"]
+    assert [event["name"] for event in spans] == ["decode"]
+    assert spans[0]["dur"] >= 0
+    assert "decode" in trace["summary"]["spans"]
+    assert "decode" in profiler.format_summary()
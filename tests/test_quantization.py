@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+import torch
+from torch import nn
+
+from aerialseg.quantization import (
+    linear_module_names,
+    load_quantized,
+    quantize_model,
+    save_quantized,
+)
+
+
+def make_model():
+    torch.manual_seed(0)
+    model = nn.Sequential()
+    model.add_module("conv", nn.Conv2d(1, 2, 3))
+    model.add_module("flatten", nn.Flatten())
+    model.add_module("fc1", nn.Linear(8, 16))
+    model.add_module("fc2", nn.Linear(16, 4))
+
+    return model.eval()
+
+
+def test_quantize_model():
+    """Test quantize_model only quantizes the named linear modules, and
+    keeps the float model."""
+    model = make_model()
+
+    assert linear_module_names(model) == ["fc1", "fc2"]
+
+    quantized = quantize_model(model, ["fc1"])
+
+    assert linear_module_names(quantized) == ["fc2"]
+    assert linear_module_names(model) == ["fc1", "fc2"]
+
+    inputs = torch.rand(2, 1, 4, 4)
+    torch.testing.assert_close(quantized(inputs), model(inputs), atol=0.05, rtol=0)
+
+
+def test_save_load_quantized(tmp_path):
+    """Test a quantized model reloads into a float model of the same
+    architecture."""
+    quantized = quantize_model(make_model())
+    path = str(tmp_path / "model_int8.pth")
+    save_quantized(quantized, path, ["fc1", "fc2"])
+
+    model = make_model()
+    nn.init.zeros_(model.conv.weight)
+    loaded = load_quantized(model, path)
+    inputs = torch.rand(2, 1, 4, 4)
+
+    torch.testing.assert_close(loaded(inputs), quantized(inputs))
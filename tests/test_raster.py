@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+from rasterio.transform import from_origin
+
+from aerialseg.raster import raster_to_image, raster_windows
+
+
+def test_raster_windows_cover_raster():
+    """Test raster_windows covers the raster with overlapping windows."""
+    raster = SimpleNamespace(
+        width=2500, height=1000, transform=from_origin(150.0, -33.0, 0.1, 0.1)
+    )
+    tiles = raster_windows(raster, 1000, overlap=10)
+    windows = [window for window, _ in tiles]
+
+    assert [int(window.col_off) for window in windows] == [0, 900, 1800]
+    assert all(int(window.row_off) == 0 for window in windows)
+    assert int(windows[-1].col_off + windows[-1].width) == raster.width
+    # The transform of each window is offset from the raster origin.
+    assert tiles[1][1].c == pytest.approx(150.0 + 900 * 0.1)
+
+
+def test_raster_to_image():
+    """Test raster_to_image returns a BGR image as cv2.imread would."""
+    data = np.stack(
+        [np.full((4, 5), 10), np.full((4, 5), 20), np.full((4, 5), 30)]
+    ).astype(np.uint8)
+    image = raster_to_image(data)
+
+    assert image.shape == (4, 5, 3)
+    assert image.dtype == np.uint8
+    assert list(image[0, 0]) == [30, 20, 10]
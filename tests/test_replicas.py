@@ -0,0 +1,13 @@
+# -*- coding: utf-8 -*-
+from aerialseg.replicas import replica_cores
+
+
+def test_replica_cores():
+    """Test replica_cores hands out consecutive blocks of cores, wrapping
+    around when replicas outnumber them."""
+    cores = [0, 1, 2, 3, 4, 5]
+
+    assert replica_cores(0, 2, cores) == [0, 1]
+    assert replica_cores(2, 2, cores) == [4, 5]
+    assert replica_cores(3, 2, cores) == [0, 1]
+    assert replica_cores(1, 4, cores) == [4, 5, 0, 1]
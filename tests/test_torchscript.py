@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+import pytest
+import torch
+
+from aerialseg.torchscript import Boxes, Instances, postprocess, resized_shape
+from aerialseg.utils import output_to_arrays
+
+
+def make_results():
+    masks = torch.zeros((2, 1, 28, 28))
+    masks[:, :, 7:21, 7:21] = 1.0
+
+    return Instances(
+        (100, 200),
+        pred_boxes=Boxes(
+            torch.tensor([[10.0, 10.0, 50.0, 30.0], [5.0, 5.0, 5.0, 9.0]])
+        ),
+        pred_classes=torch.tensor([1, 0]),
+        pred_masks=masks,
+        scores=torch.tensor([0.9, 0.8]),
+    )
+
+
+def test_resized_shape():
+    """Test resized_shape follows ResizeShortestEdge, including max_size."""
+    assert resized_shape(400, 600, 800, 1333) == (800, 1200)
+    assert resized_shape(600, 400, 800, 1333) == (1200, 800)
+    assert resized_shape(400, 1000, 800, 1333) == (533, 1333)
+
+
+def test_postprocess_paste():
+    """Test postprocess rescales boxes, drops empty boxes and pastes masks."""
+    instances = postprocess(make_results(), 200, 400)
+
+    assert len(instances) == 1
+    assert instances.image_size == (200, 400)
+    assert instances.pred_boxes.tensor.tolist() == [[20.0, 20.0, 100.0, 60.0]]
+    assert tuple(instances.pred_masks.shape) == (1, 200, 400)
+    # The pasted mask covers the middle half of the box.
+    assert instances.pred_masks[0, 40, 60]
+    assert not instances.pred_masks[0, 22, 22]
+    assert not instances.pred_masks[0].any(dim=1)[:20].any()
+
+
+def test_postprocess_roi_masks():
+    """Test postprocess keeps ROI masks, readable by output_to_arrays."""
+    instances = postprocess(make_results(), 200, 400, paste=False)
+    mask_array, bbox, labels, roi_masks, scores = output_to_arrays(
+        {"instances": instances}
+    )
+
+    assert roi_masks
+    assert mask_array.shape == (1, 28, 28)
+    assert bbox.tolist() == [[20.0, 20.0, 100.0, 60.0]]
+    assert labels.tolist() == [1]
+    assert scores.tolist() == pytest.approx([0.9])
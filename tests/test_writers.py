@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+import json
+
+import pandas as pd
+
+from aerialseg.writers import StreamingCocoWriter
+
+
+def test_streaming_coco_writer(tmp_path):
+    """Test StreamingCocoWriter writes a complete COCO JSON with sequential
+    annotation ids."""
+    path = tmp_path / "coco-out.json"
+    square = [0, 0, 10, 0, 10, 10, 0, 10, 0, 0]
+    with StreamingCocoWriter(str(path)) as writer:
+        for image_id in range(2):
+            writer.add_image(image_id, f"tile_{image_id}.png", 100, 100)
+            writer.add_annotations(
+                pd.DataFrame(
+                    {
+                        "pixel_polygon": [square, square],
+                        "image_id": [image_id, image_id],
+                        "class_id": [0, 1],
+                    }
+                )
+            )
+        writer.add_annotations(
+            pd.DataFrame(columns=["pixel_polygon", "image_id", "class_id"])
+        )
+
+        assert not path.exists()
+
+    with open(path) as f:
+        coco_json = json.load(f)
+
+    assert [image["id"] for image in coco_json["images"]] == [0, 1]
+    assert len(coco_json["annotations"]) == 4
+    assert len(coco_json["categories"]) == 2
+    assert coco_json["type"] == "instances"